@@ -1,5 +1,7 @@
+from functools import partial
 import six.moves.builtins
 import logging
+import time
 
 from blazeutils.datastructures import BlankObject
 from blazeutils.strings import randchars, randhash
@@ -7,26 +9,63 @@ from blinker import Namespace
 import six
 from werkzeug.exceptions import HTTPException, InternalServerError
 from werkzeug.routing import Map
+from werkzeug.wrappers import BaseResponse
 
+from blazeweb.asgi import AwaitingResponse
 from blazeweb.globals import ag, rg, settings, user
-from blazeweb.events import signal, SettingsConnectHelper, clear_old_beaker_sessions
+from blazeweb.events import signal, SettingsConnectHelper
 from blazeweb.exceptions import ProgrammingError
 from blazeweb.hierarchy import findobj, HierarchyImportError, \
-    listcomponents, visitmods, findview
+    listcomponents, visitmods, findview, HierarchyCache
 from blazeweb.logs import create_handlers_from_settings
-from blazeweb.mail import mail_programmers
+from blazeweb.sessions import sweeper_from_settings, value_digest
+from blazeweb.mail import ExceptionMailer, start_spool_retry
 from blazeweb.templating import default_engine
+from blazeweb.timing import NULL_TIMER, RequestTimer, TimingStats
 from blazeweb.users import UserProxy
-from blazeweb.utils import exception_with_context, abort, _Redirect, registry_has_object
+from blazeweb.utils import ExceptionContext, abort, _Redirect, registry_has_object
 from blazeweb.utils.filesystem import mkdirs, copy_static_files
-from blazeweb.views import _RouteToTemplate, _Forward
+from blazeweb.views import _AwaitAction, _RouteToTemplate, _Forward
 from blazeweb.wrappers import Request
 
 log = logging.getLogger(__name__)
 
 
+class RequestGlobals(object):
+    """
+        The object behind the rg global during a request.  Any attribute can be
+        set on it.  ident and request (a wrappers.Request for the environ) are
+        only created if they are used, so requests that never look at them
+        don't pay for them.
+    """
+    def __init__(self, environ):
+        self.environ = environ
+        self.session = environ.get('beaker.session')
+        # a timing.RequestTimer if settings.timing is enabled
+        self.timer = environ.get('blazeweb.timer', NULL_TIMER)
+        # if set, it will be called with an unhandled exception if necessary
+        self.exception_handler = None
+        # a users.User created for a request without a session, see
+        # ResponseContext.save_session()
+        self.unsaved_user = None
+
+    def __getattr__(self, name):
+        # only called when the attribute has not been set yet
+        if name == 'ident':
+            self.ident = randchars()
+            return self.ident
+        if name == 'request':
+            self.request = Request(self.environ, bind_to_context=False)
+            return self.request
+        raise AttributeError(name)
+
+
 class RequestManager(object):
     user_proxy_class = UserProxy
+    rg_class = RequestGlobals
+    # True while the request waits on an AsyncView's coroutine, the request
+    # is set up once and torn down once
+    suspended = False
 
     def __init__(self, app, environ):
         self.app = app
@@ -34,23 +73,17 @@ class RequestManager(object):
 
     def init_registry(self):
         environ = self.environ
-        environ['paste.registry'].register(rg, BlankObject())
+        environ['paste.registry'].register(rg, self.rg_class(environ))
         self.init_rg()
         user_instance = self.init_user()
         environ['paste.registry'].register(user, user_instance)
 
     def init_rg(self):
-        rg.ident = randchars()
-        rg.environ = self.environ
-        # the request object binds itself to rg.request
-        Request(self.environ)
-        if 'beaker.session' in self.environ:
-            rg.session = self.environ['beaker.session']
-            log.debug('using beaker sessions')
-        else:
-            rg.session = None
-        # if set, it will be called with an unhandled exception if necessary
-        rg.exception_handler = None
+        """
+            rg already has environ, session, timer, exception_handler, and
+            unsaved_user set and will create ident and request when they are
+            first accessed.  Override to add request globals of your own.
+        """
 
     def init_routing(self):
         rg.urladapter = ag.route_map.bind_to_environ(self.environ)
@@ -59,8 +92,14 @@ class RequestManager(object):
         return self.user_proxy_class()
 
     def __enter__(self):
-        self.init_registry()
-        self.init_routing()
+        if self.suspended:
+            self.suspended = False
+            return
+        timer = self.environ.get('blazeweb.timer', NULL_TIMER)
+        with timer.phase('registry'):
+            self.init_registry()
+        with timer.phase('url_match'):
+            self.init_routing()
         # allow middleware higher in the stack to help initilize the request
         # after the registry variables have been setup
         if 'blazeweb.request_setup' in self.environ:
@@ -68,6 +107,9 @@ class RequestManager(object):
                 callable()
 
     def __exit__(self, exc_type, exc_value, tb):
+        if isinstance(exc_value, _AwaitAction):
+            self.suspended = True
+            return
         # make the user class available to the testing framework if applicable
         # http://pythonpaste.org/webtest/#framework-hooks
         if 'paste.testing' in self.environ:
@@ -89,6 +131,9 @@ class RequestManager(object):
 
 
 class ResponseContext(object):
+    # see RequestManager.suspended
+    suspended = False
+
     def __init__(self, error_doc_code):
         self.environ = rg.environ
         # this gets set if this response context is initilized b/c
@@ -98,6 +143,9 @@ class ResponseContext(object):
         self.error_doc_code = error_doc_code
 
     def __enter__(self):
+        if self.suspended:
+            self.suspended = False
+            return
         log.debug('enter response context')
         rg.respctx = self
         # allow middleware higher in the stack to help initilize the response
@@ -106,6 +154,9 @@ class ResponseContext(object):
                 callable()
 
     def __exit__(self, exc_type, e, tb):
+        if isinstance(e, _AwaitAction):
+            self.suspended = True
+            return
         log.debug('exit response context started')
         if 'blazeweb.response_cycle_teardown' in self.environ:
             for callable in self.environ['blazeweb.response_cycle_teardown']:
@@ -118,15 +169,79 @@ class ResponseContext(object):
                     'forward loop detected: %s' % '->'.join([g[0] for g in rg.forward_queue])
                 )
             return True
-        if 'beaker.session' in self.environ:
-            bs = self.environ['beaker.session']
-            if bs.accessed():
-                log.debug('saving beaker session, id: %s', bs.id)
-                bs.save()
-            else:
-                log.debug('beaker session not accessed, not saving')
+        self.save_session()
         log.debug('exit response context finished')
 
+    def save_session(self):
+        if 'beaker.session' not in self.environ:
+            return
+        bs = self.environ['beaker.session']
+        # the user of a request without a session is only worth starting a
+        # session for if something was stored on it
+        if rg.unsaved_user is not None and not rg.unsaved_user.is_empty():
+            log.debug('adding user to new beaker session')
+            bs['__blazeweb_user'] = rg.unsaved_user
+            rg.unsaved_user = None
+        if not bs.accessed():
+            log.debug('beaker session not accessed, not saving')
+            return
+        if bs.dirty() or self.session_changed(bs):
+            log.debug('saving beaker session, id: %s', bs.id)
+            # the user is pickled by save(), so it has to be marked saved
+            # first or the stored copy would always count as modified
+            user_inst = bs.get('__blazeweb_user')
+            user_modified = hasattr(user_inst, 'mark_saved') and user_inst.is_modified()
+            if user_modified:
+                user_inst.mark_saved()
+            try:
+                with rg.timer.phase('session_save'):
+                    bs.save()
+            except Exception:
+                if user_modified:
+                    user_inst._changed()
+                raise
+        elif self.session_touch_due(bs):
+            # beaker will save the session's original data with a new
+            # accessed time
+            log.debug('beaker session not changed, updating accessed time')
+        else:
+            log.debug('beaker session not changed, not saving')
+            bs.save_atime = False
+
+    def session_changed(self, bs):
+        """
+            True if a value was set, removed, or changed in place in the
+            session, or the user in the session was modified.  Values changed
+            in place are found by the digests of sessions.DigestSession; with
+            another session class, every accessed session counts as changed.
+        """
+        original = bs.accessed_dict
+        items = [(key, value) for key, value in bs.items()
+                 if key not in ('_accessed_time', '_creation_time')]
+        for key, value in items:
+            if key not in original or original[key] is not value:
+                return True
+        if any(key not in bs for key in original):
+            return True
+        user_inst = bs.get('__blazeweb_user')
+        if user_inst is not None and \
+                (not hasattr(user_inst, 'is_modified') or user_inst.is_modified()):
+            return True
+        digests = getattr(bs, 'loaded_digests', None)
+        if digests is None:
+            return True
+        return any(value_digest(value) != digests.get(key) for key, value in items)
+
+    def session_touch_due(self, bs):
+        """
+            An unchanged session's accessed time is saved at most once every
+            settings.beaker.touch_interval seconds
+        """
+        interval = settings.beaker.get('touch_interval', 0)
+        last_accessed = getattr(bs, 'last_accessed', None)
+        return not interval or last_accessed is None or \
+            time.time() - last_accessed >= interval
+
 
 class WSGIApp(object):
 
@@ -140,6 +255,7 @@ class WSGIApp(object):
         self.init_component_settings()
         self.init_auto_actions()
         self.init_logging()
+        self.init_timing()
         self.init_routing()
         self.init_templating()
 
@@ -166,8 +282,8 @@ class WSGIApp(object):
         self.ag = BlankObject()
         self.ag.app = self
         self.ag.view_functions = {}
-        self.ag.hierarchy_import_cache = {}
-        self.ag.hierarchy_file_cache = {}
+        self.ag.hierarchy_import_cache = HierarchyCache()
+        self.ag.hierarchy_file_cache = HierarchyCache()
         self.ag.events_namespace = Namespace()
         ag._push_object(self.ag)
 
@@ -236,13 +352,30 @@ class WSGIApp(object):
         if self.settings.auto_abort_as_builtin is True:
             six.moves.builtins.dabort = abort
 
-        signal('blazeweb.auto_actions.initialized').connect(clear_old_beaker_sessions)
+        # expired sessions are removed by a background thread started on the
+        # first request
+        self.ag.session_sweeper = None
+        if self.settings.beaker.enabled and self.settings.beaker.auto_clear_sessions:
+            self.ag.session_sweeper = sweeper_from_settings(self.settings)
+        # exception emails are deduplicated and sent from a background thread
+        self.ag.exception_mailer = ExceptionMailer(self.settings,
+                                                   self.settings.exception_email_window)
+        # mail spooled before a restart is retried without waiting for new mail
+        start_spool_retry()
         signal('blazeweb.auto_actions.initialized').send(self.init_auto_actions)
 
     def init_logging(self):
         create_handlers_from_settings(self.settings)
         signal('blazeweb.logging.initialized').send(self.init_logging)
 
+    def init_timing(self):
+        self.ag.timing_stats = None
+        if self.settings.timing.enabled:
+            dump_dir = self.settings.timing.dir
+            if dump_dir:
+                mkdirs(dump_dir)
+            self.ag.timing_stats = TimingStats(dump_dir, self.settings.timing.dump_interval)
+
     def init_routing(self):
         # setup the Map object with the appropriate settings
         self.ag.route_map = Map(**self.settings.routing.map.todict())
@@ -263,6 +396,46 @@ class WSGIApp(object):
                 if "no attribute 'routes'" not in str(e):
                     raise  # pragma: no cover
 
+        self.init_dispatch_table()
+
+    def init_dispatch_table(self):
+        """
+            Resolve the view class for every routed endpoint once, so that
+            dispatch_to_endpoint() does not have to search the hierarchy on
+            each request.  @asview classes are picked up here too, since the
+            decorator adds a Rule for each function it wraps and findview()
+            returns the class stored in views.CLASS_CACHE.
+
+            Endpoints that can't be resolved now (missing modules, bad imports,
+            etc.) are left out of the table; dispatch_to_endpoint() will look
+            them up lazily and raise the usual errors at request time.  The
+            same lazy path handles endpoints only reached through forward().
+        """
+        self.ag.dispatch_table = {}
+        resolved = set()
+        while True:
+            # importing a views module can fire @asview decorators, which
+            # add more rules to the map, so keep going until nothing is new
+            endpoints = [rule.endpoint for rule in self.ag.route_map.iter_rules()
+                         if rule.endpoint not in resolved]
+            if not endpoints:
+                break
+            for endpoint in endpoints:
+                if endpoint in resolved:
+                    continue
+                resolved.add(endpoint)
+                if '.' in endpoint:
+                    # template endpoint, handled by _RouteToTemplate
+                    continue
+                try:
+                    self.ag.dispatch_table[endpoint] = findview(endpoint)
+                except ImportError as e:
+                    log.debug('dispatch table skipping %s: %s', endpoint, e)
+                except Exception:
+                    # a bug in a views module only breaks its own endpoints
+                    log.warning('dispatch table skipping %s, its view could not be loaded',
+                                endpoint, exc_info=True)
+
     def init_templating(self):
         engine = default_engine()
         self.ag.tplengine = engine()
@@ -277,50 +450,125 @@ class WSGIApp(object):
     def response_context(self, error_doc_code):
         return ResponseContext(error_doc_code)
 
-    def response_cycle(self, endpoint, args, error_doc_code=None):
-        rg.forward_queue = [(endpoint, args)]
+    def response_cycle(self, endpoint, args, error_doc_code=None, resume=None):
+        """
+            resume: continues a response cycle that was suspended by an
+                AsyncView, see resume_request()
+        """
+        if resume is None:
+            rg.forward_queue = [(endpoint, args)]
         while True:
-            with self.response_context(error_doc_code):
-                endpoint, args = rg.forward_queue[-1]
-                signal('blazeweb.response_cycle.started').send(endpoint=endpoint, urlargs=args)
-                response = self.dispatch_to_endpoint(endpoint, args)
+            respctx = rg.respctx if resume is not None else self.response_context(error_doc_code)
+            with respctx:
+                if resume is not None:
+                    # a forward from here starts a new cycle
+                    finish, resume = resume, None
+                    response = finish()
+                else:
+                    endpoint, args = rg.forward_queue[-1]
+                    signal('blazeweb.response_cycle.started').send(endpoint=endpoint,
+                                                                   urlargs=args)
+                    response = self.dispatch_to_endpoint(endpoint, args)
                 signal('blazeweb.response_cycle.ended').send(response=response)
                 return response
 
     def dispatch_to_endpoint(self, endpoint, args):
         log.debug('dispatch to %s (%s)', endpoint, args)
         if '.' not in endpoint:
-            vklass = findview(endpoint)
+            vklass = self.ag.dispatch_table.get(endpoint)
+            if vklass is None:
+                vklass = findview(endpoint)
+                self.ag.dispatch_table[endpoint] = vklass
         else:
             vklass = _RouteToTemplate
-        v = vklass(args, endpoint)
+        session = rg.environ.get('beaker.session')
+        if not vklass.uses_session:
+            # keep the view from loading the session or starting a new one
+            rg.session = None
+        elif rg.session is None and session is not None:
+            # forwarded from a view that doesn't use the session
+            rg.session = session
+            if not isinstance(user._current_obj(), UserProxy):
+                # the user it loaded is not the one kept in the session
+                rg.environ['paste.registry'].register(
+                    user, self.request_manager(rg.environ).init_user())
+        with rg.timer.phase('view_init'):
+            v = vklass(args, endpoint)
         response = v.process()
         return response
 
     def wsgi_app(self, environ, start_response):
         log.debug('request received for URL: %s', environ['PATH_INFO'])
-        with self.request_manager(environ):
-            signal('blazeweb.request.started').send()
-            try:
+        if self.ag.session_sweeper is not None:
+            self.ag.session_sweeper.start()
+        timer = NULL_TIMER
+        if self.ag.timing_stats is not None:
+            timer = environ['blazeweb.timer'] = RequestTimer()
+        return self.process_request(self.request_manager(environ), timer, environ,
+                                    start_response)
+
+    def process_request(self, manager, timer, environ, start_response, resume=None,
+                        awaiting=None):
+        try:
+            with manager:
+                if resume is None:
+                    signal('blazeweb.request.started').send()
                 try:
-                    endpoint, args = rg.urladapter.match()
+                    if resume is not None:
+                        response = self.response_cycle(None, None, resume=resume)
+                    else:
+                        try:
+                            with timer.phase('url_match'):
+                                endpoint, args = rg.urladapter.match()
+                        except HTTPException as e:
+                            log.debug('routing HTTP exception %s from %s', e, rg.request.url)
+                            raise
+                        timer.endpoint = endpoint
+                        log.debug('wsgi_app processing %s (%s)', endpoint, args)
+                        response = self.response_cycle(endpoint, args)
+                except _Redirect as e:
+                    response = e.response
                 except HTTPException as e:
-                    log.debug('routing HTTP exception %s from %s', e, rg.request.url)
-                    raise
-                log.debug('wsgi_app processing %s (%s)', endpoint, args)
-                response = self.response_cycle(endpoint, args)
-            except _Redirect as e:
-                response = e.response
-            except HTTPException as e:
-                if not self.settings.http_exception_handling:
-                    raise
-                response = self.handle_http_exception(e)
-            except Exception as e:
-                response = self.handle_exception(e)
-            # todo: I wonder if this signal send should be called even in the
-            # case of an exception by putting in a finally block
-            signal('blazeweb.request.ended').send(response=response)
-            return response(environ, start_response)
+                    if not self.settings.http_exception_handling:
+                        raise
+                    response = self.handle_http_exception(e)
+                except Exception as e:
+                    response = self.handle_exception(e)
+                # todo: I wonder if this signal send should be called even in the
+                # case of an exception by putting in a finally block
+                signal('blazeweb.request.ended').send(response=response)
+                if timer.enabled:
+                    response = self.finish_timing(timer, response)
+                return response(environ, start_response)
+        except _AwaitAction as e:
+            # served by blazeweb.asgi.ASGIAdapter, which awaits the action's
+            # coroutine on the event loop and then calls resume_request()
+            resume = partial(self.resume_request, manager, timer, environ, start_response,
+                             e.view)
+            if awaiting is not None:
+                # forwarded to another AsyncView
+                awaiting.suspend(e.awaitable, resume)
+                return awaiting
+            return AwaitingResponse(environ, e.awaitable, resume)
+
+    def resume_request(self, manager, timer, environ, start_response, view, awaiting, retval,
+                       error):
+        """
+            Finish a request that was suspended while blazeweb.asgi.ASGIAdapter
+            awaited its AsyncView's coroutine, see process_request().
+        """
+        return self.process_request(manager, timer, environ, start_response,
+                                    partial(view.resume_action, retval, error), awaiting)
+
+    def finish_timing(self, timer, response):
+        timer.finish()
+        self.ag.timing_stats.record(timer)
+        if self.settings.timing.server_timing_header:
+            if isinstance(response, HTTPException):
+                response = response.get_response(rg.environ)
+            if isinstance(response, BaseResponse):
+                response.headers['Server-Timing'] = timer.server_timing()
+        return response
 
     def handle_http_exception(self, e):
         """Handles an HTTP exception.  By default this will invoke the
@@ -352,14 +600,19 @@ class WSGIApp(object):
 
         .. versionadded: 0.3
         """
-        log.error('exception encountered: %s' % exception_with_context())
-        if not self.settings.exception_handling:
+        # the full context is formatted by the exception mailer's thread, once
+        # for each fingerprint in exception_email_window, for the log and the
+        # email
+        context = ExceptionContext()
+        log.error('exception encountered: %s (context logged as %s)', context.summary(),
+                  context.fingerprint())
+        exception_handling = self.settings.exception_handling or ()
+        try:
+            self.ag.exception_mailer.notify(context, email='email' in exception_handling)
+        except Exception:
+            log.exception('exception when trying to report exception')
+        if not exception_handling:
             raise
-        if 'email' in self.settings.exception_handling:
-            try:
-                mail_programmers('exception encountered', exception_with_context())
-            except Exception:
-                log.exception('exception when trying to email exception')
         if 'handle' in self.settings.exception_handling:
             if registry_has_object(rg) and rg.exception_handler:
                 return rg.exception_handler(e)
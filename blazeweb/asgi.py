@@ -0,0 +1,332 @@
+"""
+Serve a blazeweb application from an ASGI server (uvicorn, hypercorn, etc.):
+
+    # <project>/asgi.py
+    from blazeweb.asgi import ASGIAdapter
+    from <project>.application import make_wsgi
+
+    application = ASGIAdapter(make_wsgi())
+
+The request and response machinery is the same as for WSGI.  Each request is
+run on a bounded thread pool and the response is streamed to the client as
+the application produces it, so the event loop is never blocked.
+
+Views based on views.AsyncView (or @asview() on an "async def" function) can
+have coroutine action methods.  Under the adapter, the request is suspended
+while the action's coroutine is awaited on the server's event loop, so a
+request waiting on I/O (e.g. a long poll) doesn't hold a worker thread.  Use
+the "contextvars" registry backend (see globals.set_registry_backend()) if
+the coroutines need ag, rg, settings, or user.
+"""
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextvars
+import logging
+import sys
+from tempfile import SpooledTemporaryFile
+
+from werkzeug.exceptions import ClientDisconnected
+
+from blazeweb.exceptions import ProgrammingError
+from blazeweb.globals import rg
+from blazeweb.utils import registry_has_object
+
+log = logging.getLogger(__name__)
+
+__all__ = [
+    'ASGIAdapter',
+    'AwaitingResponse',
+    'run_coroutine',
+]
+
+_iter_done = object()
+
+
+def _next_chunk(iterator):
+    return next(iterator, _iter_done)
+
+
+class ASGIAdapter(object):
+    """
+        An ASGI (version 3) application that serves a WSGI application,
+        usually a WSGIApp wrapped with middleware.full_wsgi_stack().
+
+        max_workers: size of the thread pool the WSGI application runs on
+        max_body_in_memory: request bodies larger than this are spooled to
+            a temporary file
+    """
+    def __init__(self, wsgiapp, max_workers=None, max_body_in_memory=1024 * 1024):
+        self.wsgiapp = wsgiapp
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='blazeweb-asgi')
+        self.max_body_in_memory = max_body_in_memory
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('ASGIAdapter does not support "%s" connections' % scope['type'])
+        wsgi_input = await self.read_body(receive)
+        if wsgi_input is None:
+            # the client went away before sending the whole request
+            return
+        environ = self.build_environ(scope, wsgi_input)
+        await self.run_wsgi(environ, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        body = SpooledTemporaryFile(self.max_body_in_memory)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            body.write(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        body.seek(0)
+        return body
+
+    def build_environ(self, scope, wsgi_input):
+        script_name = scope.get('root_path', '')
+        path = scope['path']
+        if script_name and path.startswith(script_name):
+            path = path[len(script_name):]
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            # WSGI strings are bytes decoded as latin-1
+            'SCRIPT_NAME': script_name.encode('utf-8').decode('latin-1'),
+            'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': wsgi_input,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'asgi.scope': scope,
+            'blazeweb.asgi.loop': asyncio.get_running_loop(),
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+            environ['REMOTE_PORT'] = str(scope['client'][1])
+        for name, value in scope.get('headers', ()):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            if name in environ:
+                value = environ[name] + ',' + value
+            environ[name] = value
+        return environ
+
+    async def run_wsgi(self, environ, send):
+        loop = asyncio.get_running_loop()
+        # every request gets its own context so the registry backends can't
+        # see objects left over from another request that used the thread
+        context = contextvars.Context()
+
+        def in_thread(func, *args):
+            return loop.run_in_executor(self.executor, context.run, func, *args)
+
+        response_start = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response_start.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response_start['message'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in headers],
+            }
+            return written.append
+
+        async def send_body(chunk, more_body=True):
+            if not response_start.get('sent'):
+                await send(response_start['message'])
+                response_start['sent'] = True
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': more_body})
+
+        async def await_suspended():
+            # a request suspended on a coroutine, see AwaitingResponse
+            awaiting = environ.pop('blazeweb.asgi.awaiting', None)
+            if awaiting is not None:
+                await awaiting.wait()
+
+        try:
+            app_iter = await in_thread(self.wsgiapp, environ, start_response)
+        except Exception:
+            log.exception('unhandled exception from WSGI application')
+            await send({'type': 'http.response.start', 'status': 500,
+                        'headers': [(b'content-type', b'text/plain')]})
+            await send({'type': 'http.response.body', 'body': b'Internal Server Error'})
+            return
+        try:
+            await await_suspended()
+            iterator = iter(app_iter)
+            while True:
+                chunk = await in_thread(_next_chunk, iterator)
+                await await_suspended()
+                if chunk is _iter_done:
+                    break
+                # anything passed to the legacy write() callable goes first
+                while written:
+                    await send_body(written.pop(0))
+                if chunk:
+                    await send_body(chunk)
+            while written:
+                await send_body(written.pop(0))
+            await send_body(b'', more_body=False)
+        finally:
+            if hasattr(app_iter, 'close'):
+                await in_thread(app_iter.close)
+            environ['wsgi.input'].close()
+
+
+class AwaitingResponse(object):
+    """
+        The WSGI response of a request that is suspended until a coroutine is
+        done, see views.AsyncView.  ASGIAdapter awaits the coroutine on the
+        event loop and iterating the response then resumes the request.
+
+        resume: called in a worker thread with this response and the
+            coroutine's return value and exception (one of them None).  It
+            returns the WSGI response, or this response after suspend() was
+            called again.
+    """
+    def __init__(self, environ, awaitable, resume):
+        self.environ = environ
+        # the registry context is cleaned up when the application returns, its
+        # objects are registered again to resume the request
+        self.registry = environ['paste.registry']
+        self.registered = list(self.registry.reglist[-1].values())
+        self.suspend(awaitable, resume)
+        self._iter = self._iter_response()
+
+    def suspend(self, awaitable, resume):
+        self.awaitable = awaitable
+        self.resume = resume
+        self.outcome = None
+        self.resumed = False
+        # the coroutine gets the context of the request, with the registry
+        self.context = contextvars.copy_context()
+        self.environ['blazeweb.asgi.awaiting'] = self
+
+    async def wait(self):
+        task = self.context.run(asyncio.ensure_future, self.awaitable)
+        try:
+            self.outcome = (await task, None)
+        except Exception as e:
+            self.outcome = (None, e)
+
+    def __iter__(self):
+        return self._iter
+
+    def _iter_response(self):
+        while True:
+            if self.outcome is None:
+                # a chance for ASGIAdapter to await the coroutine when the
+                # application is wrapped in a middleware that calls it lazily
+                yield b''
+            app_iter = self._resume()
+            if app_iter is not self:
+                break
+        try:
+            for chunk in app_iter:
+                yield chunk
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def _resume(self, abandoned=False):
+        self.environ.pop('blazeweb.asgi.awaiting', None)
+        self.registry.prepare()
+        self.registry.multiregister(self.registered)
+        try:
+            if self.outcome is None and abandoned:
+                if hasattr(self.awaitable, 'close'):
+                    self.awaitable.close()
+                self.outcome = (None, ClientDisconnected())
+            elif self.outcome is None:
+                # not served by ASGIAdapter after all
+                try:
+                    self.outcome = (run_coroutine(self.awaitable), None)
+                except Exception as e:
+                    self.outcome = (None, e)
+            self.resumed = True
+            return self.resume(self, *self.outcome)
+        finally:
+            self.registry.cleanup()
+
+    def close(self):
+        self._iter.close()
+        # the client went away, finish the request anyway so that its teardown
+        # runs and the session is saved
+        while not self.resumed:
+            app_iter = self._resume(abandoned=True)
+            if app_iter is not self and hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+def asgi_loop():
+    """
+        The event loop of the ASGIAdapter serving the current request, or None
+        if it isn't served by one.
+    """
+    if not registry_has_object(rg):
+        return None
+    loop = rg.environ.get('blazeweb.asgi.loop')
+    if loop is None or not loop.is_running():
+        return None
+    return loop
+
+
+def run_coroutine(coro):
+    """
+        Run a coroutine from view code, which runs in a worker thread, and
+        return its result.  When the request is being served by ASGIAdapter,
+        the coroutine runs on the server's event loop in a copy of the
+        current context.  Otherwise, it runs on a new event loop.
+    """
+    loop = asgi_loop()
+    if loop is None:
+        return asyncio.run(coro)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        coro.close()
+        raise ProgrammingError('run_coroutine() can not be called from the event loop thread')
+
+    future = Future()
+
+    def done(task):
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def start():
+        # the task copies the context it is created in, which is the context
+        # of the calling thread because of call_soon_threadsafe(context=)
+        asyncio.ensure_future(coro).add_done_callback(done)
+    loop.call_soon_threadsafe(start, context=contextvars.copy_context())
+    return future.result()
@@ -0,0 +1,6 @@
+"""
+    Tasks that blazeweb provides to every application, run like the
+    application's own (see blazeweb.tasks.run_tasks()).  The actions of a
+    module here are called along with any an application defines for a task
+    of the same name.
+"""
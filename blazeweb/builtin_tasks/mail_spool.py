@@ -0,0 +1,11 @@
+from __future__ import print_function
+
+from blazeweb.globals import settings
+from blazeweb.mail import send_spooled_mail
+
+
+def action_010_send():
+    """ send the mail waiting in email.spool_dir """
+    sent = send_spooled_mail()
+    print('%d spooled messages sent from %s' % (sent, settings.email.spool_dir))
+    return sent
@@ -0,0 +1,15 @@
+from __future__ import print_function
+
+from blazeweb.globals import settings
+from blazeweb.sessions import sweeper_from_settings
+
+
+def action_010_sweep():
+    """ remove expired dbm and file beaker sessions """
+    sweeper = sweeper_from_settings(settings)
+    if sweeper is None:
+        print('sessions are not file based or have no timeout')
+        return 0
+    removed = sweeper.sweep_all()
+    print('%d of %d session files removed' % (removed, sweeper.checked))
+    return removed
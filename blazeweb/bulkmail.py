@@ -0,0 +1,379 @@
+"""
+Sending a message to many recipients, each with their own copy.
+
+A MessageTemplate is converted once (markdown, html2text, encoding the
+attachments) and then personalized for each recipient with string.Template
+placeholders.  A BulkMailer sends the copies over several SMTP connections at
+once, each connection sending a batch of messages before it is replaced,
+optionally throttled to stay under the SMTP provider's rate limit:
+
+    template = MessageTemplate('News for $name', body, format='markdown')
+    recipients = ((row.email, {'name': row.name}) for row in subscribers)
+    result = BulkMailer(template, connections=4, rate=20,
+                        checkpoint='/path/to/newsletter.done').send(recipients)
+
+A recipient who can't be sent to doesn't stop the send, see BulkResult.  With
+a checkpoint file, a send that is interrupted can be run again and skips the
+messages already sent, as long as the recipients are given in the same order.
+"""
+import logging
+from os import path
+import os
+import re
+import smtplib
+import socket
+from string import Template
+import threading
+import time
+
+from blazeutils.helpers import tolist
+from html2text import html2text
+from markdown2 import markdown
+from webhelpers2.html import escape
+
+from blazeweb.globals import settings
+from blazeweb.mail import EmailMessage, EmailMultiAlternatives, SMTPServer, smtp_pool, \
+    _is_temporary_failure, _quit
+
+# a child of blazeweb.mail, so that it is in email.log too
+log = logging.getLogger('blazeweb.mail.bulk')
+
+__all__ = [
+    'BulkMailer',
+    'BulkResult',
+    'Checkpoint',
+    'MessageTemplate',
+    'Throttle',
+    'send_bulk_mail',
+]
+
+_placeholder = re.compile(r'\$(?:(\w+)|\{(\w+)\})')
+
+
+class MessageTemplate(object):
+    """
+        The subject and body of a message with $name or ${name} placeholders.
+        The body is converted for the format ('text', 'markdown' or 'html')
+        and the attachments are encoded when the template is created; render()
+        only fills in the placeholders.  Values filled into the HTML part are
+        escaped.
+
+        attachments: (filename, content, mimetype) tuples, MIMEBase parts, or
+            file paths
+    """
+
+    def __init__(self, subject, body, from_email=None, format='text', attachments=(),
+                 headers=None):
+        self.subject = Template(subject)
+        self.from_email = from_email
+        self.headers = headers or {}
+        if format == 'markdown':
+            text, html = body, self._convert(markdown, body)
+        elif format == 'html':
+            text, html = self._convert(html2text, body), body
+        else:
+            text, html = body, None
+        self.text = Template(text)
+        self.html = Template(html) if html is not None else None
+        converter = EmailMessage()
+        self.attachments = []
+        for attachment in attachments:
+            if isinstance(attachment, str):
+                filename = path.basename(attachment)
+                with open(attachment, 'rb') as fh:
+                    attachment = (filename, fh.read())
+            if not isinstance(attachment, tuple):
+                self.attachments.append(attachment)
+            else:
+                self.attachments.append(converter._create_attachment(*attachment))
+
+    def _convert(self, convert, body):
+        # markdown would take the _ in ${first_name} for emphasis, so the
+        # placeholders are swapped for plain words while converting
+        names = []
+
+        def protect(match):
+            names.append(match.group(1) or match.group(2))
+            return 'bwplaceholder%dx' % (len(names) - 1)
+        converted = convert(_placeholder.sub(protect, body))
+        return re.sub(r'bwplaceholder(\d+)x', lambda m: '${%s}' % names[int(m.group(1))],
+                      converted)
+
+    def render(self, to, context):
+        """
+            an EmailMessage for the recipient(s) in `to`.  Raises KeyError if
+            context is missing a placeholder's value.
+        """
+        subject = self.subject.substitute(context)
+        body = self.text.substitute(context)
+        if self.html is None:
+            return EmailMessage(subject, body, self.from_email, tolist(to),
+                                attachments=list(self.attachments), headers=self.headers)
+        message = EmailMultiAlternatives(subject, body, self.from_email, tolist(to),
+                                         attachments=list(self.attachments),
+                                         headers=self.headers)
+        escaped = dict((key, str(escape(value))) for key, value in context.items())
+        message.attach_alternative(self.html.substitute(escaped), 'text/html')
+        return message
+
+
+class Throttle(object):
+    """ spaces out the calls to wait(), from all threads, to `rate` per second """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            at = max(now, self._next)
+            self._next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+class Checkpoint(object):
+    """
+        Keeps the indexes of the messages of a bulk send that are done, sent
+        or refused by the server, in a file with one index per line.  It is
+        written every `flush_every` messages and when the send ends.
+    """
+
+    def __init__(self, fpath, flush_every=100):
+        self.fpath = fpath
+        self.flush_every = flush_every
+        self.done = set()
+        if path.exists(fpath):
+            with open(fpath) as fh:
+                for line in fh:
+                    # the last line can be incomplete if the process was killed
+                    if line.endswith('\n'):
+                        self.done.add(int(line))
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def add(self, index):
+        with self._lock:
+            self.done.add(index)
+            self._pending.append(index)
+            if len(self._pending) >= self.flush_every:
+                self._write()
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        if self._pending:
+            with open(self.fpath, 'a') as fh:
+                fh.write(''.join('%d\n' % index for index in self._pending))
+            self._pending = []
+
+    def remove(self):
+        """ the send is complete, the next one starts over """
+        with self._lock:
+            self._pending = []
+            if path.exists(self.fpath):
+                os.remove(self.fpath)
+
+
+class BulkResult(object):
+    """
+        sent: how many messages were sent
+        skipped: how many messages the checkpoint had as done already
+        errors: (index, to, exception) of each message that wasn't sent.  The
+            ones with a temporary failure (see mail.MailQueue) are sent again
+            if the send is resumed from its checkpoint.
+        refused: address => (SMTP code, response) for the recipients the
+            server refused when it accepted the message for the others
+        failures: the exceptions that stopped a sending thread, e.g. when the
+            checkpoint couldn't be written or the recipients iterable raised
+        complete: True when every recipient was gone through and none of the
+            messages is left to send again
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.skipped = 0
+        self.errors = []
+        self.refused = {}
+        self.failures = []
+        self.complete = False
+
+    def __repr__(self):
+        return '<BulkResult sent=%d skipped=%d errors=%d refused=%d failures=%d>' % (
+            self.sent, self.skipped, len(self.errors), len(self.refused), len(self.failures))
+
+
+class BulkMailer(object):
+    """
+        Sends a MessageTemplate to many recipients over several SMTP
+        connections at once.
+
+        connections: how many messages are sent at the same time, each by its
+            own thread and connection
+        rate: the most messages sent per second, for all connections
+        batch_size: messages sent over a connection before it is closed and
+            a new one opened, since SMTP servers often limit them; None for
+            no limit
+        checkpoint: path of a Checkpoint file; it is removed once every
+            message has been sent or refused
+        server: the mail.SMTPServer to send with, from the settings by default
+    """
+
+    def __init__(self, template, connections=4, rate=None, batch_size=100, checkpoint=None,
+                 server=None):
+        self.template = template
+        self.connections = connections
+        self.throttle = Throttle(rate)
+        self.batch_size = batch_size
+        self.checkpoint_path = checkpoint
+        self.server = server
+
+    def send(self, recipients):
+        """
+            recipients: an iterable of (to, context) where to is an address or
+            list of addresses and context the dict the template is filled with.
+            Returns a BulkResult.
+        """
+        result = BulkResult()
+        server = self.server or SMTPServer()
+        is_live = settings.email.is_live
+        app_settings = settings._current_obj()
+        checkpoint = Checkpoint(self.checkpoint_path) if self.checkpoint_path else None
+        exhausted = threading.Event()
+        jobs = self._jobs(recipients, checkpoint, result, exhausted)
+        jobs_lock = threading.Lock()
+        results_lock = threading.Lock()
+        stop = threading.Event()
+        threads = []
+        for num in range(self.connections):
+            thread = threading.Thread(
+                target=self._work, name='blazeweb-bulkmail-%d' % num,
+                args=(app_settings, server, is_live, jobs, jobs_lock, stop, checkpoint, result,
+                      results_lock)
+            )
+            thread.start()
+            threads.append(thread)
+        try:
+            for thread in threads:
+                thread.join()
+        except BaseException:
+            # e.g. KeyboardInterrupt, let the messages being sent finish
+            stop.set()
+            for thread in threads:
+                thread.join()
+            raise
+        finally:
+            if checkpoint is not None:
+                try:
+                    checkpoint.flush()
+                except Exception as e:
+                    log.exception('could not write the checkpoint %s', checkpoint.fpath)
+                    result.failures.append(e)
+        result.complete = exhausted.is_set() and not result.failures and \
+            not any(_is_temporary_failure(exc) for _, _, exc in result.errors)
+        if checkpoint is not None and result.complete:
+            checkpoint.remove()
+        log.info('bulk send of "%s": %r', self.template.subject.template, result)
+        return result
+
+    def _jobs(self, recipients, checkpoint, result, exhausted):
+        for index, (to, context) in enumerate(recipients):
+            if checkpoint is not None and index in checkpoint.done:
+                result.skipped += 1
+                continue
+            yield index, to, context
+        exhausted.set()
+
+    def _work(self, app_settings, server, is_live, jobs, jobs_lock, stop, checkpoint, result,
+              results_lock):
+        # rendering the messages needs the settings
+        settings._push_object(app_settings)
+        connection = None
+        sent_on_connection = 0
+        try:
+            while not stop.is_set():
+                with jobs_lock:
+                    job = next(jobs, None)
+                if job is None:
+                    break
+                index, to, context = job
+                try:
+                    message = self.template.render(to, context)
+                    from_email = message.from_email
+                    recipients = message.recipients()
+                    data = message.message().as_bytes()
+                except Exception as e:
+                    log.error('Email failed: could not render message %d: %s', index, e)
+                    with results_lock:
+                        result.errors.append((index, to, e))
+                    continue
+                self.throttle.wait()
+                refused = {}
+                error = None
+                # reconnect once if the server closed an idle connection
+                for attempt in (1, 2):
+                    try:
+                        if connection is None:
+                            connection = smtp_pool.acquire(server) if is_live else False
+                            sent_on_connection = 0
+                        if is_live:
+                            refused = connection.sendmail(from_email, recipients, data)
+                        error = None
+                        break
+                    except (smtplib.SMTPServerDisconnected, socket.error) as e:
+                        if connection:
+                            smtp_pool.discard(connection)
+                        connection = None
+                        error = e
+                    except Exception as e:
+                        error = e
+                        break
+                with results_lock:
+                    if error is not None:
+                        result.errors.append((index, to, error))
+                    else:
+                        result.sent += 1
+                        result.refused.update(refused)
+                if error is not None:
+                    log.error('Email failed: "%s" to "%s": %s', message.subject,
+                              ';'.join(recipients)[:200], error)
+                    if _is_temporary_failure(error):
+                        continue
+                else:
+                    log.info('Email sent: "%s" to "%s"', message.subject,
+                             ';'.join(recipients)[:200])
+                if checkpoint is not None:
+                    checkpoint.add(index)
+                sent_on_connection += 1
+                if connection and self.batch_size and sent_on_connection >= self.batch_size:
+                    _quit(connection)
+                    connection = None
+        except Exception as e:
+            # the other threads carry on, the send is not complete
+            log.exception('bulk send thread stopped')
+            with results_lock:
+                result.failures.append(e)
+            if connection:
+                smtp_pool.discard(connection)
+            connection = None
+        finally:
+            if connection:
+                smtp_pool.release(server, connection)
+            settings._pop_object(app_settings)
+
+
+def send_bulk_mail(subject, body, recipients, from_email=None, format='text', attachments=(),
+                   **kwargs):
+    """
+        Send a copy of the message to each recipient, personalized with their
+        context; see BulkMailer for the keyword arguments and send() for
+        recipients.  Returns a BulkResult.
+    """
+    template = MessageTemplate(subject, body, from_email, format, attachments)
+    return BulkMailer(template, **kwargs).send(recipients)
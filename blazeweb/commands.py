@@ -13,7 +13,9 @@ from werkzeug.wrappers.base_response import BaseResponse
 from blazeweb.globals import ag, settings
 from blazeweb.hierarchy import list_component_mappings
 from blazeweb.paster_tpl import run_template
+from blazeweb.profiling import merge_profiles, top_frames, write_collapsed
 from blazeweb.tasks import run_tasks
+from blazeweb.timing import TimingStats
 from blazeweb.utils.filesystem import copy_static_files
 
 import paste.script.command as pscmd
@@ -232,9 +234,25 @@ class TasksCommand(pscmd.Command):
         action='store_true',
         default=False,
     )
+    parser.add_option(
+        '-w', '--workers',
+        dest='workers',
+        type='int',
+        default=None,
+        help="call the actions of a task in parallel on this many threads"
+    )
+    parser.add_option(
+        '--processes',
+        dest='executor',
+        action='store_const',
+        const='process',
+        default='thread',
+        help="with --workers, use processes instead of threads"
+    )
 
     def command(self):
-        run_tasks(self.args, test_only=self.options.test_only)
+        run_tasks(self.args, test_only=self.options.test_only, workers=self.options.workers,
+                  executor=self.options.executor)
 
 
 class ShellCommand(pscmd.Command):
@@ -308,12 +326,48 @@ class StaticCopyCommand(pscmd.Command):
         default=False,
         help='Delete "app" and "component" directories in the destination if they exist'
     )
+    parser.add_option(
+        '--no-manifest',
+        dest='manifest',
+        action='store_false',
+        default=None,
+        help='Do not write the hashed file manifest (settings.static_files.manifest)'
+    )
+    parser.add_option(
+        '-z', '--precompress',
+        dest='compress',
+        action='store_true',
+        default=None,
+        help='Write .gz/.br copies of compressible files (settings.static_files.precompress)'
+    )
 
     def command(self):
-        copy_static_files(delete_existing=self.options.delete_existing)
+        copy_static_files(delete_existing=self.options.delete_existing,
+                          manifest=self.options.manifest,
+                          compress=self.options.compress)
         print('\n - files/dirs copied succesfully\n')
 
 
+class JinjaPrecompileCommand(pscmd.Command):
+    # Parser configuration
+    summary = "compile all app and component templates into the jinja bytecode cache"
+    usage = ""
+
+    min_args = 0
+    max_args = 0
+
+    parser = pscmd.Command.standard_parser(verbose=False)
+
+    def command(self):
+        if not settings.jinja.bytecode_cache.enabled:
+            print('\n - jinja bytecode cache is not enabled (settings.jinja.bytecode_cache)\n')
+            return
+        compiled, errors = ag.tplengine.precompile_templates()
+        for endpoint, exc in errors:
+            print('    skipped %s: %s' % (endpoint, exc))
+        print('\n - %d templates compiled to %s\n' % (compiled, settings.jinja.bytecode_cache.dir))
+
+
 class JinjaConvertCommand(pscmd.Command):
     # Parser configuration
     summary = "convert jinja delimiters from old style to new style"
@@ -361,6 +415,90 @@ class ComponentMapCommand(pscmd.Command):
         pprint(list_component_mappings(inc_apps=True))
 
 
+class TimingStatsCommand(pscmd.Command):
+    # Parser configuration
+    summary = "print the request timings collected with settings.timing"
+    usage = "[ENDPOINT]"
+
+    min_args = 0
+    max_args = 1
+
+    parser = pscmd.Command.standard_parser(verbose=False)
+    parser.add_option(
+        '--reset',
+        dest='reset',
+        action='store_true',
+        default=False,
+        help='Delete the collected stats after printing them'
+    )
+
+    def command(self):
+        dump_dir = settings.timing.dir
+        stats = TimingStats.load_dir(dump_dir)
+        if not stats.endpoints:
+            print('\n - no timing stats found in %s\n' % dump_dir)
+            return
+        print(stats.report(self.args[0] if self.args else None))
+        if self.options.reset:
+            for fname in os.listdir(dump_dir):
+                if fname.endswith('.json'):
+                    os.remove(path.join(dump_dir, fname))
+            print(' - timing stats deleted\n')
+
+
+class ProfileReportCommand(pscmd.Command):
+    # Parser configuration
+    summary = "merge the request profiles collected with settings.profiling"
+    usage = "[ENDPOINT_DIR]"
+
+    min_args = 0
+    max_args = 1
+
+    parser = pscmd.Command.standard_parser(verbose=False)
+    parser.add_option(
+        '-n', '--limit',
+        dest='limit',
+        type='int',
+        default=20,
+        help='How many functions to list for each endpoint'
+    )
+    parser.add_option(
+        '-o', '--output-dir',
+        dest='output_dir',
+        default=None,
+        help='Also write the merged profile of each endpoint to this directory'
+    )
+
+    def command(self):
+        profile_dir = settings.profiling.dir
+        merged = merge_profiles(profile_dir)
+        if self.args:
+            merged = [m for m in merged if m[0] == self.args[0]]
+        if not merged:
+            print('\n - no profiles found in %s\n' % profile_dir)
+            return
+        if self.options.output_dir and not path.isdir(self.options.output_dir):
+            os.makedirs(self.options.output_dir)
+        for endpoint, fmt, count, profile in merged:
+            print('%s (%d %s profiles)' % (endpoint, count, fmt))
+            if fmt == 'collapsed':
+                total = sum(profile.values())
+                print('    %7s %7s  %s' % ('self %', 'total %', 'function'))
+                for frame, own, inclusive in top_frames(profile, self.options.limit):
+                    print('    %7.1f %7.1f  %s' % (
+                        own * 100.0 / total, inclusive * 100.0 / total, frame))
+                print('')
+            else:
+                profile.sort_stats('cumulative').print_stats(self.options.limit)
+            if self.options.output_dir:
+                fpath = path.join(self.options.output_dir, '%s.%s' % (endpoint, fmt))
+                if fmt == 'collapsed':
+                    write_collapsed(fpath, profile)
+                else:
+                    profile.dump_stats(fpath)
+                print(' - merged profile written to %s\n' % fpath)
+
+
 def make_shell(init_func=None, banner=None, use_ipython=True):
     """Returns an action callback that spawns a new interactive
     python shell.
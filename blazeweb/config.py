@@ -107,17 +107,43 @@ class DefaultSettings(QuickSettings):
         self.beaker.type = 'dbm'
         self.beaker.data_dir = path.join(self.dirs.tmp, 'session_cache')
         self.beaker.lock_dir = path.join(self.dirs.tmp, 'beaker_locks')
+        # for dbm and file sessions with a timeout, remove expired session files
+        # from a background thread: sweep_batch_size files are checked every
+        # sweep_interval seconds, by one process at a time.  The session-sweep
+        # task removes them all at once.
         self.beaker.auto_clear_sessions = True
+        self.beaker.sweep_batch_size = 500
+        self.beaker.sweep_interval = 10
+        # sessions are saved when they, or the user in them, are changed.  For
+        # requests that only read the session, the accessed time is saved at
+        # most once every touch_interval seconds (0 for every request).  Keep
+        # it well under beaker.timeout, since sessions can expire that much
+        # sooner.
+        self.beaker.touch_interval = 60
 
         #######################################################################
         # TEMPLATES
         #######################################################################
         self.templating.default_engine = 'jinja'
+        # how a template that has already been loaded is checked for changes:
+        #   'always': stat the template file every time the template is used
+        #   'interval': stat the file at most once every check_interval seconds
+        #   'never': templates don't change once loaded; no stat() calls at all,
+        #       which is best for production
+        self.templating.uptodate_checks = 'always'
+        self.templating.check_interval = 5
         self.template.default = 'default.html'
         # a list of template extensions to escape; set to False to disable
         # autoescape
         self.jinja.autoescape = ('html', 'htm', 'xml')
         self.jinja.extensions = ['jinja2.ext.autoescape', 'jinja2.ext.with_']
+        # compiled templates are cached as bytecode on the file system so that
+        # processes don't have to compile every template they use.  Entries are
+        # keyed on the template file found in the hierarchy and checked
+        # against its source.  The jinja-precompile command fills the cache
+        # ahead of time.
+        self.jinja.bytecode_cache.enabled = True
+        self.jinja.bytecode_cache.dir = path.join(self.dirs.tmp, 'jinja_bytecode')
 
         #######################################################################
         # SYSTEM VIEW ENDPOINTS
@@ -129,7 +155,9 @@ class DefaultSettings(QuickSettings):
         #######################################################################
         # EXCEPTION HANDLING
         #######################################################################
-        # an exception will always be logged using python logging
+        # an exception will always be logged using python logging: a line with
+        # its type and message when it happens, and its full context once every
+        # exception_email_window seconds (see below)
         # If bool(exception_handling) == False, only logging will occur
         # If bool(exception_handling) == True, it is expected to be a list
         # options for handling the exception.  Options are:
@@ -155,6 +183,12 @@ class DefaultSettings(QuickSettings):
         # These patterns are matched with fnmatch() against POST keys and HTTP cookie keys.  If
         # the keys match, their values are replaced with '<remove>'.
         self.exception_context_filters = ['*password*', '*secret*', '*session.id*']
+        # exceptions are logged with their context and emailed from a
+        # background thread.  Repeats of an exception (same type, raised from
+        # the same place) within this many seconds are counted instead, and the
+        # count is reported once the time has passed.  0 reports every
+        # exception.
+        self.exception_email_window = 300
 
         #######################################################################
         # DEBUGGING
@@ -210,6 +244,22 @@ class DefaultSettings(QuickSettings):
         # Should we actually send email out to a SMTP server?  Setting this to
         # False can be useful when doing testing.
         self.email.is_live = True
+        # EmailMessage.send_async(), send_mail_async(), and
+        # send_mass_mail_async() queue messages for background threads to
+        # send.  Messages that don't fit in the queue or can't be sent because
+        # the SMTP server is down are spooled to spool_dir and sent again
+        # every spool_retry seconds, also after a restart.  The mail-spool task
+        # sends them right away.
+        self.email.queue_size = 1000
+        self.email.queue_workers = 2
+        self.email.spool_dir = path.join(self.dirs.data, 'mail_spool')
+        self.email.spool_retry = 60
+        # encoded attachments are cached, up to this many bytes, so that the
+        # same file sent to many recipients is only encoded once
+        self.email.attachment_cache_size = 32 * 1024 * 1024
+        # EmailMessage.attach_file() memory-maps files of this size or larger
+        # instead of reading them into memory
+        self.email.attachment_mmap_size = 4 * 1024 * 1024
 
         #######################################################################
         # SMTP SETTINGS
@@ -219,6 +269,11 @@ class DefaultSettings(QuickSettings):
         self.smtp.user = ''
         self.smtp.password = ''
         self.smtp.use_tls = False
+        # connections are kept open and reused for up to this many seconds
+        # after a send, 0 to close them after each send
+        self.smtp.keepalive = 30
+        # the most idle connections kept open to each server
+        self.smtp.pool_size = 4
 
         #######################################################################
         # OTHER DEFAULTS
@@ -281,6 +336,51 @@ class DefaultSettings(QuickSettings):
         self.logs.http_requests.enabled = False
         self.logs.http_requests.filters.path_info = None
         self.logs.http_requests.filters.request_method = None
+        # how much of each request body to keep; bodies are captured as the
+        # application reads them
+        self.logs.http_requests.max_body = 1024 * 1024
+        # how many request logs to keep and for how long (seconds); None
+        # for no limit
+        self.logs.http_requests.max_files = 1000
+        self.logs.http_requests.max_age = None
+        # logs are written on a background thread; requests are not logged
+        # if this many are waiting to be written
+        self.logs.http_requests.queue_size = 100
+
+        #######################################################################
+        # Request timing
+        #######################################################################
+        # record how long each phase of a request takes (see blazeweb.timing),
+        # aggregated per endpoint.  Stats are written to timing.dir every
+        # dump_interval seconds and can be viewed with the timing-stats
+        # command.
+        self.timing.enabled = False
+        self.timing.dir = path.join(self.dirs.logs, 'timing')
+        self.timing.dump_interval = 60
+        # send the timings of each request in a Server-Timing header so they
+        # show up in the browser's developer tools.  Exposes internals, so
+        # intended for development only.
+        self.timing.server_timing_header = False
+
+        #######################################################################
+        # Profiling
+        #######################################################################
+        # profile a random sample of requests with middleware.RequestProfiler
+        # (added by full_wsgi_stack()).  rate is the fraction of requests to
+        # profile.  endpoints is None or a list of fnmatch patterns the
+        # request's endpoint must match.  format is "collapsed" (stack
+        # samples, suitable for flame graphs and cheap enough for production)
+        # or "pstats" (cProfile, exact but slow).  Use the profile-report
+        # command to merge the profiles per endpoint.
+        self.profiling.enabled = False
+        self.profiling.rate = 0.01
+        self.profiling.endpoints = None
+        self.profiling.format = 'collapsed'
+        # seconds between stack samples for the "collapsed" format
+        self.profiling.interval = 0.005
+        self.profiling.dir = path.join(self.dirs.logs, 'profiles')
+        # profiles kept per endpoint, None for no limit
+        self.profiling.max_files = 100
 
         #######################################################################
         # Static Files
@@ -296,6 +396,33 @@ class DefaultSettings(QuickSettings):
         # when static files are changing often and copying to the static
         # directory after each change is a hassle.
         self.static_files.location = 'static'
+        # static-copy will also write a manifest to the static directory
+        # mapping each file to a copy named after a hash of its contents.
+        # When files are served from the static directory, static_url() uses
+        # the hashed names and those files get far-future caching headers
+        # since their URL changes whenever their contents do.
+        self.static_files.manifest.enabled = True
+        self.static_files.manifest.fname = 'manifest.json'
+        self.static_files.manifest.max_age = 60 * 60 * 24 * 365
+        # static-copy can also write precompressed (.gz, .br) copies of
+        # compressible files.  "br" requires the brotli package.  When a
+        # client accepts the encoding, the precompressed copy is served if it
+        # exists.
+        self.static_files.precompress.enabled = False
+        self.static_files.precompress.formats = ['gzip', 'br']
+        self.static_files.precompress.extensions = [
+            '.css', '.js', '.map', '.json', '.html', '.htm', '.txt', '.svg', '.xml',
+        ]
+        self.static_files.precompress.min_size = 1024
+        # threads used to compress files; None lets Python decide
+        self.static_files.precompress.workers = None
+        self.static_files.serve_precompressed = True
+        # when serving from "source", small files can be kept in memory so
+        # they are not read from disk for every request.  Files are still
+        # stat()ed so changes are picked up.
+        self.static_files.memory_cache.enabled = False
+        self.static_files.memory_cache.max_bytes = 16 * 1024 * 1024
+        self.static_files.memory_cache.max_file_bytes = 256 * 1024
 
         #######################################################################
         # Automatic Actions
@@ -362,7 +489,10 @@ class DefaultSettings(QuickSettings):
         self.exception_handling = None
         self.debugger.enabled = True
         self.static_files.location = 'source'
+        self.templating.uptodate_checks = 'always'
         self.auto_abort_as_builtin = True
+        self.timing.enabled = True
+        self.timing.server_timing_header = True
 
         if override_email:
             self.emails.override = override_email
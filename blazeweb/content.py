@@ -8,6 +8,7 @@ from webhelpers2.html import HTML
 from blazeweb.globals import ag, settings
 from blazeweb.hierarchy import findcontent, split_endpoint
 from blazeweb.routing import abs_static_url, static_url
+from blazeweb.timing import current_timer
 
 
 def getcontent(__endpoint, *args, **kwargs):
@@ -146,7 +147,8 @@ class TemplateContent(Content):
 
     def create(self, **kwargs):
         self.update_context(kwargs)
-        content = ag.tplengine.render_template(self.endpoint, kwargs)
+        with current_timer().phase('template'):
+            content = ag.tplengine.render_template(self.endpoint, kwargs)
         # if self.css_placeholder_count:
         #    css_content = self.page_css()
         #    template_content = template_content.replace(
@@ -38,21 +38,12 @@ class SettingsConnectHelper(object):
 
 
 def clear_old_beaker_sessions(sender):
-    # for dbm and file type beaker sessions, files are cached under data_dir
-    #   use the last-accessed time to determine which to prune
-    if settings.beaker.type in ('dbm', 'file') and settings.beaker.auto_clear_sessions:
-        if not hasattr(settings.beaker, 'timeout'):
-            return
-
-        import datetime as dt
-        import os
-        session_path = settings.beaker.data_dir
-        cutoff = dt.datetime.now() - dt.timedelta(seconds=settings.beaker.timeout)
-
-        for root, dirnames, filenames in os.walk(session_path):
-            for filename in filenames:
-                session_file = os.path.join(root, filename)
-                if dt.datetime.fromtimestamp(
-                    os.stat(session_file).st_atime
-                ) < cutoff:
-                    os.remove(session_file)
+    """
+        Remove all expired dbm and file type beaker sessions.  This walks all
+        of settings.beaker.data_dir, the application does it incrementally in
+        the background instead (see blazeweb.sessions).
+    """
+    from blazeweb.sessions import sweeper_from_settings
+    sweeper = sweeper_from_settings(settings)
+    if sweeper is not None:
+        sweeper.sweep_all()
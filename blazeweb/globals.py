@@ -1,10 +1,13 @@
-from blazeweb.registry import StackedObjectProxy
+import os
+
+from blazeweb.registry import StackedObjectProxy, set_proxy_backend
 
 __all__ = [
     'ag',
     'rg',
     'settings',
     'user',
+    'set_registry_backend',
 ]
 
 # a "global" object for storing data and objects (like tcp connections or db
@@ -17,3 +20,18 @@ rg = StackedObjectProxy(name="rg")
 settings = StackedObjectProxy(name="settings")
 # the user object (request only)
 user = StackedObjectProxy(name="user")
+
+
+def set_registry_backend(backend):
+    """
+        Choose how the ag, rg, settings, and user globals keep track of the
+        current object: "paste" (thread-locals, the default) or "contextvars"
+        (contextvars.ContextVar, for asyncio or greenlet based servers).  Call
+        before any application is created; the BLAZEWEB_REGISTRY_BACKEND
+        environment variable does the same thing when blazeweb is imported.
+    """
+    for proxy in (ag, rg, settings, user):
+        set_proxy_backend(proxy, backend)
+
+if os.environ.get('BLAZEWEB_REGISTRY_BACKEND'):
+    set_registry_backend(os.environ['BLAZEWEB_REGISTRY_BACKEND'])
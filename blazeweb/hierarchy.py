@@ -1,3 +1,4 @@
+import collections
 import logging
 from os import path as ospath
 import sys
@@ -127,6 +128,94 @@ def list_component_mappings(target_component=None, reverse=False, inc_apps=False
     return retval
 
 
+def component_map_key():
+    """
+        a hashable snapshot of the apps and component mappings currently in
+        effect; used to tell when cached lookup misses have gone stale
+    """
+    return tuple(list_component_mappings(inc_apps=True))
+
+
+class HierarchyCache(dict):
+    """
+        Holds the results of hierarchy lookups for an application.  Keys that
+        were found map to their location like a normal dict.  Keys that were
+        searched for and not found are remembered in a bounded, least recently
+        used set so that repeated misses do not walk the hierarchy (imports or
+        stat() calls) again.  The remembered misses are dropped if the
+        settings object in effect changes; call clear() if the component map
+        of the same settings is changed.
+
+        hits, negative_hits, and misses count how lookups were answered.
+    """
+
+    def __init__(self, max_missing=1000):
+        dict.__init__(self)
+        self.max_missing = max_missing
+        self.missing = collections.OrderedDict()
+        self.missing_mapkey = None
+        # (settings object, its component_map_key())
+        self._mapkey = (None, None)
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """
+            returns (found, value).  found is True if the cache can answer
+            the lookup, in which case value is the cached location or None if
+            the key is known to be missing.
+        """
+        value = self.get(key)
+        if value:
+            self.hits += 1
+            return True, value
+        if key in self.missing:
+            if self.missing_mapkey == self.component_map_key():
+                self.missing.move_to_end(key)
+                self.negative_hits += 1
+                return True, None
+            self.missing.clear()
+        self.misses += 1
+        return False, None
+
+    def component_map_key(self):
+        """
+            component_map_key() of the settings in effect, only computed once
+            for each settings object
+        """
+        current = settings._current_obj()
+        mapkey_settings, mapkey = self._mapkey
+        if mapkey_settings is not current:
+            mapkey = component_map_key()
+            self._mapkey = (current, mapkey)
+        return mapkey
+
+    def add_missing(self, key):
+        mapkey = self.component_map_key()
+        if mapkey != self.missing_mapkey:
+            self.missing.clear()
+            self.missing_mapkey = mapkey
+        self.missing[key] = True
+        self.missing.move_to_end(key)
+        while len(self.missing) > self.max_missing:
+            self.missing.popitem(last=False)
+
+    def clear(self):
+        dict.clear(self)
+        self.missing.clear()
+        self._mapkey = (None, None)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'size': len(self),
+            'missing_size': len(self.missing),
+        }
+
+
 def findcontent(endpoint):
     try:
         return findendpoint(endpoint, 'content')
@@ -303,10 +392,15 @@ class FileFinderBase(object):
         self.assign_cachekey()
 
     def cached_path(self):
-        fullpath = ag.hierarchy_file_cache.get(self.cachekey)
+        """
+            returns (found, fullpath); see HierarchyCache.lookup()
+        """
+        found, fullpath = ag.hierarchy_file_cache.lookup(self.cachekey)
         if fullpath:
             log.debug('found %s in cache: %s', self.cachekey, fullpath)
-            return fullpath
+        elif found:
+            log.debug('%s in cache as not found', self.cachekey)
+        return found, fullpath
 
     @classmethod
     def findfile(cls, endpoint_path):
@@ -320,14 +414,15 @@ class FileFinderBase(object):
         return ospath.dirname(package_mod.__file__)
 
     def search(self):
-        fullpath = self.cached_path()
-        if fullpath:
+        found, fullpath = self.cached_path()
+        if found:
             return fullpath
 
         fullpath = self.search_apps()
         if fullpath:
             ag.hierarchy_file_cache[self.cachekey] = fullpath
             return fullpath
+        ag.hierarchy_file_cache.add_missing(self.cachekey)
 
 
 class AppFileFinder(FileFinderBase):
@@ -376,11 +471,17 @@ class FinderBase(object):
         return self.location
 
     def cached_module(self):
-        module_location = ag.hierarchy_import_cache.get(self.cachekey)
+        """
+            returns (found, module); see HierarchyCache.lookup()
+        """
+        found, module_location = ag.hierarchy_import_cache.lookup(self.cachekey)
         if module_location:
             module = hm.builtin_import(module_location, globals(), locals(), [''])
             log.debug('found %s in cache: %s', self.cachekey, module)
-            return module
+            return True, module
+        if found:
+            log.debug('%s in cache as not found', self.cachekey)
+        return found, None
 
     def search(self):
         if not self.attr:
@@ -401,6 +502,7 @@ class FinderBase(object):
         # finding the module or finding the attribute
         orig_attr = self.attr
         self.attr = None
+        self.assign_cachekey()
         module = self._search()
         if not module:
             raise HierarchyImportError(
@@ -411,9 +513,12 @@ class FinderBase(object):
         )
 
     def _search(self):
-        module = self.cached_module()
+        found, module = self.cached_module()
+        if found:
+            return module
+        module = self.search_apps()
         if not module:
-            module = self.search_apps()
+            ag.hierarchy_import_cache.add_missing(self.cachekey)
         return module
 
     def try_import(self, dlocation):
@@ -445,7 +550,9 @@ class AppFinder(FinderBase):
     type = 'appstack'
 
     def assign_cachekey(self):
-        self.cachekey = 'appstack.%s:%s' % (self.location, self.attr)
+        # module only lookups (attr is None) must not share a key with an
+        # attribute that happens to be named "None"
+        self.cachekey = 'appstack.%s:%s' % (self.location, self.attr or '')
 
     def search_apps(self):
         for app in listapps():
@@ -467,7 +574,7 @@ class ComponentFinder(FinderBase):
         return '%s%s' % (self.component, ('.%s' % self.location) if self.location else '')
 
     def assign_cachekey(self):
-        self.cachekey = 'compstack.%s:%s' % (self.exclocation, self.attr)
+        self.cachekey = 'compstack.%s:%s' % (self.exclocation, self.attr or '')
 
     def search_apps(self):
         for app, pname, package in list_component_mappings(self.component):
@@ -1,26 +1,39 @@
+import atexit
+import base64
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+import hashlib
 import logging
 import mimetypes
+import mmap
 import os
+from os import path
+import pickle
 import smtplib
 import socket
+import threading
 import time
 import random
 import re
-from email import encoders, charset
+from email import charset
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email.header import Header
 from email.utils import formatdate, parseaddr, formataddr
 
+from beaker.synchronization import file_synchronizer
 from html2text import html2text
 from markdown2 import markdown
+from blazeutils import randchars
 from blazeutils.helpers import tolist
 import six
 
 from blazeweb.globals import settings
 from blazeweb.exceptions import SettingsError
 from blazeweb.utils.encoding import smart_str, force_unicode
+from blazeweb.utils.filesystem import mkdirs
 
 log = logging.getLogger(__name__)
 
@@ -116,18 +129,140 @@ class SafeMIMEMultipart(MIMEMultipart):
         MIMEMultipart.__setitem__(self, name, val)
 
 
-class SMTPConnection(object):
+class SMTPServer(object):
     """
-    A wrapper that manages the SMTP network connection.
+        The SMTP server and login to send through.  The settings are read when
+        it is created, so that it can be used by threads that don't have the
+        application's settings, like the mail queue's.
     """
 
-    def __init__(self, host=None, port=None, username=None, password=None,
-                 use_tls=None, fail_silently=False):
+    def __init__(self, host=None, port=None, username=None, password=None, use_tls=None):
         self.host = host or settings.smtp.host
         self.port = port or settings.smtp.port
         self.username = username or settings.smtp.user
         self.password = password or settings.smtp.password
         self.use_tls = (use_tls is not None) and use_tls or settings.smtp.use_tls
+        self.keepalive = settings.smtp.keepalive
+        self.pool_size = settings.smtp.pool_size
+        # connections are only pooled with others opened the same way
+        self.key = (self.host, self.port, self.username, self.password, bool(self.use_tls))
+        # saved with spooled messages, the password stays out of the spool
+        self.spool_key = (self.host, self.port, self.username, bool(self.use_tls))
+
+    def connect(self):
+        # If local_hostname is not specified, socket.getfqdn() gets used.
+        # For performance, we use the cached FQDN for local_hostname.
+        connection = smtplib.SMTP(self.host, self.port, local_hostname=DNS_NAME.get_fqdn())
+        try:
+            if self.use_tls:
+                connection.ehlo()
+                connection.starttls()
+                connection.ehlo()
+            if self.username and self.password:
+                connection.login(self.username, self.password)
+        except:  # noqa
+            connection.close()
+            raise
+        return connection
+
+
+def _quit(connection):
+    try:
+        connection.quit()
+    except (smtplib.SMTPException, socket.error):
+        connection.close()
+
+
+class SMTPPool(object):
+    """
+        Keeps SMTP connections open after a send so that the next send doesn't
+        have to connect, STARTTLS, and log in again.  A connection is used by
+        one thread at a time, kept for the keepalive seconds of the SMTPServer
+        it was opened for, and checked with a NOOP before it is reused.
+    """
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def acquire(self, server):
+        """ an open smtplib.SMTP connection to the server """
+        while True:
+            connection = self._pop_idle(server)
+            if connection is None:
+                return server.connect()
+            try:
+                if connection.noop()[0] == 250:
+                    return connection
+            except (smtplib.SMTPException, socket.error):
+                # timed out by the server
+                pass
+            _quit(connection)
+
+    def _pop_idle(self, server):
+        expired = []
+        now = time.time()
+        with self._lock:
+            if self._pid != os.getpid():
+                # the connections of the process we were forked from
+                self._idle = {}
+                self._pid = os.getpid()
+            idle = self._idle.get(server.key, [])
+            connection = None
+            while idle:
+                conn, expires = idle.pop()
+                if expires > now:
+                    connection = conn
+                    break
+                expired.append(conn)
+        for conn in expired:
+            _quit(conn)
+        return connection
+
+    def release(self, server, connection):
+        """ keep the connection for reuse, or close it if the pool is full """
+        if server.keepalive > 0:
+            with self._lock:
+                idle = self._idle.setdefault(server.key, [])
+                if self._pid == os.getpid() and len(idle) < server.pool_size:
+                    idle.append((connection, time.time() + server.keepalive))
+                    return
+        _quit(connection)
+
+    def discard(self, connection):
+        """ close a connection that is no longer usable """
+        try:
+            connection.close()
+        except socket.error:
+            pass
+
+    def clear(self):
+        """ close all the idle connections """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, expires in connections:
+                _quit(connection)
+
+# all SMTPConnections and the mail queue share this pool
+smtp_pool = SMTPPool()
+
+
+class SMTPConnection(object):
+    """
+    A wrapper that manages the SMTP network connection.  The network
+    connection comes from, and goes back to, smtp_pool.
+    """
+
+    def __init__(self, host=None, port=None, username=None, password=None,
+                 use_tls=None, fail_silently=False):
+        self.server = SMTPServer(host, port, username, password, use_tls)
+        self.host = self.server.host
+        self.port = self.server.port
+        self.username = self.server.username
+        self.password = self.server.password
+        self.use_tls = self.server.use_tls
         self.fail_silently = fail_silently
         self.connection = None
 
@@ -140,34 +275,21 @@ class SMTPConnection(object):
             # Nothing to do if the connection is already open.
             return False
         try:
-            # If local_hostname is not specified, socket.getfqdn() gets used.
-            # For performance, we use the cached FQDN for local_hostname.
-            self.connection = smtplib.SMTP(self.host, self.port,
-                                           local_hostname=DNS_NAME.get_fqdn())
-            if self.use_tls:
-                self.connection.ehlo()
-                self.connection.starttls()
-                self.connection.ehlo()
-            if self.username and self.password:
-                self.connection.login(self.username, self.password)
+            self.connection = smtp_pool.acquire(self.server)
             return True
         except:  # noqa
             if not self.fail_silently:
                 raise
 
     def close(self):
-        """Closes the connection to the email server."""
+        """
+        Gives the connection back to the pool, which closes it if it isn't
+        kept for reuse.
+        """
+        if self.connection is None:
+            return
         try:
-            try:
-                self.connection.quit()
-            except socket.sslerror:
-                # This happens when calling quit() on a TLS connection
-                # sometimes.
-                self.connection.close()
-            except:  # noqa
-                if self.fail_silently:
-                    return
-                raise
+            smtp_pool.release(self.server, self.connection)
         finally:
             self.connection = None
 
@@ -217,6 +339,419 @@ class SMTPConnection(object):
         return True
 
 
+class MappedFile(object):
+    """ a file attachment that is memory-mapped instead of read, see attach_file() """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+
+    @contextmanager
+    def mapped(self):
+        with open(self.fpath, 'rb') as fh:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield data
+            finally:
+                data.close()
+
+    def __repr__(self):
+        return '<MappedFile %s>' % self.fpath
+
+
+class AttachmentCache(object):
+    """
+        Encoded attachments, keyed by a hash of their content, file name, and
+        mimetype, so that a file sent to many recipients is encoded once.  The
+        least recently used attachments are dropped to keep the size of the
+        encoded payloads under a limit.  The cached parts are attached to many
+        messages, don't change them.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._parts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                part, size = self._parts.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # most recently used last
+            self._parts[key] = (part, size)
+            self.hits += 1
+            return part
+
+    def put(self, key, part, max_size):
+        size = len(part.get_payload())
+        if size > max_size:
+            return
+        with self._lock:
+            if key in self._parts:
+                return
+            self._parts[key] = (part, size)
+            self.size += size
+            while self.size > max_size:
+                _, (_, dropped) = self._parts.popitem(last=False)
+                self.size -= dropped
+
+    def clear(self):
+        with self._lock:
+            self._parts.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+# shared by all messages, see EmailMessage._create_attachment()
+attachment_cache = AttachmentCache()
+
+
+def _is_temporary_failure(exc):
+    """
+        True if sending again later could work: the server could not be
+        reached or answered with a 4xx code.
+    """
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, msg in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPResponseException):
+        # SMTPConnectError can have a code of -1
+        return not 500 <= exc.smtp_code < 600
+    return isinstance(exc, (smtplib.SMTPServerDisconnected, socket.error))
+
+
+def _sendmail(server, from_email, recipients, data):
+    connection = smtp_pool.acquire(server)
+    try:
+        connection.sendmail(from_email, recipients, data)
+    except (smtplib.SMTPServerDisconnected, socket.error):
+        smtp_pool.discard(connection)
+        raise
+    except:  # noqa
+        smtp_pool.release(server, connection)
+        raise
+    smtp_pool.release(server, connection)
+
+
+class OutboundMessage(object):
+    """ an EmailMessage rendered for the mail queue """
+    __slots__ = ('server', 'from_email', 'recipients', 'data', 'subject')
+
+    def __init__(self, server, from_email, recipients, data, subject):
+        self.server = server
+        self.from_email = from_email
+        self.recipients = recipients
+        self.data = data
+        self.subject = subject
+
+
+class MailQueue(object):
+    """
+        Sends messages from a bounded queue on background threads, see
+        EmailMessage.send_async().  A message is spooled to disk, to be sent
+        later, when the queue is full or when the SMTP server can't be reached
+        or answers with a temporary error.  The workers try the spooled
+        messages again every retry_interval seconds.
+
+        The future of a queued message has a result of True once the message
+        is sent or False if it was spooled.  It has the exception if the
+        server refused the message.
+
+        A spooled message records the host, port, user, and TLS setting of its
+        SMTPServer.  It is sent again through the server registered for them
+        (see register()) and left in the spool until one is.
+    """
+    spool_lock_name = 'blazeweb_mail_spool'
+
+    def __init__(self, size=1000, workers=2, retry_interval=60):
+        self.size = size
+        self.workers = workers
+        self.retry_interval = retry_interval
+        self.queue = six.moves.queue.Queue(size)
+        self.spool_dirs = set()
+        # SMTPServer.spool_key => SMTPServer
+        self.servers = {}
+        self.sent = 0
+        self.spooled = 0
+        self.failed = 0
+        self._next_retry = 0
+        self._pid = None
+        self._threads = []
+        self._thread_lock = threading.Lock()
+
+    def put(self, message, spool_dir):
+        """ queue an OutboundMessage, returns a concurrent.futures.Future """
+        self.start()
+        self.register(spool_dir, message.server)
+        future = Future()
+        try:
+            self.queue.put_nowait((message, spool_dir, future))
+        except six.moves.queue.Full:
+            log.warning('mail queue is full, spooling "%s"', message.subject)
+            self.spool(message, spool_dir)
+            future.set_result(False)
+        return future
+
+    def register(self, spool_dir, server=None):
+        """
+            Retry the messages spooled in spool_dir, and send those spooled for
+            server's host, port, user, and TLS setting through it
+        """
+        self.spool_dirs.add(spool_dir)
+        if server is not None:
+            self.servers[server.spool_key] = server
+
+    def start(self):
+        """ start the workers if they are not running in this process """
+        if self._pid == os.getpid():
+            return
+        with self._thread_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # forked, the parent process sends what it queued
+                self.queue = six.moves.queue.Queue(self.size)
+            self._pid = os.getpid()
+            self._next_retry = time.time() + self.retry_interval
+            self._threads = []
+            for num in range(self.workers):
+                thread = threading.Thread(target=self.run, name='blazeweb-mail-%d' % num)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=10):
+        """
+            Spool the messages that are still queued and stop the workers.  A
+            worker that is sending gets `timeout` seconds to finish.
+        """
+        if self._pid != os.getpid():
+            return
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except six.moves.queue.Empty:
+                break
+            if item is not None:
+                message, spool_dir, future = item
+                self.spool(message, spool_dir)
+                future.set_result(False)
+            self.queue.task_done()
+        for thread in self._threads:
+            try:
+                self.queue.put_nowait(None)
+            except six.moves.queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(timeout)
+        self._pid = None
+
+    def flush(self):
+        """ blocks until all queued messages have been sent or spooled """
+        self.queue.join()
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.retry_interval)
+            except six.moves.queue.Empty:
+                item = ()
+            if item is None:
+                self.queue.task_done()
+                return
+            if item:
+                message, spool_dir, future = item
+                try:
+                    future.set_result(self.deliver(message, spool_dir))
+                except Exception as e:
+                    future.set_exception(e)
+                finally:
+                    self.queue.task_done()
+            if self._retry_due():
+                self.retry_spooled()
+
+    def _retry_due(self):
+        with self._thread_lock:
+            if time.time() < self._next_retry:
+                return False
+            self._next_retry = time.time() + self.retry_interval
+            return True
+
+    def deliver(self, message, spool_dir):
+        """
+            Send the message, or spool it if the failure is temporary.  Returns
+            True if it was sent.
+        """
+        try:
+            _sendmail(message.server, message.from_email, message.recipients, message.data)
+        except Exception as e:
+            if not _is_temporary_failure(e):
+                self.failed += 1
+                log.error('Email failed: "%s": %s', message.subject, e)
+                raise
+            log.warning('Email spooled: "%s": %s', message.subject, e)
+            self.spool(message, spool_dir)
+            return False
+        self.sent += 1
+        log.info('Email sent: "%s" to "%s"', message.subject,
+                 ';'.join(message.recipients)[:200])
+        return True
+
+    def spool(self, message, spool_dir):
+        # the workers don't have the settings for the default mode
+        mkdirs(spool_dir, 0o750)
+        # names sort oldest first
+        fpath = path.join(spool_dir, '%.6f-%s' % (time.time(), randchars()))
+        with open(fpath + '.tmp', 'wb') as fh:
+            pickle.dump((message.server.spool_key, message.from_email, message.recipients,
+                         message.data, message.subject), fh, 2)
+        # the workers don't see the message until it is complete
+        os.rename(fpath + '.tmp', fpath + '.msg')
+        self.spooled += 1
+
+    def retry_spooled(self):
+        """ try to send the spooled messages, returns how many were sent """
+        sent = 0
+        for spool_dir in list(self.spool_dirs):
+            try:
+                sent += self.send_spool(spool_dir)
+            except Exception:
+                log.exception('could not send the mail spooled in %s', spool_dir)
+        return sent
+
+    def send_spool(self, spool_dir):
+        """
+            Send the messages spooled in spool_dir.  After a temporary failure,
+            the rest of the messages for that server are left for the next
+            try.  A message the server refuses is renamed to <name>.failed.
+            Returns how many were sent, which is 0 when another process or
+            thread is sending them.
+        """
+        if not path.isdir(spool_dir):
+            return 0
+        lock = file_synchronizer(self.spool_lock_name, lock_dir=spool_dir)
+        if not lock.acquire_write_lock(wait=False):
+            return 0
+        sent = 0
+        unavailable = set()
+        unknown = 0
+        try:
+            for fname in sorted(os.listdir(spool_dir)):
+                if not fname.endswith('.msg'):
+                    continue
+                fpath = path.join(spool_dir, fname)
+                with open(fpath, 'rb') as fh:
+                    server_key, from_email, recipients, data, subject = pickle.load(fh)
+                if server_key in unavailable:
+                    continue
+                server = self.servers.get(server_key)
+                if server is None:
+                    unknown += 1
+                    continue
+                try:
+                    _sendmail(server, from_email, recipients, data)
+                except Exception as e:
+                    if _is_temporary_failure(e):
+                        unavailable.add(server_key)
+                        continue
+                    log.error('Email failed: "%s": %s', subject, e)
+                    os.rename(fpath, fpath[:-len('.msg')] + '.failed')
+                    continue
+                os.remove(fpath)
+                sent += 1
+                self.sent += 1
+                log.info('Email sent: "%s" to "%s"', subject, ';'.join(recipients)[:200])
+        finally:
+            lock.release_write_lock()
+        if unknown:
+            log.warning('%d messages in %s are spooled for an SMTP server that is not '
+                        'registered with the mail queue', unknown, spool_dir)
+        return sent
+
+_mail_queue = None
+_mail_queue_lock = threading.Lock()
+
+
+def get_mail_queue():
+    """
+        the process-wide MailQueue, created from the settings when first used.
+        It retries the messages in email.spool_dir that were spooled for the
+        SMTP server of the settings.
+    """
+    global _mail_queue
+    if _mail_queue is None:
+        with _mail_queue_lock:
+            if _mail_queue is None:
+                queue = MailQueue(settings.email.queue_size, settings.email.queue_workers,
+                                  settings.email.spool_retry)
+                queue.register(settings.email.spool_dir, SMTPServer())
+                atexit.register(queue.stop)
+                _mail_queue = queue
+    return _mail_queue
+
+
+def _has_spooled_mail(spool_dir):
+    try:
+        return any(fname.endswith('.msg') for fname in os.listdir(spool_dir))
+    except OSError:
+        return False
+
+
+def start_spool_retry():
+    """
+        Start the mail queue if messages are waiting in email.spool_dir, e.g.
+        from before a restart, so that they are retried without waiting for
+        the next message to be queued.  Called when the application starts.
+    """
+    if not settings.email.is_live or not _has_spooled_mail(settings.email.spool_dir):
+        return
+    queue = get_mail_queue()
+    queue.register(settings.email.spool_dir, SMTPServer())
+    queue.start()
+
+
+def send_spooled_mail():
+    """
+        Send the messages in email.spool_dir now, instead of waiting for the
+        mail queue to retry them.  Returns how many were sent.  See the
+        mail-spool task.
+    """
+    queue = get_mail_queue()
+    queue.register(settings.email.spool_dir, SMTPServer())
+    return queue.send_spool(settings.email.spool_dir)
+
+
+def _completed_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def _gather(futures):
+    """ a future of the number of futures with a true result """
+    gathered = Future()
+    pending = [len(futures)]
+    lock = threading.Lock()
+
+    def done(future):
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        try:
+            gathered.set_result(sum(1 for f in futures if f.result()))
+        except Exception as e:
+            gathered.set_exception(e)
+    if not futures:
+        gathered.set_result(0)
+    for future in futures:
+        future.add_done_callback(done)
+    return gathered
+
+
 class EmailMessage(object):
     """
     A container for email information.
@@ -320,6 +855,18 @@ class EmailMessage(object):
         """Sends the email message."""
         return self.get_connection(fail_silently).send_messages([self])
 
+    def send_async(self):
+        """
+        Renders the email message and queues it to be sent by the mail queue's
+        threads (see MailQueue).  Returns a concurrent.futures.Future.
+        """
+        if not settings.email.is_live or not self.recipients():
+            return _completed_future(bool(self.send()))
+        connection = self.get_connection()
+        message = OutboundMessage(connection.server, self.from_email, self.recipients(),
+                                  self.message().as_bytes(), self.subject)
+        return get_mail_queue().put(message, settings.email.spool_dir)
+
     def attach(self, filename=None, content=None, mimetype=None):
         """
         Attaches a file with the given filename and content. The filename can
@@ -338,9 +885,19 @@ class EmailMessage(object):
             self.attachments.append([filename, content, mimetype])
 
     def attach_file(self, path, mimetype=None):
-        """Attaches a file from the filesystem."""
+        """
+        Attaches a file from the filesystem.  Files of
+        email.attachment_mmap_size bytes or more are not read into memory,
+        they are memory-mapped when the message is built.
+        """
         filename = os.path.basename(path)
-        content = open(path, 'rb').read()
+        size = os.path.getsize(path)
+        # empty files can't be mapped
+        if size and size >= settings.email.attachment_mmap_size:
+            content = MappedFile(path)
+        else:
+            with open(path, 'rb') as fh:
+                content = fh.read()
         self.attach(filename, content, mimetype)
 
     def _perform_override(self):
@@ -364,6 +921,8 @@ class EmailMessage(object):
 
             # take care of any text/html alternative types
             for attachment in self.attachments:
+                if isinstance(attachment, MIMEBase):
+                    continue
                 filename, content, mimetype = attachment
                 if not filename and content and mimetype == 'text/html':
                     attachment[1] = self._insert_after_html_body(markdown(body_prepend), content)
@@ -389,22 +948,50 @@ class EmailMessage(object):
     def _create_attachment(self, filename, content, mimetype=None):
         """
         Converts the filename, content, mimetype triple into a MIME attachment
-        object.
+        object.  A file is only encoded the first time it is attached to a
+        message; after that, the part is taken from attachment_cache.
         """
         if mimetype is None:
             mimetype, _ = mimetypes.guess_type(filename)
             if mimetype is None:
                 mimetype = DEFAULT_ATTACHMENT_MIME_TYPE
+        if not filename:
+            # alternatives, which are usually different for each message
+            return self._encode_attachment(filename, content, mimetype)
+        if isinstance(content, MappedFile):
+            with content.mapped() as data:
+                return self._cached_attachment(filename, data, mimetype)
+        return self._cached_attachment(filename, content, mimetype)
+
+    def _cached_attachment(self, filename, content, mimetype):
+        if isinstance(content, six.text_type):
+            digest = hashlib.sha1(content.encode(settings.default.charset)).hexdigest()
+        else:
+            digest = hashlib.sha1(content).hexdigest()
+        key = (digest, filename, mimetype)
+        attachment = attachment_cache.get(key)
+        if attachment is None:
+            attachment = self._encode_attachment(filename, content, mimetype)
+            attachment_cache.put(key, attachment, settings.email.attachment_cache_size)
+        return attachment
+
+    def _encode_attachment(self, filename, content, mimetype):
         basetype, subtype = mimetype.split('/', 1)
         if basetype == 'text':
+            if not isinstance(content, (six.text_type, bytes)):
+                # mmap
+                content = content[:]
+            if isinstance(content, bytes):
+                content = content.decode(settings.default.charset)
             attachment = SafeMIMEText(
                 smart_str(content, settings.default.charset), subtype, settings.default.charset
             )
         else:
-            # Encode non-text attachments with base64.
+            # Encode non-text attachments with base64.  Same as
+            # encoders.encode_base64(), but works with a mmap too.
             attachment = MIMEBase(basetype, subtype)
-            attachment.set_payload(content)
-            encoders.encode_base64(attachment)
+            attachment.set_payload(base64.encodebytes(content).decode('ascii'))
+            attachment['Content-Transfer-Encoding'] = 'base64'
         if filename:
             attachment.add_header('Content-Disposition', 'attachment',
                                   filename=filename)
@@ -516,6 +1103,31 @@ def send_mass_mail(datatuple, format='text', fail_silently=False, auth_user=None
     return connection.send_messages(messages)
 
 
+def send_mail_async(subject, message, recipient_list, from_email=None, format='text',
+                    auth_user=None, auth_password=None):
+    """
+    Like send_mail(), but the message is sent by the mail queue.  Returns a
+    concurrent.futures.Future, see MailQueue.
+    """
+    connection = SMTPConnection(username=auth_user, password=auth_password)
+    email_class = get_email_class(format)
+    return email_class(subject, message, from_email, recipient_list,
+                       connection=connection).send_async()
+
+
+def send_mass_mail_async(datatuple, format='text', auth_user=None, auth_password=None):
+    """
+    Like send_mass_mail(), but the messages are sent by the mail queue.
+    Returns a concurrent.futures.Future of the number of messages sent, not
+    counting the ones that were spooled.
+    """
+    connection = SMTPConnection(username=auth_user, password=auth_password)
+    email_class = get_email_class(format)
+    return _gather([email_class(subject, message, sender, recipient,
+                                connection=connection).send_async()
+                    for subject, message, sender, recipient in datatuple])
+
+
 def _mail_admins(subject, message, format='text'):
     """used for testing"""
     email_class = get_email_class(format)
@@ -550,3 +1162,139 @@ def _mail_programmers(subject, message, format='text'):
 def mail_programmers(subject, message, format='text', fail_silently=False):
     """Sends a message to the programmers, as defined by the emails.programmers setting."""
     return _mail_programmers(subject, message, format).send(fail_silently=fail_silently)
+
+
+class ExceptionMailer(object):
+    """
+        Logs the full context of exceptions and emails it to the programmers
+        from a background thread, see WSGIApp.handle_exception().  An exception
+        is logged and emailed at most once every `window` seconds for each
+        fingerprint (see utils.ExceptionContext): the first one right away, the
+        ones after it are counted and the count is reported, with the context
+        of the last one, once the window has passed.
+
+        app_settings: the settings the thread sends the emails with
+        max_fingerprints: how many fingerprints are tracked.  When that many
+            have not been emailed within their window, new ones are dropped.
+    """
+    # seconds between the background thread's checks for counts to email
+    check_interval = 10
+
+    def __init__(self, app_settings, window=300, max_fingerprints=1000, queue_size=100):
+        self.settings = app_settings
+        self.window = window
+        self.max_fingerprints = max_fingerprints
+        self.queue = six.moves.queue.Queue(queue_size)
+        # fingerprint => [time reported, occurrences since, last context, email]
+        self.seen = {}
+        self.emailed = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+
+    def notify(self, context, email=True):
+        """
+            record an exception, returns True if it is going to be reported
+            now.  With email=False, the context is only logged.
+        """
+        fingerprint = context.fingerprint()
+        now = time.time()
+        with self._lock:
+            entry = self.seen.get(fingerprint)
+            if entry is not None and now - entry[0] < self.window:
+                entry[1] += 1
+                entry[2] = context
+                entry[3] = email
+                return False
+            count = 1 + (entry[1] if entry is not None else 0)
+            if entry is None and len(self.seen) >= self.max_fingerprints:
+                self._prune(now)
+                if len(self.seen) >= self.max_fingerprints:
+                    self.dropped += 1
+                    log.warning('too many different exceptions, not reporting %s', fingerprint)
+                    return False
+            self.seen[fingerprint] = [now, 0, None, email]
+        self.start()
+        return self._put(fingerprint, count, context, email)
+
+    def _put(self, fingerprint, count, context, email):
+        try:
+            self.queue.put_nowait((fingerprint, count, context, email))
+            return True
+        except six.moves.queue.Full:
+            self.dropped += 1
+            log.warning('exception queue is full, not reporting %s', fingerprint)
+            return False
+
+    def _prune(self, now):
+        # forget the fingerprints whose window has passed, queueing their counts
+        for fingerprint, (reported, count, context, email) in list(self.seen.items()):
+            if now - reported >= self.window:
+                del self.seen[fingerprint]
+                if count:
+                    self._put(fingerprint, count, context, email)
+
+    def due(self):
+        """ queue the counts whose window has passed """
+        now = time.time()
+        with self._lock:
+            for fingerprint, entry in self.seen.items():
+                reported, count, context, email = entry
+                if count and now - reported >= self.window:
+                    entry[:] = [now, 0, None, email]
+                    self._put(fingerprint, count, context, email)
+
+    def start(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.run, name='blazeweb-exception-mailer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None and self._pid == os.getpid():
+            self.queue.put(None)
+            self._thread.join()
+        self._pid = None
+        self._thread = None
+
+    def flush(self):
+        """ blocks until the queued emails have been sent """
+        self.queue.join()
+
+    def run(self):
+        settings._push_object(self.settings)
+        while True:
+            self.due()
+            try:
+                item = self.queue.get(timeout=self.check_interval)
+            except six.moves.queue.Empty:
+                continue
+            try:
+                if item is None:
+                    return
+                self.send(*item)
+            finally:
+                self.queue.task_done()
+
+    def send(self, fingerprint, count, context, email=True):
+        subject = 'exception encountered'
+        if count > 1:
+            subject += ' (%d times)' % count
+        body = '\n== OCCURRENCES ==\n\n%d of %s' % (count, fingerprint)
+        if count > 1:
+            body += ' since the last report, the context is from the last one'
+        body += '\n'
+        log.error('%s %s: %s', subject, fingerprint, body + str(context))
+        if not email:
+            return
+        try:
+            mail_programmers(subject, body + str(context))
+            self.emailed += 1
+        except Exception:
+            log.exception('exception when trying to email exception')
@@ -1,30 +1,51 @@
+import collections
+import cProfile
+from datetime import datetime
 import logging
+import os
 from os import path
-from io import StringIO
-from tempfile import TemporaryFile
+from io import BytesIO
+import random
+import re
+import threading
 import time
 
 from beaker.middleware import SessionMiddleware
 from blazeutils import randchars, pformat, tolist
 from paste.registry import RegistryManager
+import six
 from werkzeug.datastructures import EnvironHeaders
+from werkzeug.exceptions import HTTPException
 from werkzeug.debug import DebuggedApplication
+from werkzeug.http import http_date, parse_accept_header
 from werkzeug.middleware.shared_data import SharedDataMiddleware
-from werkzeug.wsgi import LimitedStream
+from werkzeug.wsgi import ClosingIterator, LimitedStream
 
 from blazeweb import routing
 from blazeweb.hierarchy import findfile, FileNotFound
 from blazeweb.globals import settings, ag
-from blazeweb.utils.filesystem import mkdirs
+from blazeweb.profiling import StackSampler, endpoint_matches, profile_dir_for, \
+    write_collapsed, FORMATS
+from blazeweb.sessions import session_class_for
+from blazeweb.utils.filesystem import mkdirs, static_manifest
 
 log = logging.getLogger(__name__)
 
+# Python 3.12+ allows only one cProfile.Profile to be enabled at a time
+_cprofile_lock = threading.Lock()
+
 
 class HttpRequestLogger(object):
     """
         Logs the full HTTP request to text files for debugging purposes
 
-        Note: should only be used low-request applications and/or with filters.
+        The request body is captured as the application reads it, up to
+        max_body bytes, so large uploads are never held in memory.  Files are
+        written to <dirs.logs>/http_requests by a background thread after the
+        response is finished.  max_files and max_age (seconds) limit how many
+        request logs are kept.
+
+        Note: use filters to limit what gets logged on busy applications.
 
         Example (<project>/applications.py):
 
@@ -43,57 +64,414 @@ class HttpRequestLogger(object):
 
     """
     def __init__(self, application, enabled=False, path_info_filter=None,
-                 request_method_filter=None):
-        self.log_dir = path.join(settings.dirs.logs, 'http_requests')
+                 request_method_filter=None, max_body=1024 * 1024, max_files=None,
+                 max_age=None, queue_size=100, log_dir=None):
+        self.log_dir = log_dir or path.join(settings.dirs.logs, 'http_requests')
         mkdirs(self.log_dir)
         self.application = application
         self.enabled = enabled
         self.pi_filter = path_info_filter
         self.rm_filter = request_method_filter
+        self.max_body = max_body
+        self.writer = RequestLogWriter(self.log_dir, max_files, max_age, queue_size)
+
+    def should_log(self, environ):
+        if self.pi_filter is not None and self.pi_filter not in environ['PATH_INFO']:
+            return False
+        if self.rm_filter is not None and environ['REQUEST_METHOD'].lower() not in [
+            x.lower() for x in tolist(self.rm_filter)
+        ]:
+            return False
+        return True
 
     def __call__(self, environ, start_response):
-        if self.enabled:
-            self.headers = EnvironHeaders(environ)
-            should_log = True
-            if self.pi_filter is not None and self.pi_filter not in environ['PATH_INFO']:
-                should_log = False
-            if self.rm_filter is not None and environ['REQUEST_METHOD'].lower() not in [
-                x.lower() for x in tolist(self.rm_filter)
-            ]:
-                should_log = False
-            if should_log:
-                wsgi_input = self.replace_wsgi_input(environ)
-                fname = '%s_%s' % (time.time(), randchars())
-                fh = open(path.join(self.log_dir, fname), 'wb+')
-                try:
-                    fh.write(pformat(environ))
-                    fh.write('\n')
-                    fh.write(wsgi_input.read())
-                    wsgi_input.seek(0)
-                finally:
-                    fh.close()
-        return self.application(environ, start_response)
+        if not self.enabled or not self.should_log(environ):
+            return self.application(environ, start_response)
+        # format the environ before the application has a chance to add to it
+        head = pformat(environ)
+        tee_input = self.replace_wsgi_input(environ)
+
+        def write_log():
+            self.writer.submit(head, tee_input)
+        try:
+            app_iter = self.application(environ, start_response)
+        except Exception:
+            write_log()
+            raise
+        return ClosingIterator(app_iter, write_log)
 
     def replace_wsgi_input(self, environ):
-        content_length = self.headers.get('content-length', type=int)
-        limited_stream = LimitedStream(environ['wsgi.input'], content_length)
-        if content_length is not None and content_length > 1024 * 500:
-            wsgi_input = TemporaryFile('wb+')
-        else:
-            wsgi_input = StringIO()
-        wsgi_input.write(limited_stream.read())
-        wsgi_input.seek(0)
-        environ['wsgi.input'] = wsgi_input
+        content_length = EnvironHeaders(environ).get('content-length', type=int)
+        limited_stream = LimitedStream(environ['wsgi.input'], content_length or 0)
+        environ['wsgi.input'] = TeeInput(limited_stream, self.max_body)
         return environ['wsgi.input']
 
 
-class StaticFileServer(SharedDataMiddleware):
+class TeeInput(object):
+    """
+        Wraps wsgi.input and keeps a copy of the first `limit` bytes that are
+        read from it.  bytes_read counts everything that was read.
+    """
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.captured = bytearray()
+        self.bytes_read = 0
+
+    def _capture(self, data):
+        self.bytes_read += len(data)
+        room = self.limit - len(self.captured)
+        if room > 0:
+            self.captured += data[:room]
+        return data
+
+    def read(self, size=None):
+        return self._capture(self.stream.read(size))
+
+    def readline(self, size=None):
+        return self._capture(self.stream.readline(size))
+
+    def readlines(self, hint=None):
+        return [self._capture(line) for line in self.stream.readlines(hint)]
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+class RequestLogWriter(object):
+    """
+        Writes HttpRequestLogger files on a background thread.  If the queue is
+        full, the request is not logged rather than slowing down the response.
+        After each write, the oldest logs are removed to stay within max_files
+        and logs older than max_age seconds are removed.
+    """
+    # <timestamp>_<random chars>, see write()
+    fname_pattern = re.compile(r'(\d+(?:\.\d+)?)_\w+$')
+
+    def __init__(self, log_dir, max_files=None, max_age=None, queue_size=100):
+        self.log_dir = log_dir
+        self.max_files = max_files
+        self.max_age = max_age
+        self.queue = six.moves.queue.Queue(queue_size)
+        self.dropped = 0
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
+    def submit(self, head, tee_input):
+        self.start()
+        try:
+            self.queue.put_nowait((time.time(), head, tee_input))
+        except six.moves.queue.Full:
+            self.dropped += 1
+            log.warning('http request log queue is full, request not logged')
+
+    def start(self):
+        with self.thread_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run,
+                                               name='blazeweb-http-request-logger')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            try:
+                self.write(*record)
+                self.prune()
+            except Exception:
+                log.exception('could not write http request log')
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """ blocks until all submitted requests have been written """
+        self.queue.join()
+
+    def write(self, timestamp, head, tee_input):
+        fname = '%s_%s' % (timestamp, randchars())
+        with open(path.join(self.log_dir, fname), 'wb') as fh:
+            fh.write(head.encode('utf-8'))
+            fh.write(b'\n')
+            fh.write(bytes(tee_input.captured))
+            if tee_input.bytes_read > len(tee_input.captured):
+                fh.write(b'\n[body truncated: %d of %d bytes logged]\n'
+                         % (len(tee_input.captured), tee_input.bytes_read))
+
+    def prune(self):
+        if not self.max_files and not self.max_age:
+            return
+        # file names start with the timestamp, so they sort oldest first.  Files
+        # the writer didn't create are left alone.
+        logs = []
+        for fname in os.listdir(self.log_dir):
+            match = self.fname_pattern.match(fname)
+            if match:
+                logs.append((float(match.group(1)), fname))
+        logs.sort()
+        remove = []
+        if self.max_files and len(logs) > self.max_files:
+            remove = logs[:len(logs) - self.max_files]
+            logs = logs[len(remove):]
+        if self.max_age:
+            cutoff = time.time() - self.max_age
+            remove.extend(entry for entry in logs if entry[0] < cutoff)
+        for _, fname in remove:
+            try:
+                os.remove(path.join(self.log_dir, fname))
+            except OSError:
+                pass
+
+
+class RequestProfiler(object):
+    """
+        Profiles a random sample of requests and writes each profile to
+        <profile_dir>/<endpoint>/<timestamp>-<random>.<format>.  See
+        blazeweb.profiling for the formats.  Only the call to the application
+        is profiled, not the iteration of the response.
+
+        rate: the fraction of requests to profile, 0.0 to 1.0
+        endpoints: a list of fnmatch patterns; when given, only requests
+            routed to a matching endpoint are profiled
+        interval: seconds between stack samples ("collapsed" format)
+        max_files: how many profiles to keep for each endpoint; None for no
+            limit
+
+        Use the profile-report command to merge the profiles.
+    """
+    def __init__(self, application, profile_dir, rate=0.01, endpoints=None,
+                 format='collapsed', interval=0.005, max_files=100):
+        if format not in FORMATS:
+            raise ValueError('unknown profile format: %s' % format)
+        self.application = application
+        self.profile_dir = profile_dir
+        self.rate = rate
+        self.endpoints = tolist(endpoints) if endpoints is not None else None
+        self.format = format
+        self.interval = interval
+        self.max_files = max_files
+        # the route map is needed before the registry is setup for the request
+        self.route_map = ag.route_map
+
+    def endpoint_for(self, environ):
+        try:
+            endpoint, _ = self.route_map.bind_to_environ(environ).match()
+        except HTTPException:
+            # not found, redirects, etc.  These are profiled under the
+            # routing error so they can be excluded with an endpoint filter
+            return 'routing-error'
+        return endpoint
+
+    def __call__(self, environ, start_response):
+        if random.random() >= self.rate:
+            return self.application(environ, start_response)
+        endpoint = self.endpoint_for(environ)
+        if not endpoint_matches(endpoint, self.endpoints):
+            return self.application(environ, start_response)
+        return self.profile_request(endpoint, environ, start_response)
+
+    def profile_request(self, endpoint, environ, start_response):
+        if self.format == 'pstats':
+            return self.profile_pstats(endpoint, environ, start_response)
+        # frames above this one belong to the server and other middleware
+        sampler = StackSampler(interval=self.interval,
+                               stop_code=RequestProfiler.profile_request.__code__)
+        sampler.start()
+        try:
+            return self.application(environ, start_response)
+        finally:
+            sampler.stop()
+            if sampler.samples:
+                self.save(endpoint, lambda fpath: write_collapsed(fpath, sampler.stacks))
+
+    def profile_pstats(self, endpoint, environ, start_response):
+        # a request that comes in while another one is profiled isn't profiled
+        if not _cprofile_lock.acquire(False):
+            return self.application(environ, start_response)
+        try:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # another tool (a debugger, coverage) is using the profiler
+                return self.application(environ, start_response)
+            try:
+                return self.application(environ, start_response)
+            finally:
+                profiler.disable()
+                self.save(endpoint, profiler.dump_stats)
+        finally:
+            _cprofile_lock.release()
+
+    def save(self, endpoint, write):
+        dpath = profile_dir_for(self.profile_dir, endpoint)
+        fname = '%s-%s%s' % (datetime.now().strftime('%Y%m%d-%H%M%S-%f'), randchars(6),
+                             FORMATS[self.format])
+        try:
+            mkdirs(dpath)
+            write(path.join(dpath, fname))
+            if self.max_files is not None:
+                self.prune(dpath)
+        except EnvironmentError:
+            log.exception('could not write profile for %s', endpoint)
+
+    def prune(self, dpath):
+        # file names start with a timestamp, so the oldest sort first
+        fnames = sorted(os.listdir(dpath))
+        for fname in fnames[:max(len(fnames) - self.max_files, 0)]:
+            os.remove(path.join(dpath, fname))
+
+
+class PrecompressedMixin(object):
+    """
+        For SharedDataMiddleware subclasses: when the client accepts it, serve
+        a precompressed sibling of the requested file (style.css.br,
+        style.css.gz) with the matching Content-Encoding.  Responses for files
+        that have a sibling get "Vary: Accept-Encoding" so caches keep the
+        variants apart.  static-copy writes the siblings, see
+        utils.filesystem.compress_static_files().
+    """
+    # in order of preference
+    precompressed = (('br', '.br'), ('gzip', '.gz'))
+
+    def __init__(self, *args, **kwargs):
+        self.serve_precompressed = kwargs.pop('precompressed', True)
+        # the file opener does not get the environ, so the negotiation for
+        # the current request is kept here
+        self._precompressed_local = threading.local()
+        super(PrecompressedMixin, self).__init__(*args, **kwargs)
+
+    def _opener(self, filename):
+        local = self._precompressed_local
+        if not self.serve_precompressed or not hasattr(local, 'accept'):
+            return super(PrecompressedMixin, self)._opener(filename)
+        for encoding, suffix in self.precompressed:
+            if not path.isfile(filename + suffix):
+                continue
+            local.vary = True
+            if local.accept[encoding]:
+                local.encoding = encoding
+                return super(PrecompressedMixin, self)._opener(filename + suffix)
+        return super(PrecompressedMixin, self)._opener(filename)
+
+    def __call__(self, environ, start_response):
+        if not self.serve_precompressed:
+            return super(PrecompressedMixin, self).__call__(environ, start_response)
+        local = self._precompressed_local
+        local.accept = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+        local.encoding = None
+        local.vary = False
+
+        def encoding_start_response(status, headers, exc_info=None):
+            if local.encoding:
+                headers.append(('Content-Encoding', local.encoding))
+            if local.vary:
+                headers.append(('Vary', 'Accept-Encoding'))
+            return start_response(status, headers, exc_info)
+        try:
+            return super(PrecompressedMixin, self).__call__(environ, encoding_start_response)
+        finally:
+            del local.accept
+
+
+class StaticFileCache(object):
+    """
+        A bounded, least recently used, in-memory cache of small static files.
+        Entries are keyed by file path and hold the file's bytes, mtime, and
+        size.  Each lookup stat()s the file and reloads it if it has changed,
+        so edits are still picked up, but the file is not opened and read
+        again while it is unchanged.
+
+        max_bytes: upper limit for the total size of the cached files
+        max_file_bytes: files larger than this are not cached
+    """
+    def __init__(self, max_bytes, max_file_bytes):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, fpath):
+        """
+            returns (data, mtime, size) for fpath, reading the file if it is not
+            cached or has changed.  Returns None if the file is too large to
+            be cached.
+        """
+        stat = os.stat(fpath)
+        with self.lock:
+            entry = self.entries.get(fpath)
+            if entry is not None and entry[1] == stat.st_mtime and entry[2] == stat.st_size:
+                self.entries.move_to_end(fpath)
+                self.hits += 1
+                return entry[0], datetime.utcfromtimestamp(entry[1]), entry[2]
+            self.misses += 1
+        if stat.st_size > self.max_file_bytes:
+            return None
+        with open(fpath, 'rb') as fh:
+            data = fh.read()
+        with self.lock:
+            self._discard(fpath)
+            self.entries[fpath] = (data, stat.st_mtime, len(data))
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self._discard(next(iter(self.entries)))
+        return data, datetime.utcfromtimestamp(stat.st_mtime), len(data)
+
+    def _discard(self, fpath):
+        entry = self.entries.pop(fpath, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class MemoryCacheMixin(object):
+    """
+        For SharedDataMiddleware subclasses: serve files through a
+        StaticFileCache given as the "memory_cache" keyword argument.
+        Conditional requests are answered from the cached mtime and size
+        without touching the file's contents.
+    """
+    def __init__(self, *args, **kwargs):
+        self.memory_cache = kwargs.pop('memory_cache', None)
+        super(MemoryCacheMixin, self).__init__(*args, **kwargs)
+
+    def _opener(self, filename):
+        if self.memory_cache is None:
+            return super(MemoryCacheMixin, self)._opener(filename)
+
+        def opener():
+            cached = self.memory_cache.get(filename)
+            if cached is None:
+                return super(MemoryCacheMixin, self)._opener(filename)()
+            data, mtime, size = cached
+            return BytesIO(data), mtime, size
+        return opener
+
+
+class StaticDirectoryServer(PrecompressedMixin, SharedDataMiddleware):
+    """
+        Serves files from the static directory (e.g. after static-copy)
+    """
+
+
+class StaticFileServer(PrecompressedMixin, MemoryCacheMixin, SharedDataMiddleware):
     """
         Serves static files based on hierarchy structure
     """
     def __init__(self, app, **kwargs):
         exports = {'/' + routing.static_url('/'): ''}
-        SharedDataMiddleware.__init__(self, app, exports, **kwargs)
+        super(StaticFileServer, self).__init__(app, exports, **kwargs)
 
     def debug(self, pathpart, msg):
         log.debug('StaticFileServer 404 (%s): %s', pathpart, msg)
@@ -133,6 +511,32 @@ class StaticFileServer(SharedDataMiddleware):
         return loader
 
 
+class HashedStaticFiles(StaticDirectoryServer):
+    """
+        Serves the static directory like SharedDataMiddleware, but the
+        content-hashed files listed in the static manifest are sent with
+        far-future, immutable caching headers.  Their URLs change whenever
+        their contents do, so browsers never need to revalidate them.
+    """
+    def __init__(self, app, exports, hashed_paths, max_age, **kwargs):
+        super(HashedStaticFiles, self).__init__(app, exports, **kwargs)
+        prefix = '/' + routing.static_url('/')
+        self.immutable_paths = set(prefix + hpath for hpath in hashed_paths)
+        self.max_age = max_age
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO', '') not in self.immutable_paths:
+            return super(HashedStaticFiles, self).__call__(environ, start_response)
+
+        def immutable_start_response(status, headers, exc_info=None):
+            headers = [(name, value) for name, value in headers
+                       if name.lower() not in ('cache-control', 'expires')]
+            headers.append(('Cache-Control', 'public, max-age=%d, immutable' % self.max_age))
+            headers.append(('Expires', http_date(time.time() + self.max_age)))
+            return start_response(status, headers, exc_info)
+        return super(HashedStaticFiles, self).__call__(environ, immutable_start_response)
+
+
 def static_files(app):
     settings = ag.app.settings
 
@@ -141,9 +545,20 @@ def static_files(app):
         # from the source packages; use static-copy command for that)
         if settings.static_files.location == 'static':
             exported_dirs = {'/' + routing.static_url('/'): settings.dirs.static}
-            return SharedDataMiddleware(app, exported_dirs)
+            precompressed = settings.static_files.serve_precompressed
+            manifest = static_manifest()
+            if manifest:
+                return HashedStaticFiles(app, exported_dirs, manifest.values(),
+                                         settings.static_files.manifest.max_age,
+                                         precompressed=precompressed)
+            return StaticDirectoryServer(app, exported_dirs, precompressed=precompressed)
         # serve static files from source packages based on hierarchy rules
-        return StaticFileServer(app)
+        memory_cache = None
+        if settings.static_files.memory_cache.enabled:
+            memory_cache = StaticFileCache(settings.static_files.memory_cache.max_bytes,
+                                           settings.static_files.memory_cache.max_file_bytes)
+        return StaticFileServer(app, precompressed=settings.static_files.serve_precompressed,
+                                memory_cache=memory_cache)
     return app
 
 
@@ -170,7 +585,12 @@ def full_wsgi_stack(app):
     settings = ag.app.settings
 
     if settings.beaker.enabled:
-        app = SessionMiddleware(app, **dict(settings.beaker))
+        # sessions that can tell when they were changed, see blazeweb.sessions.
+        # Given as config, beaker warns about "session_" keyword arguments.
+        config = {}
+        if not settings.beaker.get('session_class'):
+            config['session.session_class'] = session_class_for(settings.beaker.type)
+        app = SessionMiddleware(app, config, **dict(settings.beaker))
 
     app = static_files(app)
 
@@ -180,12 +600,28 @@ def full_wsgi_stack(app):
     if settings.debugger.enabled:
         app = DebuggedApplication(app, evalex=settings.debugger.interactive)
 
+    # profile a sample of requests
+    if settings.profiling.enabled:
+        app = RequestProfiler(
+            app,
+            settings.profiling.dir,
+            rate=settings.profiling.rate,
+            endpoints=settings.profiling.endpoints,
+            format=settings.profiling.format,
+            interval=settings.profiling.interval,
+            max_files=settings.profiling.max_files,
+        )
+
     # log http requests, use sparingly on production servers
     if settings.logs.http_requests.enabled:
         app = HttpRequestLogger(
             app, True,
             settings.logs.http_requests.filters.path_info,
-            settings.logs.http_requests.filters.request_method
+            settings.logs.http_requests.filters.request_method,
+            max_body=settings.logs.http_requests.max_body,
+            max_files=settings.logs.http_requests.max_files,
+            max_age=settings.logs.http_requests.max_age,
+            queue_size=settings.logs.http_requests.queue_size,
         )
 
     return app
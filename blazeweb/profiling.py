@@ -0,0 +1,168 @@
+"""
+Profiling of sampled requests, see middleware.RequestProfiler and
+settings.profiling.
+
+Two formats are written:
+
+    collapsed: a background thread samples the request thread's stack every
+        few milliseconds.  Each line of the file is a stack, outermost frame
+        first, separated by ";", followed by how many times it was seen.  This
+        is the input format of flamegraph.pl, speedscope, etc.  Cheap enough
+        to use in production.
+    pstats: the request is profiled with cProfile.  Exact call counts and
+        times, but it slows the profiled requests down considerably.
+
+The profile-report command merges the files of each endpoint.
+"""
+from collections import Counter
+import fnmatch
+import logging
+import os
+from os import path
+import pstats
+import re
+import sys
+import threading
+
+log = logging.getLogger(__name__)
+
+__all__ = [
+    'StackSampler',
+    'endpoint_matches',
+    'profile_dir_for',
+    'read_collapsed',
+    'write_collapsed',
+    'merge_profiles',
+    'top_frames',
+]
+
+FORMATS = {
+    'collapsed': '.collapsed',
+    'pstats': '.pstats',
+}
+
+
+def frame_label(code):
+    return '%s (%s:%d)' % (code.co_name, path.basename(code.co_filename), code.co_firstlineno)
+
+
+class StackSampler(object):
+    """
+        Samples the stack of one thread every `interval` seconds from a
+        background thread.  Frames outside of (above) `stop_code` are not
+        recorded.  Stacks are counted in `stacks`, keyed on their collapsed
+        form.
+    """
+    def __init__(self, thread_id=None, interval=0.005, stop_code=None):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stop_code = stop_code
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='blazeweb-stack-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.sample(frame)
+
+    def sample(self, frame):
+        labels = []
+        while frame is not None:
+            if frame.f_code is self.stop_code:
+                break
+            labels.append(frame_label(frame.f_code))
+            frame = frame.f_back
+        if labels:
+            labels.reverse()
+            self.stacks[';'.join(labels)] += 1
+            self.samples += 1
+
+
+def write_collapsed(fpath, stacks):
+    with open(fpath, 'w') as fh:
+        for stack, count in sorted(stacks.items()):
+            fh.write('%s %d\n' % (stack, count))
+
+
+def read_collapsed(fpath, stacks=None):
+    stacks = Counter() if stacks is None else stacks
+    with open(fpath) as fh:
+        for line in fh:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack and count.isdigit():
+                stacks[stack] += int(count)
+    return stacks
+
+
+def endpoint_matches(endpoint, patterns):
+    """ patterns is None (everything matches) or a list of fnmatch patterns """
+    if patterns is None:
+        return True
+    return any(fnmatch.fnmatchcase(endpoint, pattern) for pattern in patterns)
+
+
+def profile_dir_for(base_dir, endpoint):
+    """ the directory the profiles for endpoint are written to """
+    return path.join(base_dir, re.sub(r'[^\w.:-]', '_', endpoint).replace(':', '--'))
+
+
+def merge_profiles(base_dir):
+    """
+        Merge the profiles written for each endpoint.  Returns a list of
+        (endpoint directory name, format, number of files, merged) where
+        merged is a Counter of collapsed stacks or a pstats.Stats instance.
+    """
+    merged = []
+    if not path.isdir(base_dir):
+        return merged
+    for dname in sorted(os.listdir(base_dir)):
+        dpath = path.join(base_dir, dname)
+        if not path.isdir(dpath):
+            continue
+        fnames = sorted(os.listdir(dpath))
+        for fmt, ext in sorted(FORMATS.items()):
+            fpaths = [path.join(dpath, fname) for fname in fnames if fname.endswith(ext)]
+            if not fpaths:
+                continue
+            if fmt == 'collapsed':
+                stacks = Counter()
+                for fpath in fpaths:
+                    read_collapsed(fpath, stacks)
+                merged.append((dname, fmt, len(fpaths), stacks))
+            else:
+                stats = pstats.Stats(fpaths[0], stream=sys.stdout)
+                for fpath in fpaths[1:]:
+                    try:
+                        stats.add(fpath)
+                    except (TypeError, EOFError, ValueError):
+                        log.warning('skipping unreadable profile: %s', fpath)
+                merged.append((dname, fmt, len(fpaths), stats))
+    return merged
+
+
+def top_frames(stacks, limit=20):
+    """
+        The frames that were seen in the most samples as a list of
+        (frame, samples the frame was running in, samples the frame was on
+        the stack)
+    """
+    own = Counter()
+    inclusive = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        own[frames[-1]] += count
+        for frame in set(frames):
+            inclusive[frame] += count
+    return [(frame, count, inclusive[frame]) for frame, count in own.most_common(limit)]
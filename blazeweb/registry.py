@@ -1,6 +1,12 @@
+import contextvars
 
 from paste.registry import StackedObjectProxy as PasteSOP
 
+from blazeweb.exceptions import ProgrammingError
+
+_missing = object()
+_getattribute = object.__getattribute__
+
 
 class StackedObjectProxy(PasteSOP):
 
@@ -24,3 +30,93 @@ class StackedObjectProxy(PasteSOP):
 
     def __bool__(self):
         return bool(self._current_obj())
+
+
+class ContextVarObjectProxy(StackedObjectProxy):
+    """
+        Same API as StackedObjectProxy, but the stack of objects is kept in a
+        contextvars.ContextVar instead of a thread-local.  Each asyncio task
+        (and greenlet, on servers that give greenlets their own context) sees
+        only the objects pushed in its own context.
+
+        The stack is stored as a tuple and replaced on every push/pop, never
+        modified in place, so contexts copied from each other don't share
+        changes.
+    """
+    def __init__(self, *args, **kwargs):
+        StackedObjectProxy.__init__(self, *args, **kwargs)
+        init_contextvar(self)
+
+    def _current_obj(self):
+        stack = _getattribute(self, '__dict__')['____contextvar__'].get()
+        if stack:
+            return stack[-1]
+        obj = self.__dict__.get('____default_object__', _missing)
+        if obj is not _missing:
+            return obj
+        raise TypeError(
+            'No object (name: %s) has been registered for this context' % self.____name__
+        )
+
+    def __getattribute__(self, attr):
+        # Public names always belong to the proxied object, so skip the normal
+        # lookup on the proxy, which would fail and fall back to __getattr__.
+        # Private names are looked up on the proxy first; __getattr__ still
+        # sends them to the proxied object if the proxy doesn't have them.
+        if attr[0] == '_':
+            return _getattribute(self, attr)
+        stack = _getattribute(self, '__dict__')['____contextvar__'].get()
+        if stack:
+            return getattr(stack[-1], attr)
+        return getattr(self._current_obj(), attr)
+
+    def _push_object(self, obj):
+        var = _getattribute(self, '__dict__')['____contextvar__']
+        var.set(var.get() + (obj,))
+
+    def _pop_object(self, obj=None):
+        var = _getattribute(self, '__dict__')['____contextvar__']
+        stack = var.get()
+        if not stack:
+            raise AssertionError('No object has been registered for this context')
+        if obj is not None and stack[-1] is not obj:
+            raise AssertionError(
+                'The object popped (%s) is not the same as the object '
+                'expected (%s)' % (stack[-1], obj))
+        var.set(stack[:-1])
+
+    def _object_stack(self):
+        return list(_getattribute(self, '__dict__')['____contextvar__'].get())
+
+
+def init_contextvar(proxy):
+    if '____contextvar__' not in proxy.__dict__:
+        proxy.__dict__['____contextvar__'] = contextvars.ContextVar(
+            'blazeweb.registry.%s' % proxy.__dict__['____name__'], default=()
+        )
+
+
+registry_backends = {
+    'paste': StackedObjectProxy,
+    'contextvars': ContextVarObjectProxy,
+}
+
+
+def set_proxy_backend(proxy, backend):
+    """
+        Switch an existing proxy to the "paste" (thread-local) or
+        "contextvars" backend.  The proxy object stays the same, so modules
+        that have already imported it see the change.  Nothing can be
+        registered with the proxy when it is switched.
+    """
+    if backend not in registry_backends:
+        raise ValueError('unknown registry backend: %s' % backend)
+    if proxy._object_stack():
+        raise ProgrammingError(
+            'can not change the registry backend of "%s" while objects are registered'
+            % proxy.__dict__['____name__']
+        )
+    if backend == 'contextvars':
+        init_contextvar(proxy)
+    # the proxy's __setattr__ would set the attribute on the proxied object
+    object.__setattr__(proxy, '__class__', registry_backends[backend])
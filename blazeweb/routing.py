@@ -1,5 +1,6 @@
 from blazeweb.globals import settings, rg
 from blazeweb.utils import registry_has_object
+from blazeweb.utils.filesystem import static_manifest
 from werkzeug.datastructures import MultiDict
 from werkzeug.routing import Rule
 from werkzeug.urls import Href
@@ -60,9 +61,15 @@ def static_url(path):
     """
         Adds the conifgured "static" files prefix to the relative URL passed in.
 
+        If static files are served from the static directory and the path is
+        in the static manifest, the content-hashed file name is used instead.
+
         NOTE: abs_static_url() will probably be more useful
     """
-    return '%s/%s' % (settings.routing.static_prefix.rstrip('/'), path.lstrip('/'))
+    path = path.lstrip('/')
+    if settings.static_files.location == 'static':
+        path = static_manifest().get(path, path)
+    return '%s/%s' % (settings.routing.static_prefix.rstrip('/'), path)
 
 
 def abs_static_url(path):
@@ -0,0 +1,205 @@
+"""
+Beaker session classes that can tell when a session was changed, and removal
+of expired dbm and file beaker sessions.
+
+DigestSession and DigestCookieSession keep a digest of each value's pickle as
+it was loaded, so that ResponseContext only saves a session when one of its
+values was set, removed, or changed in place (e.g.
+rg.session['cart'].append(item)).  middleware.full_wsgi_stack() uses them
+unless beaker.session_class is set.
+
+Each session is a file under settings.beaker.data_dir.  Instead of walking
+the whole directory when the application starts, a SessionSweeper checks a
+batch of files at a time from a background thread, picking up the walk where
+the last batch left off.  A lock under settings.beaker.lock_dir keeps more than
+one process from sweeping at the same time.
+
+The "session-sweep" task (`bw tasks session-sweep`) does a complete sweep out
+of band, e.g. from cron.
+"""
+import hashlib
+import logging
+import os
+from os import path
+import pickle
+import threading
+import time
+
+from beaker.session import CookieSession, Session
+from beaker.synchronization import file_synchronizer
+
+log = logging.getLogger(__name__)
+
+__all__ = [
+    'DigestCookieSession',
+    'DigestSession',
+    'SessionSweeper',
+    'session_class_for',
+    'sweeper_from_settings',
+    'value_digest',
+]
+
+# set by beaker on every load, not worth saving the session for
+_TIMESTAMP_KEYS = ('_accessed_time', '_creation_time')
+
+
+def value_digest(value):
+    """ a digest of the value's pickle; None if it can't be pickled """
+    try:
+        return hashlib.sha1(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)).digest()
+    except Exception:
+        return None
+
+
+def _value_digests(data):
+    return dict((key, value_digest(value)) for key, value in data.items()
+                if key not in _TIMESTAMP_KEYS)
+
+
+class DigestSession(Session):
+    """ a beaker Session with loaded_digests: key => value_digest() when loaded """
+    def load(self):
+        Session.load(self)
+        self.loaded_digests = _value_digests(self.accessed_dict)
+
+
+class DigestCookieSession(CookieSession):
+    """ a beaker CookieSession with loaded_digests, see DigestSession """
+    def __init__(self, *args, **kwargs):
+        CookieSession.__init__(self, *args, **kwargs)
+        self.loaded_digests = _value_digests(self.accessed_dict)
+
+
+def session_class_for(session_type):
+    """ the Digest session class for a beaker.type setting """
+    if session_type == 'cookie':
+        return DigestCookieSession
+    return DigestSession
+
+
+class SessionSweeper(object):
+    """
+        Removes session files that have not been used for `timeout` seconds.
+
+        batch_size: how many files sweep() checks
+        interval: seconds between the sweeps of the background thread
+    """
+    lock_name = 'blazeweb_session_sweep'
+
+    def __init__(self, data_dir, timeout, lock_dir=None, batch_size=500, interval=10):
+        self.data_dir = data_dir
+        self.timeout = timeout
+        self.lock_dir = lock_dir
+        self.batch_size = batch_size
+        self.interval = interval
+        self.checked = 0
+        self.removed = 0
+        # complete passes over data_dir
+        self.passes = 0
+        self._files = None
+        self._pid = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def walk(self):
+        for root, dirnames, filenames in os.walk(self.data_dir):
+            for filename in filenames:
+                yield path.join(root, filename)
+
+    def sweep(self, limit=None, wait=False):
+        """
+            Check up to `limit` (default: batch_size) files and remove the
+            expired ones.  Returns the number of files checked, which is 0
+            when, unless wait is True, another process is sweeping.
+        """
+        limit = limit or self.batch_size
+        lock = file_synchronizer(self.lock_name, lock_dir=self.lock_dir)
+        if not lock.acquire_write_lock(wait=wait):
+            return 0
+        try:
+            return self._sweep(limit)
+        finally:
+            lock.release_write_lock()
+
+    def _sweep(self, limit):
+        if self._files is None:
+            self._files = self.walk()
+        cutoff = time.time() - self.timeout
+        checked = 0
+        for fpath in self._files:
+            checked += 1
+            try:
+                stat = os.stat(fpath)
+                # sessions that are read but not changed don't always get
+                # written, so go by the last access too
+                if max(stat.st_atime, stat.st_mtime) < cutoff:
+                    os.remove(fpath)
+                    self.removed += 1
+            except OSError:
+                # removed by beaker or another process
+                pass
+            if checked >= limit:
+                break
+        else:
+            # start a new pass on the next sweep
+            self._files = None
+            self.passes += 1
+        self.checked += checked
+        return checked
+
+    def sweep_all(self):
+        """ a complete pass over data_dir, returns the number of files removed """
+        removed = self.removed
+        passes = self.passes
+        self._files = None
+        while self.passes == passes:
+            self.sweep(wait=True)
+        return self.removed - removed
+
+    def start(self):
+        """
+            Start the background thread if it is not running in this process.
+            Called for each request, so that processes forked after the
+            application was created get their own thread.
+        """
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._files = None
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self.run, name='blazeweb-session-sweeper')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception:
+                log.exception('session sweep failed')
+
+
+def sweeper_from_settings(settings):
+    """
+        A SessionSweeper for the application's beaker settings, or None if the
+        sessions are not stored in files or don't time out.
+    """
+    beaker = settings.beaker
+    if beaker.type not in ('dbm', 'file') or not beaker.get('timeout'):
+        return None
+    return SessionSweeper(
+        beaker.data_dir,
+        beaker.timeout,
+        lock_dir=beaker.get('lock_dir'),
+        batch_size=beaker.sweep_batch_size,
+        interval=beaker.sweep_interval,
+    )
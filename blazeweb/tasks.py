@@ -1,10 +1,17 @@
 from __future__ import print_function
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import importlib
+import multiprocessing
+import re
+import time
+
 from decorator import decorator
 from blazeutils import tolist, OrderedDict
 import logging
 import six
 
-from blazeweb.globals import ag
+from blazeweb.exceptions import ProgrammingError
+from blazeweb.globals import ag, settings
 from blazeweb.hierarchy import gatherobjs
 
 log = logging.getLogger(__name__)
@@ -47,7 +54,196 @@ def attributes(*args):
     return decorate_func
 
 
-def run_tasks(tasks, print_call=True, test_only=False, *args, **kwargs):
+def depends_on(*names):
+    """
+        a decorator to declare the actions, by name, that have to be completed
+        before an action is called when a task's actions are run in parallel
+        (see run_tasks()).  An action with the name in any component counts;
+        names that are not part of the run, e.g. because of an attribute, are
+        ignored.  An action without dependencies waits for the actions with a
+        lower numeric prefix, so that the following:
+
+            def action_010_tables():
+                pass
+
+            def action_020_users():
+                pass
+
+            @depends_on('action_010_tables')
+            def action_020_products():
+                pass
+
+            @depends_on()
+            def action_030_static_files():
+                pass
+
+        calls action_010_tables and action_030_static_files right away,
+        action_020_products when action_010_tables is done, and
+        action_020_users when action_010_tables (and any other action_010 or
+        lower of any component) is done.
+    """
+    def decorate_func(f):
+        f.__blazeweb_task_deps = names
+        return decorator(_attributes, f)
+    return decorate_func
+
+
+_prefix = re.compile(r'action_(\d+)')
+
+
+def _group(actname):
+    """
+        the sort key of an action's group: its numeric prefix as a number, so
+        that action_2 comes before action_10.  Actions without a prefix come
+        after all of those, ordered by name.
+    """
+    match = _prefix.match(actname)
+    if match:
+        return (0, int(match.group(1)))
+    return (1, actname)
+
+
+def _dependencies(callables):
+    """
+        the (name, module key) of the actions each action waits for: the ones
+        given to depends_on(), or else those of the earlier numeric groups
+    """
+    deps = {}
+    for actname, modkey, actobj, _ in callables:
+        names = getattr(actobj, '__blazeweb_task_deps', None)
+        group = _group(actname)
+        deps[(actname, modkey)] = set(
+            (other, othermod) for other, othermod, _, _ in callables
+            if (other in names if names is not None else _group(other) < group)
+        )
+    return deps
+
+
+def _builtin_actions(underscore_task):
+    """
+        the actions blazeweb provides for the task, from
+        blazeweb.builtin_tasks.<task>, as (modkey, {name: action})
+    """
+    modname = 'blazeweb.builtin_tasks.%s' % underscore_task
+    try:
+        module = importlib.import_module(modname)
+    except ImportError as e:
+        if getattr(e, 'name', modname) != modname:
+            raise
+        return None, {}
+    actions = OrderedDict(
+        (k, v) for k, v in sorted(six.iteritems(vars(module))) if k.startswith('action_')
+    )
+    return modname, actions
+
+
+def _call_action(action, objects=None):
+    """
+        Call the action and time it.  In a thread, `objects` are the ag and
+        settings to push for it.  Exceptions are handled like the application
+        handles them, then raised.
+    """
+    if objects is not None:
+        ag._push_object(objects[0])
+        settings._push_object(objects[1])
+    try:
+        start = time.time()
+        try:
+            retval = action()
+        except Exception as e:
+            ag.app.handle_exception(e)
+            raise
+        return retval, time.time() - start
+    finally:
+        if objects is not None:
+            settings._pop_object(objects[1])
+            ag._pop_object(objects[0])
+
+
+def _run_sequential(task, callables, print_call, test_only):
+    results = {}
+    for actname, modkey, actobj, _ in sorted(callables):
+        if print_call is True:
+            print('--- Calling: %s:%s ---' % (modkey, actname))
+        if test_only:
+            results[(actname, modkey)] = 'test_only=True'
+            continue
+        try:
+            callable_retval, seconds = _call_action(actobj)
+        except Exception:
+            log.application('task {}: an exception occurred'.format(task))
+            raise
+        if print_call is True:
+            print('--- Done: %s:%s in %.2fs ---' % (modkey, actname, seconds))
+        results[(actname, modkey)] = callable_retval
+    return results
+
+
+def _run_parallel(task, callables, print_call, workers, executor):
+    """
+        Calls the actions on a pool of `workers` threads or processes, each
+        as soon as the actions it depends on are done.  After an action
+        raises, no more actions are started and the exception is raised once
+        the running ones are done.
+    """
+    deps = _dependencies(callables)
+    actions = dict(((actname, modkey), actobj) for actname, modkey, actobj, _ in callables)
+    if executor == 'process':
+        # forked, so the processes have the application already
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+        objects = None
+    else:
+        pool = ThreadPoolExecutor(workers, thread_name_prefix='blazeweb-task')
+        objects = (ag._current_obj(), settings._current_obj())
+    results = {}
+    running = {}
+    error = None
+    try:
+        while deps or running:
+            if error is None:
+                for key in sorted(deps):
+                    if not deps[key] - set(results):
+                        del deps[key]
+                        if print_call is True:
+                            print('--- Calling: %s:%s ---' % (key[1], key[0]))
+                        running[pool.submit(_call_action, actions[key], objects)] = key
+            if not running:
+                if error is None:
+                    raise ProgrammingError(
+                        'task %s: the dependencies of %s can not be met' %
+                        (task, ', '.join('%s:%s' % (key[1], key[0]) for key in sorted(deps)))
+                    )
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                actname, modkey = key = running.pop(future)
+                try:
+                    results[key], seconds = future.result()
+                except Exception as e:
+                    log.application('task {}: an exception occurred'.format(task))
+                    error = error or e
+                    continue
+                if print_call is True:
+                    print('--- Done: %s:%s in %.2fs ---' % (modkey, actname, seconds))
+    finally:
+        pool.shutdown()
+    if error is not None:
+        raise error
+    return results
+
+
+def run_tasks(tasks, print_call=True, test_only=False, workers=None, executor='thread',
+              *args, **kwargs):
+    """
+        Calls the actions of the tasks, in the order of their names.  The
+        actions blazeweb provides in blazeweb.builtin_tasks are included.
+
+        workers: when more than 1, the actions of a task are called in
+            parallel, on a pool of this many workers, as allowed by their
+            dependencies (see depends_on())
+        executor: 'thread' or 'process'.  Process workers are forked, so the
+            actions and their return values have to be picklable.
+    """
     tasks = tolist(tasks)
     retval = OrderedDict()
     for task in tasks:
@@ -72,6 +268,9 @@ def run_tasks(tasks, print_call=True, test_only=False, *args, **kwargs):
 
         collection = gatherobjs('tasks.%s' % underscore_task,
                                 lambda objname, obj: objname.startswith('action_'))
+        builtin_modkey, builtin_actions = _builtin_actions(underscore_task)
+        if builtin_actions:
+            collection[builtin_modkey] = builtin_actions
 
         callables = []
         for modkey, modattrs in six.iteritems(collection):
@@ -101,24 +300,14 @@ def run_tasks(tasks, print_call=True, test_only=False, *args, **kwargs):
                 # sorting purposes, it gives us a predictable
                 # order
                 callables.append((actname, modkey, actobj, None))
-        retval[task] = []
-        for call_tuple in sorted(callables):
-            if print_call is True:
-                print('--- Calling: %s:%s ---' % (call_tuple[1], call_tuple[0]))
-            if test_only:
-                callable_retval = 'test_only=True'
-            else:
-                try:
-                    callable_retval = call_tuple[2]()
-                except Exception as e:
-                    log.application('task {}: an exception occurred')
-                    ag.app.handle_exception(e)
-                    raise
-            retval[task].append((
-                call_tuple[0],
-                call_tuple[1],
-                callable_retval
-            ))
+        if workers and workers > 1 and not test_only:
+            results = _run_parallel(task, callables, print_call, workers, executor)
+        else:
+            results = _run_sequential(task, callables, print_call, test_only)
+        retval[task] = [
+            (actname, modkey, results[(actname, modkey)])
+            for actname, modkey, _, _ in sorted(callables)
+        ]
 
         log.application('task {}: completed'.format(task))
 
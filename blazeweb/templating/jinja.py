@@ -1,15 +1,23 @@
 from __future__ import with_statement
 from __future__ import absolute_import
 import logging
+import os
 from os import path
+import pickle
+import tempfile
+import time
 
 from jinja2 import Environment, TemplateNotFound, BaseLoader, \
-    Template as j2Template, contextfilter
+    Template as j2Template, contextfilter, FileSystemBytecodeCache, \
+    TemplateSyntaxError
 from jinja2.utils import Markup
 
+from blazeweb.exceptions import SettingsError
 from blazeweb.globals import settings
-from blazeweb.hierarchy import FileNotFound, findfile, split_endpoint
+from blazeweb.hierarchy import FileNotFound, findfile, split_endpoint, \
+    list_component_mappings, hm
 import blazeweb.templating as templating
+from blazeweb.utils.filesystem import mkdirs
 import six
 
 log = logging.getLogger(__name__)
@@ -58,11 +66,53 @@ class Template(j2Template):
         return j2Template._from_namespace(environment, namespace, globals)
 
 
+class HierarchyBytecodeCache(FileSystemBytecodeCache):
+    """
+        Jinja's FileSystemBytecodeCache, made safe to share between processes.
+
+        Jinja keys each bucket on the template name *and* the filename that
+        HierarchyLoader.get_source() returns, which is the path resolved
+        through the hierarchy.  Bytecode whose source checksum doesn't match
+        the template is discarded.  So when a supporting app or component
+        starts overriding a template, the override gets its own bucket and the
+        compiled copy of the overridden template is never used for it.
+
+        Writes go to a temporary file that is renamed into place so a process
+        never reads a half written file, and a cache file that can't be read
+        or written is treated as a miss rather than an error.
+    """
+
+    def load_bytecode(self, bucket):
+        try:
+            FileSystemBytecodeCache.load_bytecode(self, bucket)
+        except (EOFError, ValueError, TypeError, pickle.UnpicklingError) as e:
+            log.warning('discarding unreadable template bytecode for %s: %s', bucket.key, e)
+            bucket.reset()
+
+    def dump_bytecode(self, bucket):
+        try:
+            fd, tmppath = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        except (IOError, OSError) as e:
+            log.warning('could not write template bytecode for %s: %s', bucket.key, e)
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(tmppath, self._get_cache_filename(bucket))
+        except (IOError, OSError) as e:
+            log.warning('could not write template bytecode for %s: %s', bucket.key, e)
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+
+
 class Translator(templating.EngineBase):
 
     def __init__(self):
         self.env = Environment(
             loader=self.create_loader(),
+            bytecode_cache=self.create_bytecode_cache(),
             **self.get_settings()
         )
         self.env.template_class = Template
@@ -72,6 +122,13 @@ class Translator(templating.EngineBase):
     def create_loader(self):
         return HierarchyLoader()
 
+    def create_bytecode_cache(self):
+        bcsettings = settings.jinja.bytecode_cache
+        if not bcsettings.enabled:
+            return None
+        mkdirs(bcsettings.dir)
+        return HierarchyBytecodeCache(bcsettings.dir)
+
     def get_settings(self):
         def guess_autoescape(template_name):
             if template_name is None or '.' not in template_name:
@@ -81,7 +138,13 @@ class Translator(templating.EngineBase):
         jsettings = settings.jinja
         if isinstance(jsettings.autoescape, (list, tuple)):
             jsettings.autoescape = guess_autoescape
-        return jsettings.todict()
+        envsettings = dict(jsettings.todict())
+        # blazeweb's own settings, not Environment arguments
+        envsettings.pop('bytecode_cache', None)
+        if settings.templating.uptodate_checks == 'never':
+            # jinja won't even call the loader's uptodate function
+            envsettings.setdefault('auto_reload', False)
+        return envsettings
 
     def init_globals(self):
         self.env.globals.update(self.get_globals())
@@ -98,6 +161,23 @@ class Translator(templating.EngineBase):
     def render_string(self, string, context):
         return self.env.from_string(string).render(context)
 
+    def precompile_templates(self):
+        """
+            Load every template in the appstack and compstack so its compiled
+            bytecode is written to the bytecode cache.  Returns the number of
+            templates compiled and a list of (endpoint, exception) tuples for
+            the files that could not be compiled.
+        """
+        compiled = 0
+        errors = []
+        for endpoint in self.env.list_templates():
+            try:
+                self.env.get_template(endpoint)
+                compiled += 1
+            except (TemplateSyntaxError, UnicodeDecodeError) as e:
+                errors.append((endpoint, e))
+        return compiled, errors
+
     def mark_safe(self, value):
         """ when a template has auto-escaping enabled, mark a value as safe """
         return Markup(value)
@@ -109,8 +189,18 @@ class HierarchyLoader(BaseLoader):
         the hierarchy.
     """
 
-    def __init__(self, encoding=settings.default.charset):
+    uptodate_modes = ('always', 'interval', 'never')
+
+    def __init__(self, encoding=settings.default.charset, uptodate_checks=None,
+                 check_interval=None):
         self.encoding = encoding
+        self.uptodate_checks = uptodate_checks or settings.templating.uptodate_checks
+        if self.uptodate_checks not in self.uptodate_modes:
+            raise SettingsError('templating.uptodate_checks should be one of %s, not "%s"'
+                                % (', '.join(self.uptodate_modes), self.uptodate_checks))
+        if check_interval is None:
+            check_interval = settings.templating.check_interval
+        self.check_interval = check_interval
 
     def find_template_path(self, endpoint):
         # try module level first
@@ -137,8 +227,61 @@ class HierarchyLoader(BaseLoader):
             raise TemplateNotFound(endpoint)
         with open(fpath, 'rb') as f:
             contents = f.read().decode(self.encoding)
+        return contents, fpath, self.uptodate_func(fpath)
+
+    def uptodate_func(self, fpath):
+        """
+            The function jinja calls to find out if the template it loaded from
+            fpath is still current, based on self.uptodate_checks
+        """
+        if self.uptodate_checks == 'never':
+            return lambda: True
         old = path.getmtime(fpath)
-        return contents, fpath, lambda: path.getmtime(fpath) == old
+        if self.uptodate_checks == 'interval':
+            return _IntervalUptodate(fpath, old, self.check_interval)
+        return lambda: path.getmtime(fpath) == old
+
+    def list_templates(self):
+        """
+            The endpoints of all templates in the appstack and compstack.
+            Templates overridden higher in the hierarchy are only listed once.
+        """
+        endpoints = set()
+        for app, pname, package in list_component_mappings(inc_apps=True):
+            package_mod = hm.builtin_import(package or app, fromlist=[''])
+            tpldir = path.dirname(package_mod.__file__)
+            if pname and not package:
+                tpldir = path.join(tpldir, 'components', pname)
+            tpldir = path.join(tpldir, 'templates')
+            for dirpath, _, filenames in os.walk(tpldir):
+                for fname in filenames:
+                    template = path.relpath(path.join(dirpath, fname), tpldir)
+                    template = template.replace(os.sep, '/')
+                    if pname:
+                        template = '%s:%s' % (pname, template)
+                    endpoints.add(template)
+        return sorted(endpoints)
+
+
+class _IntervalUptodate(object):
+    """
+        An uptodate function that only stat()s the template file if at least
+        `interval` seconds have passed since the last time it did
+    """
+    __slots__ = ('fpath', 'mtime', 'interval', 'next_check')
+
+    def __init__(self, fpath, mtime, interval):
+        self.fpath = fpath
+        self.mtime = mtime
+        self.interval = interval
+        self.next_check = time.time() + interval
+
+    def __call__(self):
+        now = time.time()
+        if now < self.next_check:
+            return True
+        self.next_check = now + self.interval
+        return path.getmtime(self.fpath) == self.mtime
 
 
 @contextfilter
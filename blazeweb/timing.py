@@ -0,0 +1,304 @@
+"""
+Per-request timing of the phases of the request cycle, aggregated per
+endpoint into histograms.  Enable with settings.timing.enabled.
+
+Phases recorded by the framework:
+
+    registry: setting up the request globals
+    url_match: binding and matching the URL
+    view_init: creating the view and calling its init()
+    process_args: validation of the view's arguments
+    view.<method>: each method in the view's call stack (auth_pre, setup_view, ...)
+    action: the view's action method
+    template: rendering templates (usually included in "action")
+    session_save: saving the beaker session
+    total: the whole request, up to the point the response is returned
+
+Application code can time its own phases with:
+
+    with current_timer().phase('db'):
+        ...
+
+Stats are dumped periodically to settings.timing.dir, one file per process,
+and can be displayed with the "timing-stats" command.
+"""
+import atexit
+from bisect import bisect_left
+from collections import OrderedDict
+import json
+import logging
+import os
+from os import path
+import threading
+import time
+
+from blazeweb.globals import rg
+from blazeweb.utils.filesystem import _write_atomic
+
+log = logging.getLogger(__name__)
+
+__all__ = [
+    'current_timer',
+    'Histogram',
+    'NULL_TIMER',
+    'RequestTimer',
+    'TimingStats',
+]
+
+UNROUTED = '(unrouted)'
+
+
+class _Phase(object):
+    __slots__ = ('timer', 'name', 'started')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.timer.add(self.name, time.perf_counter() - self.started)
+
+
+class RequestTimer(object):
+    """
+        Collects the time spent in each phase of one request.  A phase that
+        is entered more than once is summed.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = OrderedDict()
+        self.endpoint = None
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def add(self, name, seconds):
+        self.durations[name] = self.durations.get(name, 0) + seconds
+
+    def finish(self):
+        self.add('total', time.perf_counter() - self.started)
+
+    def server_timing(self):
+        """ the value for a Server-Timing header """
+        return ', '.join('%s;dur=%.3f' % (name, seconds * 1000)
+                         for name, seconds in self.durations.items())
+
+
+class _NullPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+class _NullTimer(object):
+    """ used when timing is disabled so callers don't need to check """
+    enabled = False
+    endpoint = None
+    _phase = _NullPhase()
+
+    def phase(self, name):
+        return self._phase
+
+    def add(self, name, seconds):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def current_timer():
+    """
+        The RequestTimer for the current request, or NULL_TIMER if timing is
+        disabled or there is no request.
+    """
+    try:
+        return rg.timer
+    except (TypeError, AttributeError):
+        return NULL_TIMER
+
+
+class Histogram(object):
+    """
+        A fixed bucket histogram of durations in milliseconds.  Percentiles
+        are approximate: they report the upper bound of the bucket the
+        percentile falls in.
+    """
+    buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0.0
+        needed = self.count * pct / 100.0
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= needed and count:
+                if idx == len(self.buckets):
+                    return self.max
+                return min(self.buckets[idx], self.max)
+        return self.max
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def todict(self):
+        return {'counts': self.counts, 'count': self.count, 'total': self.total,
+                'max': self.max}
+
+    @classmethod
+    def fromdict(cls, data):
+        hist = cls()
+        if len(data['counts']) == len(hist.counts):
+            hist.counts = list(data['counts'])
+        else:
+            # written with different buckets; keep the summary values
+            hist.counts[-1] = data['count']
+        hist.count = data['count']
+        hist.total = data['total']
+        hist.max = data['max']
+        return hist
+
+
+class TimingStats(object):
+    """
+        Phase histograms per endpoint for the requests this process has
+        handled.
+
+        dump_dir: if given, the stats are written to <dump_dir>/<pid>.json
+            every dump_interval seconds (checked when a request is recorded)
+            and when the process exits
+    """
+    def __init__(self, dump_dir=None, dump_interval=60):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+        self.dump_dir = dump_dir
+        self.dump_interval = dump_interval
+        self.last_dump = time.time()
+        if dump_dir:
+            atexit.register(self.dump)
+
+    def record(self, timer):
+        endpoint = timer.endpoint or UNROUTED
+        with self.lock:
+            phases = self.endpoints.get(endpoint)
+            if phases is None:
+                phases = self.endpoints[endpoint] = {}
+            for name, seconds in timer.durations.items():
+                hist = phases.get(name)
+                if hist is None:
+                    hist = phases[name] = Histogram()
+                hist.observe(seconds * 1000)
+        if self.dump_dir and time.time() - self.last_dump >= self.dump_interval:
+            self.dump()
+
+    def merge(self, other):
+        with self.lock:
+            for endpoint, phases in other.endpoints.items():
+                mine = self.endpoints.setdefault(endpoint, {})
+                for name, hist in phases.items():
+                    mine.setdefault(name, Histogram()).merge(hist)
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+    def todict(self):
+        with self.lock:
+            return dict(
+                (endpoint, dict((name, hist.todict()) for name, hist in phases.items()))
+                for endpoint, phases in self.endpoints.items()
+            )
+
+    @classmethod
+    def fromdict(cls, data):
+        stats = cls()
+        for endpoint, phases in data.items():
+            stats.endpoints[endpoint] = dict(
+                (name, Histogram.fromdict(hist)) for name, hist in phases.items()
+            )
+        return stats
+
+    def dump(self, fpath=None):
+        self.last_dump = time.time()
+        if fpath is None:
+            # processes that served no requests (e.g. commands) write nothing
+            if not self.dump_dir or not self.endpoints:
+                return
+            fpath = path.join(self.dump_dir, '%d.json' % os.getpid())
+        try:
+            _write_atomic(fpath, json.dumps(self.todict()).encode('utf-8'))
+        except EnvironmentError:
+            log.exception('could not write timing stats to %s', fpath)
+
+    @classmethod
+    def load_dir(cls, dump_dir):
+        """ merge the stats dumped by all processes into one TimingStats """
+        stats = cls()
+        if not path.isdir(dump_dir):
+            return stats
+        for fname in sorted(os.listdir(dump_dir)):
+            if not fname.endswith('.json'):
+                continue
+            try:
+                with open(path.join(dump_dir, fname)) as fh:
+                    stats.merge(cls.fromdict(json.load(fh)))
+            except ValueError:
+                log.warning('skipping unreadable timing stats file: %s', fname)
+        return stats
+
+    def report(self, endpoint=None):
+        """ the stats formatted as a text table, slowest endpoints first """
+        lines = []
+        header = '%-30s %8s %9s %9s %9s %9s' % ('phase', 'count', 'mean ms', 'p50 ms',
+                                                'p95 ms', 'max ms')
+
+        def total_time(item):
+            total = item[1].get('total')
+            return total.total if total else 0
+        with self.lock:
+            items = sorted(self.endpoints.items(), key=total_time, reverse=True)
+            for ep, phases in items:
+                if endpoint is not None and ep != endpoint:
+                    continue
+                lines.append(ep)
+                lines.append('    ' + header)
+                for name, hist in phases.items():
+                    lines.append('    %-30s %8d %9.2f %9.2f %9.2f %9.2f' % (
+                        name, hist.count, hist.mean, hist.percentile(50), hist.percentile(95),
+                        hist.max
+                    ))
+                lines.append('')
+        return '\n'.join(lines)
@@ -1,21 +1,147 @@
+from collections.abc import MutableSet
 import logging
 import random
+import threading
 
 from blazeutils.datastructures import LazyDict, OrderedDict
 from blazeutils.helpers import tolist
-from blazeweb.globals import rg, user as guser
+from werkzeug.http import parse_cookie
+
+from blazeweb.globals import rg, settings, user as guser
 from blazeweb.utils import registry_has_object
 
 log = logging.getLogger(__name__)
 
 
+class PermissionRegistry(object):
+    """
+        Interns permission names to bits so that a set of permissions can be
+        kept and checked as an int.  The bits are only meaningful in the
+        process that assigned them: store permission names, not masks.
+    """
+    # masks() results kept before the cache is reset
+    max_cached_masks = 1000
+
+    def __init__(self):
+        self.bits = {}
+        self._masks = {}
+        self._lock = threading.Lock()
+
+    def bit(self, name):
+        try:
+            return self.bits[name]
+        except KeyError:
+            with self._lock:
+                return self.bits.setdefault(name, 1 << len(self.bits))
+
+    def mask(self, names, more_names=()):
+        """
+            The mask for a permission name or a list/tuple of names, plus
+            more_names.  Masks are cached by the names, so the
+            require_any/require_all of a view are only compiled once.
+        """
+        key = self._key(names, more_names)
+        try:
+            return self._masks[key]
+        except KeyError:
+            pass
+        mask = 0
+        for name in key:
+            mask |= self.bit(name)
+        self._cache(key, mask)
+        return mask
+
+    def known_mask(self, names, more_names=()):
+        """
+            Like mask(), for checking permissions: a name that no one has been
+            given has no bit and isn't assigned one, so checks can't use up
+            bits.  Returns the mask of the names that have a bit and whether
+            all of them have one.
+        """
+        key = self._key(names, more_names)
+        try:
+            return self._masks[key], True
+        except KeyError:
+            pass
+        mask = 0
+        complete = True
+        for name in key:
+            bit = self.bits.get(name)
+            if bit is None:
+                complete = False
+            else:
+                mask |= bit
+        # the mask changes once the missing names get a bit
+        if complete:
+            self._cache(key, mask)
+        return mask, complete
+
+    def _key(self, names, more_names):
+        if isinstance(names, (list, tuple)):
+            return tuple(names) + tuple(more_names)
+        return tuple(tolist(names)) + tuple(more_names)
+
+    def _cache(self, key, mask):
+        if len(self._masks) >= self.max_cached_masks:
+            self._masks = {}
+        self._masks[key] = mask
+
+    def names(self, mask):
+        return frozenset(name for name, bit in list(self.bits.items()) if mask & bit)
+
+
+class UserPerms(MutableSet):
+    """
+        The names of a user's permissions as a set.  Changes to it, e.g.
+        user.perms.add('edit') or user.perms.discard('edit'), are made to the
+        user's permission bitmask.
+    """
+    def __init__(self, user):
+        self._user = user
+
+    def __contains__(self, name):
+        bit = self._user.perm_registry.bits.get(name, 0)
+        return bool(self._user._perm_mask & bit)
+
+    def __iter__(self):
+        return iter(self._user.perm_registry.names(self._user._perm_mask))
+
+    def __len__(self):
+        return bin(self._user._perm_mask).count('1')
+
+    def add(self, name):
+        self._user.add_perm(name)
+
+    def discard(self, name):
+        bit = self._user.perm_registry.bits.get(name, 0)
+        if self._user._perm_mask & bit:
+            self._user._perm_mask &= ~bit
+            self._user._changed()
+
+    def update(self, *others):
+        for names in others:
+            self._user.add_perm(*names)
+
+    def __repr__(self):
+        return 'UserPerms(%r)' % set(self)
+
+
 class User(LazyDict):
     messages_class = OrderedDict
+    # the permissions of all users are interned here
+    perm_registry = PermissionRegistry()
+    # version of the __getstate__() format
+    state_version = 1
+    # attributes saved by __getstate__(); anything else in __dict__ is saved
+    # as is
+    _state_attrs = ('_messages', '_is_authenticated', '_is_super_user', '_perm_mask',
+                    '_modified', '_ld_initialized')
 
     def __init__(self):
         self._messages = self.messages_class()
         # initialize values
         self.clear()
+        self.mark_saved()
         LazyDict.__init__(self)
 
     @property
@@ -25,6 +151,7 @@ class User(LazyDict):
     @is_authenticated.setter
     def is_authenticated(self, value):
         self._is_authenticated = value
+        self._changed()
 
     @property
     def is_super_user(self):
@@ -33,32 +160,109 @@ class User(LazyDict):
     @is_super_user.setter
     def is_super_user(self, value):
         self._is_super_user = value
+        self._changed()
+
+    @property
+    def perms(self):
+        """ the names of the user's permissions, a UserPerms set """
+        return UserPerms(self)
+
+    @perms.setter
+    def perms(self, names):
+        self._perm_mask = self.perm_registry.mask(list(names))
+        self._changed()
+
+    def __setattr__(self, item, value):
+        # LazyDict only looks for properties on the class itself, not on its
+        # bases, so the properties would not work for subclasses
+        if isinstance(getattr(type(self), item, None), property):
+            object.__setattr__(self, item, value)
+        else:
+            LazyDict.__setattr__(self, item, value)
 
     def clear(self):
         log.debug('SessionUser object getting cleared() of auth info')
         self._is_authenticated = False
         self._is_super_user = False
-        self.perms = set()
+        self._perm_mask = 0
+        self._changed()
         LazyDict.clear(self)
 
-    def _has_any(self, haystack, needles, arg_needles):
-        needles = set(tolist(needles))
-        if len(arg_needles) > 0:
-            needles |= set(arg_needles)
-        return bool(haystack.intersection(needles))
+    def is_modified(self):
+        """
+            True if the user has been changed since it was last saved in the
+            session.  Changes made by mutating a value in place (e.g.
+            appending to a list stored on the user) are not seen; assign the
+            value again.
+        """
+        # users pickled before modification tracking don't have the flag
+        return self.__dict__.get('_modified', True)
+
+    def mark_saved(self):
+        self.__dict__['_modified'] = False
+
+    def _changed(self):
+        # not an attribute assignment, LazyDict would store a missing
+        # attribute as an item
+        self.__dict__['_modified'] = True
+
+    def __setitem__(self, key, value):
+        self._changed()
+        LazyDict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._changed()
+        LazyDict.__delitem__(self, key)
+
+    def pop(self, *args):
+        self._changed()
+        return LazyDict.pop(self, *args)
+
+    def popitem(self):
+        self._changed()
+        return LazyDict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._changed()
+        return LazyDict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self._changed()
+        LazyDict.update(self, *args, **kwargs)
+
+    def is_empty(self):
+        """
+            True if nothing has been stored on this user: it isn't
+            authenticated and has no perms, messages, or values.  An empty user
+            doesn't need to be kept in the session.
+        """
+        return not (self._is_authenticated or self._is_super_user or self._perm_mask
+                    or self._messages or len(self))
 
     def add_perm(self, *perms):
-        self.perms |= set(perms)
+        self._perm_mask |= self.perm_registry.mask(perms)
+        self._changed()
 
     def has_perm(self, perm):
-        if self.is_super_user:
+        if self._is_super_user:
             return True
-        return perm in self.perms
+        # a permission no one has been given has no bit yet
+        bit = self.perm_registry.bits.get(perm, 0)
+        return bool(self._perm_mask & bit)
 
     def has_any_perm(self, perms, *args):
-        if self.is_super_user:
+        if self._is_super_user:
             return True
-        return self._has_any(self.perms, perms, args)
+        mask, _ = self.perm_registry.known_mask(perms, args)
+        return bool(self._perm_mask & mask)
+
+    def has_all_perms(self, perms, *args):
+        """ True if the user has every one of the permissions, or perms is empty """
+        if self._is_super_user:
+            return True
+        mask, complete = self.perm_registry.known_mask(perms, args)
+        return complete and self._perm_mask & mask == mask
 
     def add_message(self, severity, text, ident=None):
         log.debug('SessionUser message added: %s, %s, %s', severity, text, ident)
@@ -70,13 +274,15 @@ class User(LazyDict):
                 if ident not in self._messages:
                     break
         self._messages[ident] = UserMessage(severity, text)
+        self._changed()
 
     def get_messages(self, clear=True):
         log.debug('SessionUser messages retrieved: %d' % len(self._messages))
         msgs = list(self._messages.values())
-        if clear:
+        if clear and msgs:
             log.debug('SessionUser messages cleared')
             self._messages = self.messages_class()
+            self._changed()
         return msgs
 
     def __repr__(self):
@@ -92,13 +298,64 @@ class User(LazyDict):
     def __bool__(self):
         return True
 
+    def __getstate__(self):
+        """
+            A compact state for pickling the user into the session: builtin
+            types only, no UserMessage objects or attribute names.  The values
+            of the dict are pickled separately.
+        """
+        extra = dict((name, value) for name, value in self.__dict__.items()
+                     if name not in self._state_attrs)
+        return (
+            self.state_version,
+            self._is_authenticated,
+            self._is_super_user,
+            sorted(self.perms),
+            [(ident, msg.severity, msg.text) for ident, msg in self._messages.items()],
+            extra or None,
+        )
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # pickled before __getstate__() existed
+            state = dict(state)
+            state['_perm_mask'] = self.perm_registry.mask(list(state.pop('perms', ())))
+            self.__dict__.update(state)
+            return
+        version = state[0]
+        if version != 1:
+            raise ValueError('unknown User state version: %r' % (version,))
+        _, is_authenticated, is_super_user, perms, messages, extra = state
+        self.__dict__.update(
+            _is_authenticated=is_authenticated,
+            _is_super_user=is_super_user,
+            _perm_mask=self.perm_registry.mask(perms),
+            _messages=self.messages_class(
+                (ident, UserMessage(severity, text)) for ident, severity, text in messages
+            ),
+            _modified=False,
+            _ld_initialized=True,
+        )
+        if extra:
+            self.__dict__.update(extra)
+
 
 class UserMessage(object):
+    __slots__ = ('severity', 'text')
 
     def __init__(self, severity, text):
         self.severity = severity
         self.text = text
 
+    def __getstate__(self):
+        return (self.severity, self.text)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # pickled before __slots__ were used
+            state = (state['severity'], state['text'])
+        self.severity, self.text = state
+
     def __repr__(self):
         return '%s: %s' % (self.severity, self.text)
 
@@ -113,6 +370,11 @@ class UserProxy(object):
         collected and future accesses to the global user object will
         go directly to that object.
 
+        The User is kept in the beaker session.  Requests that did not send a
+        session cookie get a new User that is only added to the session if
+        something is stored on it (see ResponseContext), so reading the user
+        does not create a session or set a cookie.
+
         This code adapted from paste.registry.
     """
 
@@ -136,14 +398,18 @@ class UserProxy(object):
             return self.__dict__['_user_inst']
 
         # load user instance from the beaker session if possible
-        if registry_has_object(rg) and rg.session is not None:
-            if '__blazeweb_user' in rg.session:
-                user_inst = rg.session['__blazeweb_user']
+        session = rg.session if registry_has_object(rg) else None
+        if session is not None and self._session_started(session):
+            if '__blazeweb_user' in session:
+                user_inst = session['__blazeweb_user']
             else:
                 user_inst = self._new_user_instance()
-                rg.session['__blazeweb_user'] = user_inst
+                session['__blazeweb_user'] = user_inst
         else:
             user_inst = self._new_user_instance()
+            if session is not None:
+                # ResponseContext will add it to the session if it gets used
+                rg.unsaved_user = user_inst
 
         # save the user instance in case we get called again
         self.__dict__['_user_inst'] = user_inst
@@ -162,6 +428,19 @@ class UserProxy(object):
             rg.environ['paste.registry'].register(guser, user_inst)
         return user_inst
 
+    def _session_started(self, session):
+        """
+            True if the client sent a session cookie or the session has already
+            been used in this request.  Otherwise, loading the session would
+            only create a new, empty one.
+        """
+        accessed = getattr(session, 'accessed', None)
+        if accessed is None or accessed():
+            # not a lazy beaker session or already loaded
+            return True
+        key = settings.beaker.get('key', 'beaker.session.id')
+        return key in parse_cookie(rg.environ)
+
     def __getattr__(self, attr):
         return getattr(self._user(), attr)
 
@@ -1,7 +1,9 @@
 import fnmatch
+import hashlib
 import re
 import logging
-from traceback import format_exc
+import sys
+from traceback import TracebackException
 
 from formencode.validators import URL
 from formencode import Invalid
@@ -103,31 +105,68 @@ def exception_context_filter(data):
     return retval
 
 
+class ExceptionContext(object):
+    """
+        The current exception and a copy of the request's environ and POST
+        data.  Converting it to a string formats it like
+        exception_with_context(), but the copy is cheap, so the formatting can
+        wait until the text is needed, on another thread if need be.
+    """
+    def __init__(self):
+        self.trace = TracebackException(*sys.exc_info())
+        self.has_request = bool(len(rg._object_stack()))
+        if self.has_request:
+            post_data = werkzeug_multi_dict_conv(rg.request.form)
+
+            # Remove HTTP_COOKIE from the environment since it may contain sensitive info.  It
+            # will get filtered and inserted next.
+            environ = rg.environ.copy()
+            if 'HTTP_COOKIE' in environ:
+                del environ['HTTP_COOKIE']
+                environ['blazeweb.cookies'] = exception_context_filter(rg.request.cookies)
+        else:
+            post_data = {}
+            environ = {}
+        self.environ = environ
+        self.post_data = exception_context_filter(post_data)
+        self._text = None
+        self._fingerprint = None
+
+    def fingerprint(self):
+        """
+            identifies the exception by its type and where it was raised from,
+            so that repeats of the same error can be told apart from new ones
+        """
+        if self._fingerprint is None:
+            etype = self.trace.exc_type
+            signature = [getattr(etype, '__module__', ''), getattr(etype, '__name__', '')]
+            for frame in self.trace.stack:
+                signature.append('%s:%s:%s' % (frame.filename, frame.name, frame.lineno))
+            digest = hashlib.sha1('\n'.join(signature).encode('utf-8')).hexdigest()
+            self._fingerprint = digest[:12]
+        return self._fingerprint
+
+    def summary(self):
+        """ the exception's type and message, on one line """
+        lines = list(self.trace.format_exception_only())
+        return lines[-1].strip() if lines else ''
+
+    def __str__(self):
+        if self._text is None:
+            text = '\n== TRACE ==\n\n%s' % ''.join(self.trace.format())
+            if self.has_request:
+                text += '\n\n== ENVIRON ==\n\n%s' % pformat(self.environ, 4)
+                text += '\n\n== POST ==\n\n%s\n\n' % pformat(self.post_data, 4)
+            self._text = text
+        return self._text
+
+
 def exception_with_context():
     """
         formats the last exception as a string and adds context about the
         request.
     """
-    has_request = len(rg._object_stack())
-    if has_request:
-        post_data = werkzeug_multi_dict_conv(rg.request.form)
-
-        # Remove HTTP_COOKIE from the environment since it may contain sensitive info.  It will get
-        # filtered and inserted next.
-        environ = rg.environ.copy()
-        if 'HTTP_COOKIE' in environ:
-            del environ['HTTP_COOKIE']
-            environ['blazeweb.cookies'] = exception_context_filter(rg.request.cookies)
-    else:
-        post_data = {}
-        environ = {}
-    post_data = exception_context_filter(post_data)
-
-    retval = '\n== TRACE ==\n\n%s' % format_exc()
-    if has_request:
-        retval += '\n\n== ENVIRON ==\n\n%s' % pformat(environ, 4)
-        retval += '\n\n== POST ==\n\n%s\n\n' % pformat(post_data, 4)
-    return retval
+    return str(ExceptionContext())
 
 
 class _Redirect(Exception):
@@ -172,3 +211,5 @@ def sess_regenerate_id():
         rg.session.request['set_cookie'] = True
         if hasattr(rg.session, 'namespace'):
             del rg.session.namespace
+    # the session needs to be saved under its new id
+    rg.session.save()
@@ -6,18 +6,35 @@ library.
 
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+from io import BytesIO
+import json
+import logging
 import os
 from os import path
 from shutil import copy2, copystat, rmtree
+import tempfile
 
 from blazeutils import NotGiven
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-from blazeweb.globals import settings
+from blazeweb.globals import ag, settings
 from blazeweb.hierarchy import list_component_mappings, hm
+from blazeweb.utils import registry_has_object
+
+log = logging.getLogger(__name__)
 
 __all__ = [
     'mkdirs',
     'copy_static_files',
+    'write_static_manifest',
+    'static_manifest',
+    'compress_static_files',
 ]
 
 
@@ -50,13 +67,24 @@ def mkdirs(newdir, mode=NotGiven):
         os.makedirs(newdir, mode)
 
 
-def copy_static_files(delete_existing=False):
+def copy_static_files(delete_existing=False, manifest=None, compress=None):
     """
         copy's files from the apps and components to the static directory
         defined in the settings.  Files are copied in a hierarchical way
         such that apps and components lower in priority have their files
         overwritten by apps/components with higher priority.
+
+        manifest: write the hashed file manifest after copying, see
+            write_static_manifest().  Defaults to
+            settings.static_files.manifest.enabled.
+        compress: write precompressed copies of the files after copying, see
+            compress_static_files().  Defaults to
+            settings.static_files.precompress.enabled.
     """
+    if manifest is None:
+        manifest = settings.static_files.manifest.enabled
+    if compress is None:
+        compress = settings.static_files.precompress.enabled
     statroot = settings.dirs.static
 
     if delete_existing:
@@ -85,6 +113,177 @@ def copy_static_files(delete_existing=False):
 
             copytree(srcpath, targetpath)
 
+    if manifest:
+        write_static_manifest()
+    if compress:
+        compress_static_files()
+
+
+def _file_hash(fpath):
+    fhash = hashlib.md5()
+    with open(fpath, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(65536), b''):
+            fhash.update(chunk)
+    return fhash.hexdigest()[:12]
+
+
+def _write_atomic(fpath, data):
+    # write to a temporary file and rename it so a running app never reads a
+    # partially written file
+    fd, tmp_fpath = tempfile.mkstemp(dir=path.dirname(fpath), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(data)
+    os.replace(tmp_fpath, fpath)
+
+
+def _read_manifest(fpath):
+    if not path.isfile(fpath):
+        return {}
+    with open(fpath) as fh:
+        return json.load(fh)
+
+
+def write_static_manifest():
+    """
+        Gives each file in the "app" and "component" static directories a copy
+        named after a hash of its contents (css/style.css ->
+        css/style.<hash>.css) and writes a JSON manifest to the static
+        directory mapping the original path to the hashed path.  Paths in the
+        manifest are relative to the static directory and use forward slashes,
+        the same as the paths given to routing.static_url().
+
+        Hashed copies from previous runs are left in place so pages cached
+        with old URLs keep working.  They are recognized by the hash in their
+        name matching their contents, and are not hashed again.
+
+        Returns the manifest dictionary.
+    """
+    statroot = settings.dirs.static
+    manifest_fpath = path.join(statroot, settings.static_files.manifest.fname)
+    manifest = {}
+    for topdir in ('app', 'component'):
+        for dirpath, dirnames, fnames in os.walk(path.join(statroot, topdir)):
+            dirnames.sort()
+            for fname in sorted(fnames):
+                if fname.endswith(compressed_suffixes):
+                    continue
+                fpath = path.join(dirpath, fname)
+                relpath = path.relpath(fpath, statroot).replace(os.sep, '/')
+                fhash = _file_hash(fpath)
+                base, ext = path.splitext(relpath)
+                if base.endswith('.' + fhash) or ext == '.' + fhash:
+                    # a hashed copy
+                    continue
+                hashed = '%s.%s%s' % (base, fhash, ext)
+                hashed_fpath = path.join(statroot, *hashed.split('/'))
+                if not path.exists(hashed_fpath):
+                    copy2(fpath, hashed_fpath)
+                manifest[relpath] = hashed
+    _write_atomic(manifest_fpath, json.dumps(manifest, indent=0, sort_keys=True).encode('utf-8'))
+    if registry_has_object(ag):
+        ag.static_manifest = manifest
+    return manifest
+
+
+def static_manifest():
+    """
+        The manifest written by write_static_manifest(), loaded once per
+        application.  An empty dictionary is returned when the manifest is
+        disabled or static-copy has not written one.
+    """
+    if not settings.static_files.manifest.enabled:
+        return {}
+    if not hasattr(ag, 'static_manifest'):
+        ag.static_manifest = _read_manifest(
+            path.join(settings.dirs.static, settings.static_files.manifest.fname)
+        )
+    return ag.static_manifest
+
+
+def _gzip_compress(data):
+    buf = BytesIO()
+    # mtime=0 keeps the output the same for the same input
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as gzfile:
+        gzfile.write(data)
+    return buf.getvalue()
+
+
+def _brotli_compress(data):
+    return brotli.compress(data, quality=11)
+
+static_compressors = {
+    'gzip': ('.gz', _gzip_compress),
+    'br': ('.br', _brotli_compress),
+}
+compressed_suffixes = tuple(suffix for suffix, _ in static_compressors.values())
+
+
+def _compress_file(fpath, formats):
+    written = 0
+    data = None
+    for fmt in formats:
+        suffix, compressor = static_compressors[fmt]
+        cpath = fpath + suffix
+        if path.exists(cpath) and path.getmtime(cpath) >= path.getmtime(fpath):
+            continue
+        if data is None:
+            with open(fpath, 'rb') as fh:
+                data = fh.read()
+        cdata = compressor(data)
+        # only worth serving if it is actually smaller
+        if len(cdata) >= len(data):
+            continue
+        _write_atomic(cpath, cdata)
+        written += 1
+    return written
+
+
+def compress_static_files(formats=None, min_size=None, workers=None):
+    """
+        Writes precompressed siblings (style.css.gz, style.css.br) of the
+        compressible files in the "app" and "component" static directories so
+        they can be served without compressing on each request.  Files are
+        compressed in parallel and siblings that are newer than their file are
+        left alone.
+
+        formats: encodings to write, "gzip" and/or "br"; "br" requires the
+            brotli package.  Defaults to settings.static_files.precompress.formats.
+        min_size: files smaller than this many bytes are skipped.  Defaults to
+            settings.static_files.precompress.min_size.
+        workers: size of the thread pool.  Defaults to
+            settings.static_files.precompress.workers.
+
+        Returns the number of compressed files written.
+    """
+    pcsettings = settings.static_files.precompress
+    formats = list(pcsettings.formats if formats is None else formats)
+    min_size = pcsettings.min_size if min_size is None else min_size
+    workers = pcsettings.workers if workers is None else workers
+    for fmt in list(formats):
+        if fmt not in static_compressors:
+            raise ValueError('unknown static compression format: %s' % fmt)
+        if fmt == 'br' and brotli is None:
+            log.warning('brotli is not installed, .br static files will not be written')
+            formats.remove(fmt)
+    extensions = set(ext.lower() for ext in pcsettings.extensions)
+
+    statroot = settings.dirs.static
+    fpaths = []
+    for topdir in ('app', 'component'):
+        for dirpath, _, fnames in os.walk(path.join(statroot, topdir)):
+            for fname in fnames:
+                if path.splitext(fname)[1].lower() not in extensions:
+                    continue
+                fpath = path.join(dirpath, fname)
+                if path.getsize(fpath) >= min_size:
+                    fpaths.append(fpath)
+
+    if not formats or not fpaths:
+        return 0
+    # zlib and brotli release the GIL while compressing, so threads are enough
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(lambda fpath: _compress_file(fpath, formats), fpaths))
+
 
 def copytree(src, dst, symlinks=False, ignore=None):
     """Recursively copy a directory tree using copy2().
@@ -1,3 +1,5 @@
+import inspect
+from itertools import chain
 import logging
 
 from decorator import decorator
@@ -9,20 +11,23 @@ import six
 from werkzeug.datastructures import MultiDict
 from werkzeug.exceptions import BadRequest, abort
 from werkzeug.routing import Rule
-from werkzeug.utils import ArgumentValidationError, validate_arguments
 
+from blazeweb.asgi import asgi_loop, run_coroutine
 from blazeweb.globals import ag, rg, user, settings
 from blazeutils.jsonh import jsonmod, assert_have_json
 from blazeweb.content import getcontent, Content
 from blazeweb.hierarchy import listapps, split_endpoint
+from blazeweb.timing import current_timer
 from blazeweb.utils import werkzeug_multi_dict_conv
 from blazeweb.wrappers import Response
 
 log = logging.getLogger(__name__)
 
 __all__ = (
+    'ArgProcessor',
     'View',
     'SecureView',
+    'AsyncView',
     'asview',
     'jsonify'
 )
@@ -63,6 +68,131 @@ class _ProcessorWrapper(formencode.validators.Wrapper):
         return result
 
 
+class _ArgSignature(object):
+    """
+        A compact description of the arguments a view method accepts.  Built
+        once per function and cached on the view class so that calling a
+        method with the calling args doesn't require introspection.
+    """
+    __slots__ = ('names', 'required', 'takes_kwargs')
+
+    def __init__(self, func, skip_first=False):
+        spec = inspect.getfullargspec(func)
+        positional = spec.args[1:] if skip_first else spec.args
+        num_required = len(positional) - len(spec.defaults or ())
+        kwonly_defaults = spec.kwonlydefaults or {}
+        self.names = frozenset(positional + spec.kwonlyargs)
+        self.required = tuple(positional[:num_required]) + tuple(
+            name for name in spec.kwonlyargs if name not in kwonly_defaults
+        )
+        self.takes_kwargs = spec.varkw is not None
+
+    def missing(self, calling_args):
+        return [name for name in self.required if name not in calling_args]
+
+    def kwargs(self, calling_args):
+        if self.takes_kwargs:
+            return calling_args
+        names = self.names
+        return dict((k, v) for k, v in six.iteritems(calling_args) if k in names)
+
+
+class ArgProcessor(object):
+    """
+        A filtering & validation step for one calling argument.  Takes the
+        same arguments as View.add_processor(), see there for details.
+
+        The formencode wrappers used at request time are built here, once.
+        That makes it possible to declare processors on the view class and
+        share them across requests instead of calling add_processor() in
+        init():
+
+            class Search(View):
+                arg_processors = (
+                    ArgProcessor('q', required=True),
+                    ArgProcessor('page', int),
+                    ArgProcessor('tags[]', takes_list=True, pass_as='tags'),
+                )
+
+        They are applied the same way as the processors added with
+        add_processor(), and before them.  As with add_processor(), arguments
+        that aren't URL arguments are expected as GET arguments.
+    """
+
+    def __init__(self, argname, processor=None, required=None, takes_list=None,
+                 list_item_invalidates=False, strict=False, show_msg=False,
+                 custom_msg=None, pass_as=None):
+        if custom_msg:
+            show_msg = True
+        if required:
+            if not processor:
+                processor = formencode.validators.NotEmpty()
+            strict = True
+        self.argname = argname
+        self.required = required
+        self.takes_list = takes_list
+        self.list_item_invalidates = list_item_invalidates
+        self.strict = strict
+        self.show_msg = show_msg
+        self.custom_msg = custom_msg
+        self.pass_as = pass_as or argname
+        if processor:
+            validators = []
+            for proc in tolist(processor):
+                if not formencode.is_validator(proc):
+                    if not hasattr(proc, '__call__'):
+                        raise TypeError('processor must be a Formencode validator or a callable')
+                    proc = _ProcessorWrapper(to_python=proc)
+                if takes_list:
+                    proc = formencode.ForEach(proc)
+                if required:
+                    proc = formencode.All(formencode.validators.NotEmpty, proc)
+                validators.append(proc)
+            self.validators = tuple(validators)
+        else:
+            self.validators = (None, )
+
+    def apply(self, calling_args, validator):
+        """
+            Process the value for this argument in calling_args, in place, with
+            one of self.validators.  Raises formencode.Invalid on failure.
+        """
+        argname = self.argname
+        pass_as = self.pass_as
+        takes_list = self.takes_list
+        argval = calling_args.get(argname, None)
+        if isinstance(argval, list):
+            if takes_list is False:
+                raise formencode.Invalid('multiple values not allowed', argval, None)
+            if takes_list is None:
+                calling_args[pass_as] = argval = argval[0]
+        elif takes_list:
+            calling_args[pass_as] = argval = tolist(argval)
+        if pass_as != argname:
+            # catches a couple cases where a replacement doesn't
+            # already happen above
+            calling_args[pass_as] = argval
+            # delete the old value if it exists
+            if argname in calling_args:
+                del calling_args[argname]
+        if validator is None:
+            return
+        try:
+            processed_val = validator.to_python(argval)
+        except formencode.Invalid as e:
+            """ do a second round of processing for list values """
+            if not takes_list or not e.error_list or self.list_item_invalidates:
+                raise
+            """ only remove the bad values, keep the good ones """
+            new_list = []
+            for index, error in enumerate(e.error_list):
+                if error is None:
+                    new_list.append(argval[index])
+            # revalidate for conversion and required
+            processed_val = validator.to_python(new_list)
+        calling_args[pass_as] = processed_val
+
+
 class _ViewCallStackAbort(Exception):
     """
         used to stop the views from running through all the methods in the
@@ -70,6 +200,20 @@ class _ViewCallStackAbort(Exception):
         view instead.
     """
 
+
+class _AwaitAction(BaseException):
+    """
+        raised by an AsyncView served by blazeweb.asgi.ASGIAdapter when its
+        action returns a coroutine.  The request is suspended until the
+        adapter has awaited it on the event loop, see
+        WSGIApp.resume_request().  A BaseException, so that the application's
+        exception handling doesn't catch it.
+    """
+    def __init__(self, view, awaitable):
+        BaseException.__init__(self)
+        self.view = view
+        self.awaitable = awaitable
+
 """
     primary View objects
 """
@@ -102,6 +246,15 @@ class View(object):
         '_default_': 'default',
     }
 
+    # ArgProcessor instances applied to the calling args of every request,
+    # before any processors added with add_processor()
+    arg_processors = ()
+
+    # set to False for views that don't need the session or a persistent user
+    # (static like content, APIs, etc.).  rg.session is None while they run,
+    # so they don't load a session or start a new one.
+    uses_session = True
+
     def __init__(self, urlargs, endpoint):
         # the view methods are responsible for filling self.retval1
         # with the response string or returning the value
@@ -120,7 +273,10 @@ class View(object):
         self.strict_args = False
         # names of GET arguments that should be "melded" with the routing
         # arguments
-        self.expected_get_args = []
+        self.expected_get_args = [
+            argproc.argname for argproc in self.arg_processors
+            if argproc.argname not in urlargs
+        ]
         # holds the variables that will be sent to the template when
         # rendering
         self.template_vars = {}
@@ -252,30 +408,16 @@ class View(object):
                 ?listvalues[]=1&listvalues[]=2), then set pass_as to a string
                 that corresponds to the variable name that should be used
                 when passing this value to the action methods.
+
+            Processors that don't depend on the request can be declared once on
+            the class instead, see ArgProcessor.
         """
         if argname not in self.urlargs:
             self.expect_getargs(argname)
-        if custom_msg:
-            show_msg = True
-        if required:
-            if not processor:
-                processor = formencode.validators.NotEmpty()
-            strict = True
-        if processor:
-            for proc in tolist(processor):
-                if not formencode.is_validator(proc):
-                    if not hasattr(proc, '__call__'):
-                        raise TypeError('processor must be a Formencode validator or a callable')
-                    proc = _ProcessorWrapper(to_python=proc)
-                self._processors.append((
-                    argname, proc, required, takes_list,
-                    list_item_invalidates, strict, show_msg, custom_msg, pass_as
-                ))
-        else:
-            self._processors.append((
-                argname, None, required, takes_list,
-                list_item_invalidates, strict, show_msg, custom_msg, pass_as
-            ))
+        self._processors.append(ArgProcessor(
+            argname, processor, required, takes_list, list_item_invalidates,
+            strict, show_msg, custom_msg, pass_as
+        ))
 
     """
         methods related to processing the view
@@ -284,25 +426,29 @@ class View(object):
         """
             called to get the view's response
         """
+        timer = current_timer()
         try:
             # call prep method if it exists.  This is not part of the call stack
             # because it allows the view instance to customize the call stack
             # before it starts being used in the loop below
             if hasattr(self, 'init'):
-                getattr(self, 'init')()
+                with timer.phase('view_init'):
+                    getattr(self, 'init')()
 
             # turn URL args and GET args into a single MultiDict and store
             # on self.calling_args
             self.process_calling_args()
 
             # validate/process self.calling_args
-            self.process_args()
+            with timer.phase('process_args'):
+                self.process_args()
 
             # call each method in the call stack
             self.process_cm_stack()
 
             # call the action method
-            self.process_action_method()
+            with timer.phase('action'):
+                self.process_action_method()
         except _ViewCallStackAbort:
             pass
         return self.handle_response()
@@ -326,86 +472,59 @@ class View(object):
         self.calling_args = werkzeug_multi_dict_conv(args)
         log.debug('calling args: %s' % self.calling_args)
 
-    def process_args(self):  # noqa
+    def process_args(self):
         had_strict_arg_failure = False
-        for argname, processor, required, takes_list, list_item_invalidates, \
-                strict, show_msg, custom_msg, pass_as in self._processors:
-            is_invalid = False
-            pass_as = pass_as or argname
-            argval = self.calling_args.get(argname, None)
-            try:
-                if isinstance(argval, list):
-                    if takes_list is False:
-                        raise formencode.Invalid('multiple values not allowed', argval, None)
-                    if takes_list is None:
-                        self.calling_args[pass_as] = argval = argval[0]
-                elif takes_list:
-                    self.calling_args[pass_as] = argval = tolist(argval)
-                if pass_as != argname:
-                    # catches a couple cases where a replacement doesn't
-                    # already happen above
-                    self.calling_args[pass_as] = argval
-                    # delete the old value if it exists
-                    if argname in self.calling_args:
-                        del self.calling_args[argname]
-                if processor:
-                    if takes_list:
-                        processor = formencode.ForEach(processor)
-                    try:
-                        if required:
-                            processor = formencode.All(formencode.validators.NotEmpty, processor)
-                        processed_val = processor.to_python(argval)
-                    except formencode.Invalid as e:
-                        """ do a second round of processing for list values """
-                        if not takes_list or not e.error_list or list_item_invalidates:
-                            raise
-                        """ only remove the bad values, keep the good ones """
-                        new_list = []
-                        for index, error in enumerate(e.error_list):
-                            if error is None:
-                                new_list.append(argval[index])
-                        # revalidate for conversion and required
-                        processed_val = processor.to_python(new_list)
-                    self.calling_args[pass_as] = processed_val
-            except formencode.Invalid as e:
-                is_invalid = True
-                if self.strict_args or strict:
-                    had_strict_arg_failure = True
-                self.invalid_arg_keys.append(argname)
-                if show_msg:
-                    invalid_msg = '%s: %s' % (argname, custom_msg or str(e))
-                    user.add_message('error', invalid_msg)
-            try:
-                if is_invalid or self.calling_args[pass_as] is None or \
-                        self.calling_args[pass_as] == '':
-                    del self.calling_args[pass_as]
-            except KeyError:
-                pass
+        for argproc in chain(self.arg_processors, self._processors):
+            argname = argproc.argname
+            pass_as = argproc.pass_as
+            for validator in argproc.validators:
+                is_invalid = False
+                try:
+                    argproc.apply(self.calling_args, validator)
+                except formencode.Invalid as e:
+                    is_invalid = True
+                    if self.strict_args or argproc.strict:
+                        had_strict_arg_failure = True
+                    self.invalid_arg_keys.append(argname)
+                    if argproc.show_msg:
+                        invalid_msg = '%s: %s' % (argname, argproc.custom_msg or str(e))
+                        user.add_message('error', invalid_msg)
+                try:
+                    if is_invalid or self.calling_args[pass_as] is None or \
+                            self.calling_args[pass_as] == '':
+                        del self.calling_args[pass_as]
+                except KeyError:
+                    pass
         if len(self.invalid_arg_keys) > 0:
             log.debug('%s had bad args: %s', self.__class__.__name__, self.invalid_arg_keys)
         if had_strict_arg_failure:
             raise BadRequest('strict arg failure w/ invalid keys: %s' % self.invalid_arg_keys)
 
     def process_cm_stack(self):
+        timer = current_timer()
         # loop through all the calls requested
         for method_name, required, takes_args in self._cm_stack:
             if not hasattr(self, method_name) and not required:
                 continue
             methodobj = getattr(self, method_name)
-            if not takes_args:
-                methodobj()
-            else:
-                self._call_with_expected_args(methodobj)
+            with timer.phase('view.' + method_name):
+                if not takes_args:
+                    methodobj()
+                else:
+                    self._call_with_expected_args(methodobj)
 
     def process_action_method(self):
         # now call our "action" methods, only one of these methods will be
         # called depending on the type of request and the attributes
         # available on the view
-        http_method = rg.request.method.lower()
+        # read from the environ so views that don't use rg.request don't
+        # cause it to be created
+        environ = rg.environ
+        http_method = environ['REQUEST_METHOD'].lower()
         method_name = None
 
         # handle XHR (Ajax) requests
-        if rg.request.is_xhr:
+        if environ.get('HTTP_X_REQUESTED_WITH', '').lower() == 'xmlhttprequest':
             method_name = self.http_method_map['_xhr_']
             # if the method isn't present, treat it as a non-xhr request
             if method_name and not hasattr(self, method_name):
@@ -432,23 +551,35 @@ class View(object):
             self.retval = retval
 
     def _call_with_expected_args(self, method, method_is_bound=True):
-        log.debug('calling w/ expected: %s %s' % (method, self.calling_args))
         """ handle argument conversion to what the method accepts """
-        try:
-            # validate_arguments is made for a function, not a class method
-            # so we need to "trick" it by sending self here, but then
-            # removing it before the bound method is called below
-            pos_args = (self,) if method_is_bound else tuple()
-            args, kwargs = validate_arguments(method, pos_args, self.calling_args.copy())
-        except ArgumentValidationError as e:
-            log.error('arg validation failed: %s, %s, %s, %s',
-                      method, e.missing, e.extra, e.extra_positional)
+        log.debug('calling w/ expected: %s %s', method, self.calling_args)
+        signature = self._arg_signature(method, method_is_bound)
+        missing = signature.missing(self.calling_args)
+        if missing:
+            log.error('arg validation failed: %s, missing: %s', method, missing)
             raise BadRequest('The browser failed to transmit all '
                              'the data expected.')
-        if method_is_bound:
-            # remove "self" from args since its a bound method
-            args = args[1:]
-        return method(*args, **kwargs)
+        return method(**signature.kwargs(self.calling_args))
+
+    @classmethod
+    def _arg_signature(cls, method, method_is_bound=True):
+        """
+            Returns the _ArgSignature for method, introspecting it only the
+            first time it is seen by this class.  Bound methods are keyed on
+            their underlying function so the cache is shared by all instances.
+        """
+        func = getattr(method, '__func__', method) if method_is_bound else method
+        # each class gets its own cache, not one inherited from a parent
+        cache = cls.__dict__.get('_arg_signatures')
+        if cache is None:
+            cache = {}
+            cls._arg_signatures = cache
+        try:
+            return cache[func]
+        except KeyError:
+            signature = _ArgSignature(func, skip_first=func is not method)
+            cache[func] = signature
+            return signature
 
     def handle_response(self):
         # nothing returned is fine, I guess
@@ -623,9 +754,8 @@ class SecureView(View):
 
     def auth_calculate_any_all(self, any, all):
         # if require_all is given and there are any failures, deny authorization
-        for perm in tolist(all):
-            if not user.has_perm(perm):
-                return False
+        if not user.has_all_perms(all):
+            return False
         # if there was at least one value for require_all and not values for
         # require any, then the user is authorized
         if all and not any:
@@ -653,6 +783,61 @@ class SecureView(View):
     def not_authorized(self):
         abort(403)
 
+
+class AsyncView(View):
+    """
+        A View whose call stack and action methods may be coroutine functions
+        ("async def").  The view itself still runs in a worker thread.
+
+        When served by blazeweb.asgi.ASGIAdapter, the request is suspended
+        when the action returns a coroutine: the worker thread is given back
+        and the adapter awaits the coroutine on the server's event loop, then
+        finishes the request.  A long poll doesn't hold a worker while it
+        waits.  Coroutine call stack methods, and actions served over WSGI,
+        are handed to blazeweb.asgi.run_coroutine() and the thread waits for
+        their result.
+
+        Use the "contextvars" registry backend if the coroutines need to use
+        ag, rg, settings or user.
+    """
+    _calling_action = False
+
+    def process_action_method(self):
+        self._calling_action = True
+        try:
+            View.process_action_method(self)
+        finally:
+            self._calling_action = False
+
+    def _call_with_expected_args(self, method, method_is_bound=True):
+        retval = View._call_with_expected_args(self, method, method_is_bound)
+        if not inspect.isawaitable(retval):
+            return retval
+        if self._calling_action and self._can_suspend():
+            raise _AwaitAction(self, retval)
+        return run_coroutine(retval)
+
+    def _can_suspend(self):
+        # only the request's own response cycle is resumed, error documents
+        # wait for the coroutine in the worker thread
+        respctx = getattr(rg, 'respctx', None)
+        return asgi_loop() is not None and respctx is not None and \
+            respctx.error_doc_code is None
+
+    def resume_action(self, retval=None, error=None):
+        """
+            Finish the view once the action's coroutine is done, with its
+            return value or the exception it raised.  Returns the response.
+        """
+        try:
+            if error is not None:
+                raise error
+            if retval is not None:
+                self.retval = retval
+        except _ViewCallStackAbort:
+            pass
+        return self.handle_response()
+
 """
     functions and classes related to processing functions as views
 """
@@ -670,6 +855,7 @@ def asview(rule=None, **options):
         lrule = rule
         fname = f.__name__
         getargs = options.pop('getargs', [])
+        uses_session = options.pop('uses_session', True)
         component_prefix = _calc_component_name(f.__module__)
 
         # calculate the endpoint
@@ -689,7 +875,10 @@ def asview(rule=None, **options):
         # create the class that will handle this function if it doesn't already
         # exist in the cache
         if cachekey not in CLASS_CACHE:
-            fvh = type(fname, (_AsViewHandler, ), {})
+            if inspect.iscoroutinefunction(f):
+                fvh = type(fname, (_AsViewHandler, AsyncView), {})
+            else:
+                fvh = type(fname, (_AsViewHandler, ), {})
             fvh.__module__ = f.__module__
 
             # make the getargs available
@@ -708,6 +897,7 @@ def asview(rule=None, **options):
         def defmethod(self):
             return self._call_with_expected_args(f, method_is_bound=False)
         fvh.default = defmethod
+        fvh.uses_session = uses_session
 
         # return the class instead of the function
         return fvh
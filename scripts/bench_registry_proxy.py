@@ -0,0 +1,37 @@
+"""
+Microbenchmark for attribute access through the registry proxies (ag, rg,
+settings, user) with the "paste" and "contextvars" backends.
+
+    python scripts/bench_registry_proxy.py [accesses]
+"""
+import sys
+import timeit
+
+from blazeutils.datastructures import BlankObject
+
+from blazeweb.registry import registry_backends
+
+
+def main(number=1000000):
+    for backend, proxy_class in sorted(registry_backends.items()):
+        proxy = proxy_class(name='bench')
+        obj = BlankObject()
+        obj.attr = 1
+        proxy._push_object(obj)
+
+        def access():
+            return proxy.attr
+
+        def push_pop():
+            proxy._push_object(obj)
+            proxy._pop_object(obj)
+
+        for name, func, count in (('attribute access', access, number),
+                                  ('push + pop', push_pop, number // 10)):
+            best = min(timeit.repeat(func, number=count, repeat=3))
+            print('%-12s %-18s %6.0f nsec' % (backend, name, best / count * 1000000000))
+        proxy._pop_object(obj)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
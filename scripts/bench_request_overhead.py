@@ -0,0 +1,49 @@
+"""
+Microbenchmark for the per-request overhead of the framework.
+
+Calls a trivial view (minimal1's helloworld) through the minimal WSGI stack
+and times RequestManager's setup/teardown on its own.  Run from the root of
+the repository:
+
+    python scripts/bench_request_overhead.py [requests]
+"""
+from os import path
+import sys
+import timeit
+
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), 'tests', 'apps'))
+
+from paste.registry import Registry  # noqa
+from werkzeug.test import EnvironBuilder  # noqa
+
+from minimal1.application import app, wsgiapp  # noqa
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def main(number=20000):
+    base_environ = EnvironBuilder('/helloworld').get_environ()
+
+    def full_request():
+        b''.join(wsgiapp(dict(base_environ), start_response))
+
+    registry = Registry()
+    registry.prepare()
+
+    def request_manager():
+        environ = dict(base_environ)
+        environ['paste.registry'] = registry
+        with app.request_manager(environ):
+            pass
+
+    for name, func in (('full request', full_request),
+                       ('RequestManager enter/exit', request_manager)):
+        func()
+        best = min(timeit.repeat(func, number=number, repeat=3))
+        print('%-28s %8.1f usec/request' % (name, best / number * 1000000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
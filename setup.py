@@ -56,16 +56,16 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
         'Topic :: Internet :: WWW/HTTP'
     ],
     license='BSD',
+    python_requires='>=3.7',
     packages=find_packages(exclude=['tests']),
     include_package_data=True,
     install_requires=required_packages,
-    extras_require={'develop': develop_requires},
+    extras_require={'develop': develop_requires, 'brotli': ['Brotli']},
     entry_points="""
     [console_scripts]
     bw = blazeweb.scripting:blazeweb_entry
@@ -83,7 +83,10 @@ setup(
     shell = blazeweb.commands:ShellCommand
     routes = blazeweb.commands:RoutesCommand
     static-copy = blazeweb.commands:StaticCopyCommand
+    jinja-precompile = blazeweb.commands:JinjaPrecompileCommand
     component-map = blazeweb.commands:ComponentMapCommand
+    timing-stats = blazeweb.commands:TimingStatsCommand
+    profile-report = blazeweb.commands:ProfileReportCommand
 
 
     [blazeweb.blazeweb_project_template]
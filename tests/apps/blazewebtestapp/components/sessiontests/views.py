@@ -27,3 +27,11 @@ class RegenId(View):
 
     def default(self):
         sess_regenerate_id()
+
+
+class AddItem(View):
+
+    def default(self, item):
+        # changed in place, not assigned again
+        rg.session.setdefault('items', []).append(item)
+        return ','.join(rg.session['items'])
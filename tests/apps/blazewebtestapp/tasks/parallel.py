@@ -0,0 +1,30 @@
+import threading
+
+from blazeweb.tasks import depends_on
+
+calls = []
+free_called = threading.Event()
+
+
+def action_010_slow():
+    # returns True if action_030_free was called while this one was running
+    called = free_called.wait(5)
+    calls.append('010_slow')
+    return called
+
+
+def action_020_after():
+    calls.append('020_after')
+    return 'after'
+
+
+@depends_on('action_020_after')
+def action_020_needs_after():
+    calls.append('020_needs_after')
+
+
+@depends_on()
+def action_030_free():
+    free_called.set()
+    calls.append('030_free')
+    return 'free'
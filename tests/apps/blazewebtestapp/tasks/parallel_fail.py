@@ -0,0 +1,9 @@
+calls = []
+
+
+def action_010_fails():
+    raise ValueError('action failed')
+
+
+def action_020_not_called():
+    calls.append('020_not_called')
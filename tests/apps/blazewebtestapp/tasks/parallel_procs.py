@@ -0,0 +1,9 @@
+import os
+
+
+def action_010_pid():
+    return os.getpid()
+
+
+def action_020_pid():
+    return os.getpid()
@@ -1,4 +1,8 @@
-from blazeweb.views import asview
+import asyncio
+
+from werkzeug.exceptions import abort
+
+from blazeweb.views import asview, forward
 from blazeweb.wrappers import Response
 
 
@@ -77,3 +81,36 @@ def returnwsgiapp():
         start_response('200 OK', [('Content-Type', 'text/html')])
         return [b'wsgi hw']
     return hello_world
+
+
+@asview('/asynchello/<tome>')
+async def asynchello(tome):
+    await asyncio.sleep(0)
+    return 'async %s' % tome
+
+
+# one item for each asyncgather() request that is waiting
+gathered = []
+
+
+@asview('/asyncgather/<int:count>')
+async def asyncgather(count):
+    # waits until `count` requests are waiting at the same time
+    gathered.append(True)
+    for _ in range(500):
+        if len(gathered) >= count:
+            return 'together'
+        await asyncio.sleep(0.01)
+    return 'alone'
+
+
+@asview('/asyncforward/<tome>')
+async def asyncforward(tome):
+    await asyncio.sleep(0)
+    forward('asynchello', tome=tome)
+
+
+@asview('/asyncabort')
+async def asyncabort():
+    await asyncio.sleep(0)
+    abort(403)
@@ -0,0 +1,7 @@
+from blazeweb.config import ComponentSettings
+
+
+class Settings(ComponentSettings):
+
+    def init(self):
+        self.add_route('/brokenviews', 'brokenviews:Broken')
@@ -0,0 +1,10 @@
+from blazeweb.views import View
+
+# a bug at import time, only the views of this module should fail
+undefined_name  # noqa
+
+
+class Broken(View):
+
+    def default(self):
+        return 'not reached'
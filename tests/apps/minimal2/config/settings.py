@@ -46,6 +46,14 @@ class Dispatching(Default):
         self.some_list = ['from app']
 
 
+class BrokenViews(Dispatching):
+    def init(self):
+        Dispatching.init(self)
+        self.add_component(self.app_package, 'brokenviews')
+        # only the dispatch table imports the views modules
+        self.auto_load_views = False
+
+
 class BeakerSessions(Dispatching):
     def init(self):
         Dispatching.init(self)
@@ -82,6 +90,15 @@ class TestStorageDir(Default):
         return DefaultSettings.get_storage_dir(self)
 
 
+class Timing(Default):
+    def init(self):
+        Default.init(self)
+
+        self.timing.enabled = True
+        self.timing.server_timing_header = True
+        self.timing.dump_interval = 3600
+
+
 class NoAutoImportView(Default):
     def init(self):
         Default.init(self)
@@ -59,3 +59,27 @@ def session3():
 @asview()
 def eventtest():
     return 'foo'
+
+
+@asview()
+def readuser():
+    return 'authenticated: %s' % user.is_authenticated
+
+
+@asview()
+def writeuser():
+    user.add_message('notice', 'saved')
+    return ''
+
+
+@asview(uses_session=False)
+def sessionless():
+    assert rg.session is None
+    user.add_message('notice', 'not saved')
+    return 'hello sessionless!'
+
+
+@asview(uses_session=False)
+def sessionlessforward():
+    user.add_message('notice', 'not saved')
+    forward('writeuser')
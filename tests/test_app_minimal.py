@@ -67,6 +67,11 @@ class TestMinimal1(object):
         r = self.ta.get('/returnwsgiapp')
         r.mustcontain('wsgi hw')
 
+    def test_async_view(self):
+        # outside of the ASGI adapter, the coroutine gets its own event loop
+        r = self.ta.get('/asynchello/world')
+        r.mustcontain('async world')
+
 
 class TestMinimal2(object):
 
@@ -3,6 +3,8 @@ from nose.tools import eq_
 from webtest import TestApp
 
 from blazeweb.globals import settings, ag, rg
+from blazeweb.testing import inrequest
+from blazeweb.wrappers import Request
 
 from newlayout.application import make_wsgi
 from minimal2.application import make_wsgi as m2_make_wsgi
@@ -88,6 +90,61 @@ def test_environ_hooks():
     r.mustcontain('foo')
 
 
+class TestLazyRequestGlobals(object):
+
+    @classmethod
+    def setup_class(cls):
+        make_wsgi()
+
+    @inrequest('/foo?bar=baz')
+    def test_lazy_attributes(self):
+        rgobj = rg._current_obj()
+        assert 'ident' not in vars(rgobj)
+        assert 'request' not in vars(rgobj)
+
+        ident = rg.ident
+        eq_(len(ident), 12)
+        assert rg.ident is ident
+
+        assert isinstance(rg.request, Request)
+        assert rg.request is rg.request
+        eq_(rg.request.args['bar'], 'baz')
+        assert rg.request.environ is rg.environ
+
+        eq_(rg.session, None)
+        eq_(rg.exception_handler, None)
+        try:
+            rg.notthere
+            assert False
+        except AttributeError:
+            pass
+
+    @inrequest()
+    def test_bound_request(self):
+        # creating a request binds it to rg, like before
+        req = Request(rg.environ)
+        assert rg.request is req
+
+    def test_plain_view_does_not_create_request(self):
+        created = []
+
+        class TrackingRequest(Request):
+            def __init__(self, *args, **kwargs):
+                created.append(self)
+                Request.__init__(self, *args, **kwargs)
+
+        import blazeweb.application
+        from minimal1.application import wsgiapp
+        orig_request = blazeweb.application.Request
+        blazeweb.application.Request = TrackingRequest
+        try:
+            ta = TestApp(wsgiapp)
+            ta.get('/helloworld').mustcontain('Hello World')
+        finally:
+            blazeweb.application.Request = orig_request
+        eq_(created, [])
+
+
 class TestUserSessionInteraction(object):
 
     @classmethod
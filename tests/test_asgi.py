@@ -0,0 +1,169 @@
+import asyncio
+
+from nose.tools import eq_
+
+from blazeweb.asgi import ASGIAdapter
+
+from minimal1.application import wsgiapp, settings
+settings.apply_test_settings()
+
+
+def asgi_request(app, path, method='GET', body_chunks=(b'',), headers=(), query_string=b''):
+    """
+        Send one request through an ASGI app and return the messages it sent
+    """
+    return asyncio.run(asgi_call(app, path, method, body_chunks, headers, query_string))
+
+
+async def asgi_call(app, path, method='GET', body_chunks=(b'',), headers=(), query_string=b''):
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'root_path': '',
+        'query_string': query_string,
+        'headers': list(headers),
+        'server': ('testserver', 80),
+        'client': ('127.0.0.1', 5000),
+    }
+    incoming = [{'type': 'http.request', 'body': chunk, 'more_body': True}
+                for chunk in body_chunks]
+    incoming[-1]['more_body'] = False
+    sent = []
+
+    async def receive():
+        return incoming.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent
+
+
+def response_body(sent):
+    return b''.join(m['body'] for m in sent if m['type'] == 'http.response.body')
+
+
+class TestASGIAdapter(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.app = ASGIAdapter(wsgiapp, max_workers=2)
+
+    def test_get(self):
+        sent = asgi_request(self.app, '/helloworld')
+        eq_(sent[0]['type'], 'http.response.start')
+        eq_(sent[0]['status'], 200)
+        assert (b'content-type', b'text/html; charset=utf-8') in sent[0]['headers']
+        eq_(response_body(sent), b'Hello World')
+        assert sent[-1]['more_body'] is False
+
+    def test_query_string(self):
+        sent = asgi_request(self.app, '/cooler/hot', query_string=b'foo=1&bar=2')
+        eq_(response_body(sent), b'1, 2, hot, None')
+
+    def test_not_found(self):
+        sent = asgi_request(self.app, '/nothere')
+        eq_(sent[0]['status'], 404)
+
+    def test_async_view(self):
+        sent = asgi_request(self.app, '/asynchello/world')
+        eq_(sent[0]['status'], 200)
+        eq_(response_body(sent), b'async world')
+
+    def test_async_view_releases_worker(self):
+        from minimal1 import views
+        del views.gathered[:]
+        app = ASGIAdapter(wsgiapp, max_workers=1)
+
+        async def requests():
+            return await asyncio.gather(*[asgi_call(app, '/asyncgather/4') for _ in range(4)])
+        responses = asyncio.run(requests())
+        # all four coroutines were waiting at once with a single worker thread
+        eq_([response_body(sent) for sent in responses], [b'together'] * 4)
+
+    def test_async_forward(self):
+        sent = asgi_request(self.app, '/asyncforward/there')
+        eq_(response_body(sent), b'async there')
+
+    def test_async_abort(self):
+        sent = asgi_request(self.app, '/asyncabort')
+        eq_(sent[0]['status'], 403)
+
+    def test_async_view_lazy_middleware(self):
+        def lazy(environ, start_response):
+            for chunk in wsgiapp(environ, start_response):
+                yield chunk
+        sent = asgi_request(ASGIAdapter(lazy), '/asynchello/lazy')
+        eq_(response_body(sent), b'async lazy')
+
+    def test_request_body_and_environ(self):
+        seen = {}
+
+        def app(environ, start_response):
+            seen.update(environ)
+            body = environ['wsgi.input'].read()
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [body.upper()]
+        sent = asgi_request(
+            ASGIAdapter(app),
+            '/app/post/é',
+            method='POST',
+            body_chunks=(b'foo=', b'bar'),
+            headers=[(b'content-type', b'application/x-www-form-urlencoded'),
+                     (b'content-length', b'7'), (b'x-test', b'a'), (b'x-test', b'b')],
+        )
+        eq_(response_body(sent), b'FOO=BAR')
+        eq_(seen['REQUEST_METHOD'], 'POST')
+        eq_(seen['PATH_INFO'], '/app/post/é'.encode('utf-8').decode('latin-1'))
+        eq_(seen['CONTENT_TYPE'], 'application/x-www-form-urlencoded')
+        eq_(seen['CONTENT_LENGTH'], '7')
+        eq_(seen['HTTP_X_TEST'], 'a,b')
+        eq_(seen['REMOTE_ADDR'], '127.0.0.1')
+        eq_(seen['SERVER_NAME'], 'testserver')
+
+    def test_streaming(self):
+        closed = []
+
+        class Body(object):
+            def __iter__(self):
+                yield b'one'
+                yield b''
+                yield b'two'
+
+            def close(self):
+                closed.append(True)
+
+        def app(environ, start_response):
+            write = start_response('200 OK', [('Content-Type', 'text/plain')])
+            write(b'zero')
+            return Body()
+        sent = asgi_request(ASGIAdapter(app), '/')
+        eq_([m['type'] for m in sent], ['http.response.start'] + ['http.response.body'] * 4)
+        eq_([m['body'] for m in sent[1:]], [b'zero', b'one', b'two', b''])
+        eq_([m['more_body'] for m in sent[1:]], [True, True, True, False])
+        eq_(closed, [True])
+
+    def test_app_error(self):
+        def app(environ, start_response):
+            raise ValueError('broken')
+        sent = asgi_request(ASGIAdapter(app), '/')
+        eq_(sent[0]['status'], 500)
+
+    def test_lifespan(self):
+        app = ASGIAdapter(wsgiapp)
+        incoming = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return incoming.pop(0)
+
+        async def send(message):
+            sent.append(message)
+        asyncio.run(app({'type': 'lifespan'}, receive, send))
+        eq_([m['type'] for m in sent],
+            ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from nose.tools import eq_
+
+from blazeweb.bulkmail import BulkMailer, Checkpoint, MessageTemplate, Throttle, send_bulk_mail
+from blazeweb.globals import settings
+from blazeweb.mail import smtp_pool
+from . import config
+from .test_mail import StandInSMTP
+
+
+class TestBulkMail(unittest.TestCase):
+    def setUp(self):
+        self.app = config.make_wsgi()
+        self.smtpd = StandInSMTP()
+        settings.smtp.port = self.smtpd.port
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        smtp_pool.clear()
+        self.smtpd.stop()
+        shutil.rmtree(self.tmpdir)
+        self.app = None
+
+    def recipients(self, count):
+        return [('user%d@example.com' % num, {'name': 'user_%d' % num}) for num in range(count)]
+
+    def test_template(self):
+        template = MessageTemplate('Hi $name', '**${name}** & $amount',
+                                   format='markdown', attachments=[('a.txt', 'attached')])
+        message = template.render('to@example.com', {'name': 'first_last', 'amount': '<5>'})
+        eq_(message.subject, 'Hi first_last')
+        eq_(message.to, ['to@example.com'])
+        eq_(message.body, '**first_last** & <5>')
+        html = message.attachments[-1][1]
+        assert '<strong>first_last</strong> &amp; &lt;5&gt;' in html, html
+        # encoded once, shared by the messages
+        other = template.render('other@example.com', {'name': 'other', 'amount': 1})
+        assert message.attachments[0] is other.attachments[0]
+        eq_(other.message().get_payload()[1].get_payload(decode=True), b'attached')
+
+    def test_send(self):
+        result = send_bulk_mail('Hi $name', 'Dear $name', self.recipients(25), connections=3,
+                                batch_size=4)
+        eq_(result.sent, 25)
+        eq_(result.errors, [])
+        assert result.complete
+        eq_(len(self.smtpd.messages), 25)
+        bodies = sorted(data.split(b'\n\n', 1)[1].strip() for _, _, data in self.smtpd.messages)
+        eq_(bodies[0], b'Dear user_0')
+        # a new connection after each batch
+        assert 7 <= self.smtpd.connections <= 9, self.smtpd.connections
+
+    def test_errors(self):
+        self.smtpd.refuse = ['user1@']
+        recipients = self.recipients(3) + [('user3@example.com', {})]
+        recipients[2] = (['user2@example.com', 'user1@example.com'], {'name': 'both'})
+        result = send_bulk_mail('Hi', 'Dear $name', recipients, connections=2)
+        eq_(result.sent, 2)
+        eq_(sorted(index for index, to, exc in result.errors), [1, 3])
+        errors = dict((index, exc) for index, to, exc in result.errors)
+        assert isinstance(errors[3], KeyError)
+        eq_(list(result.refused.keys()), ['user1@example.com'])
+        eq_(result.refused['user1@example.com'][0], 550)
+        assert result.complete
+
+    def test_checkpoint(self):
+        fpath = os.path.join(self.tmpdir, 'send.done')
+        self.smtpd.mail_reply = '451 try again later'
+        mailer = BulkMailer(MessageTemplate('Hi', 'Dear $name'), connections=2,
+                            checkpoint=fpath)
+        result = mailer.send(self.recipients(5))
+        eq_(result.sent, 0)
+        eq_(len(result.errors), 5)
+        assert not result.complete
+        eq_(Checkpoint(fpath).done, set())
+
+        # two were sent before the process got killed
+        with open(fpath, 'w') as fh:
+            fh.write('0\n3\n4')
+        self.smtpd.mail_reply = '250 OK'
+        result = mailer.send(self.recipients(5))
+        eq_(result.skipped, 2)
+        eq_(result.sent, 3)
+        assert result.complete
+        assert not os.path.exists(fpath)
+
+    def test_thread_failures(self):
+        fpath = os.path.join(self.tmpdir, 'send.done')
+        with open(fpath, 'w') as fh:
+            fh.write('0\n')
+        mailer = BulkMailer(MessageTemplate('Hi', 'Dear $name'), connections=2,
+                            checkpoint=fpath)
+
+        def wait():
+            raise IOError('no space left on device')
+        mailer.throttle.wait = wait
+        result = mailer.send(self.recipients(5))
+        eq_(result.sent, 0)
+        eq_(len(result.failures), 2)
+        assert not result.complete
+        eq_(Checkpoint(fpath).done, set([0]))
+
+        def recipients():
+            yield 'user0@example.com', {'name': 'user_0'}
+            raise ValueError('the database went away')
+        result = send_bulk_mail('Hi', 'Dear $name', recipients(), connections=2)
+        eq_(result.sent, 1)
+        eq_([type(e) for e in result.failures], [ValueError])
+        assert not result.complete
+
+    def test_throttle(self):
+        throttle = Throttle(50)
+        start = time.time()
+        for num in range(6):
+            throttle.wait()
+        assert time.time() - start >= 0.09
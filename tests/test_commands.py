@@ -33,7 +33,10 @@ def test_app_usage():
     assert 'tasks' in result.stdout
     assert 'shell' in result.stdout
     assert 'static-copy' in result.stdout
+    assert 'jinja-precompile' in result.stdout
     assert 'component-map' in result.stdout, result.stdout
+    assert 'timing-stats' in result.stdout
+    assert 'profile-report' in result.stdout
 
 
 def test_bad_profile():
@@ -74,6 +77,11 @@ def test_app_testrun():
     assert indexstr not in res.stdout.replace('\r\n', '\n')
 
 
+def test_app_jinja_precompile():
+    res = run_application('minimal2', 'jinja-precompile')
+    assert 'templates compiled to' in res.stdout, res.stdout
+
+
 def test_app_tasks():
     res = run_application('minimal2', 'tasks', expect_error=True)
     assert 'You must provide at least 1 argument' in res.stdout
@@ -89,12 +97,71 @@ def test_app_tasks():
     assert 'appstack.tasks.init_data:action_010' in res.stdout
     assert 'doit' not in res.stdout
 
+    res = run_application('minimal2', 'tasks', 'init_data', '-w', '2')
+    assert 'doit' in res.stdout
+    assert '--- Done: appstack.tasks.init_data:action_010 in ' in res.stdout, res
+
 
 def test_app_routes():
     res = run_application('minimal2', 'routes')
     assert "'/'" in res.stdout, res.stdout
 
 
+def test_app_timing_stats():
+    from blazeweb.timing import RequestTimer, TimingStats
+    from minimal2.config.settings import Default
+
+    res = run_application('minimal2', 'timing-stats')
+    assert 'no timing stats found' in res.stdout, res.stdout
+
+    # run_application() clears the test output directory, so write the stats
+    # afterwards and run the command directly
+    dump_dir = Default().timing.dir
+    if not os.path.isdir(dump_dir):
+        os.makedirs(dump_dir)
+    timer = RequestTimer()
+    timer.endpoint = 'index'
+    timer.finish()
+    stats = TimingStats()
+    stats.record(timer)
+    stats.dump(os.path.join(dump_dir, 'test.json'))
+    res = env.run('python', 'application.py', 'timing-stats', '--reset',
+                  cwd=os.path.join(here, 'apps', 'minimal2'))
+    assert 'index' in res.stdout, res.stdout
+    assert 'p95 ms' in res.stdout
+    assert os.listdir(dump_dir) == []
+
+
+def test_app_profile_report():
+    from minimal2.config.settings import Default
+
+    res = run_application('minimal2', 'profile-report')
+    assert 'no profiles found' in res.stdout, res.stdout
+
+    profile_dir = os.path.join(Default().profiling.dir, 'index')
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    for fname in ('1.collapsed', '2.collapsed'):
+        with open(os.path.join(profile_dir, fname), 'w') as fh:
+            fh.write('index (views.py:5);render (content.py:10) 3\nindex (views.py:5) 1\n')
+    output_dir = os.path.join(script_test_path, 'merged-profiles')
+    res = env.run('python', 'application.py', 'profile-report', '-o', output_dir,
+                  cwd=os.path.join(here, 'apps', 'minimal2'))
+    assert 'index (2 collapsed profiles)' in res.stdout, res.stdout
+    assert '75.0    75.0  render (content.py:10)' in res.stdout, res.stdout
+    assert '25.0   100.0  index (views.py:5)' in res.stdout
+    with open(os.path.join(output_dir, 'index.collapsed')) as fh:
+        eq_(fh.read(), 'index (views.py:5) 2\nindex (views.py:5);render (content.py:10) 6\n')
+
+
+def test_app_session_sweep():
+    res = run_application('minimal2', 'tasks', 'session-sweep')
+    assert 'sessions are not file based or have no timeout' in res.stdout, res.stdout
+
+    res = run_application('minimal2', '-p', 'BeakerSessions', 'tasks', 'session-sweep')
+    assert '0 of 0 session files removed' in res.stdout, res.stdout
+
+
 if six.PY2:
     class TestProjectCommands(object):
         def check_command(self, projname, template, file_count, look_for, expect_stderr=False):
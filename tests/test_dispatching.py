@@ -1,7 +1,11 @@
 import sys
 
+from blazeutils.testing import logging_handler
+from nose.tools import eq_
 from webtest import TestApp
 
+import blazeweb.application
+from blazeweb.globals import ag
 from minimal2.application import make_wsgi
 
 
@@ -39,6 +43,46 @@ class TestAltStack(object):
         r = self.ta.get('/news/display')
         r.mustcontain('np4 display')
 
+    def test_dispatch_table(self):
+        assert ag.dispatch_table['workingview'].__name__ == 'workingview'
+        assert ag.dispatch_table['news:newsindex'].__name__ == 'newsindex'
+
+        # routed views should not need a hierarchy lookup during the request
+        orig_findview = blazeweb.application.findview
+
+        def findview(endpoint):
+            raise AssertionError('findview() called for %s' % endpoint)
+        blazeweb.application.findview = findview
+        try:
+            r = self.ta.get('/workingview')
+            r.mustcontain('hello foo!')
+        finally:
+            blazeweb.application.findview = orig_findview
+
+    def test_dispatch_table_lazy_fallback(self):
+        del ag.dispatch_table['page2']
+        r = self.ta.get('/page1')
+        r.mustcontain('page2!')
+        assert ag.dispatch_table['page2'].__name__ == 'page2'
+
+
+class TestBrokenViews(object):
+
+    def test_broken_views_module(self):
+        eh = logging_handler('blazeweb.application')
+        wsgiapp = make_wsgi('BrokenViews', use_session=False)
+        assert 'brokenviews:Broken' not in ag.dispatch_table
+        warnings = ''.join(eh.messages['warning'])
+        assert 'dispatch table skipping brokenviews:Broken' in warnings, warnings
+        eh.reset()
+
+        # the application starts, the broken view fails when requested
+        try:
+            TestApp(wsgiapp).get('/brokenviews')
+            assert False
+        except NameError as e:
+            assert 'undefined_name' in str(e), e
+
 
 class TestAltStackWithSession(object):
 
@@ -64,3 +108,40 @@ class TestAltStackWithSession(object):
         # get a new ta so that the cookie is different
         nta = TestApp(self.wsgiapp)
         nta.get('/session3')
+
+    def test_reading_user_does_not_start_session(self):
+        ta = TestApp(self.wsgiapp)
+        r = ta.get('/readuser')
+        r.mustcontain('authenticated: False')
+        assert 'Set-Cookie' not in r.headers
+        assert r.session.accessed() is False
+
+    def test_changed_user_starts_session(self):
+        ta = TestApp(self.wsgiapp)
+        r = ta.get('/writeuser')
+        assert 'Set-Cookie' in r.headers
+        assert r.session['__blazeweb_user'] is r.user
+
+        # the user is loaded from the session on the next request
+        r = ta.get('/readuser')
+        assert 'Set-Cookie' not in r.headers
+        eq_([msg.text for msg in r.user.get_messages()], ['saved'])
+
+    def test_view_without_session(self):
+        ta = TestApp(self.wsgiapp)
+        r = ta.get('/sessionless')
+        r.mustcontain('hello sessionless!')
+        assert 'Set-Cookie' not in r.headers
+        assert r.session is None
+
+        # an existing session is not loaded either
+        ta.get('/session1')
+        r = ta.get('/sessionless')
+        assert r.session is None
+
+    def test_forward_to_view_with_session(self):
+        ta = TestApp(self.wsgiapp)
+        r = ta.get('/sessionlessforward')
+        assert 'Set-Cookie' in r.headers
+        assert r.session['__blazeweb_user'] is r.user
+        eq_([msg.text for msg in r.user.get_messages()], ['saved'])
@@ -7,7 +7,7 @@ from nose.tools import eq_
 from blazeweb.globals import ag
 from blazeweb.hierarchy import findview, HierarchyImportError, findfile, \
     FileNotFound, findobj, listcomponents, list_component_mappings, visitmods, \
-    gatherobjs, findcontent
+    gatherobjs, findcontent, HierarchyCache
 
 from newlayout.application import make_wsgi
 from blazewebtestapp.applications import make_wsgi as pta_make_wsgi
@@ -250,6 +250,57 @@ class TestMostStuff(object):
         assert 'in cache' in dmesgs, dmesgs
         eh.reset()
 
+    def test_findfile_negative_cache(self):
+        stats = ag.hierarchy_file_cache.stats()
+        eh = logging_handler('blazeweb.hierarchy')
+        for _ in range(2):
+            try:
+                findfile('templates/negcache.txt')
+                assert False
+            except FileNotFound:
+                pass
+        dmesgs = ''.join(eh.messages['debug'])
+        assert 'templates/negcache.txt in cache as not found' in dmesgs, dmesgs
+        eq_(ag.hierarchy_file_cache.stats()['misses'], stats['misses'] + 1)
+        eq_(ag.hierarchy_file_cache.stats()['negative_hits'], stats['negative_hits'] + 1)
+
+        # stale misses are dropped when the component map changes
+        ag.hierarchy_file_cache.missing_mapkey = ('stale', )
+        try:
+            findfile('templates/negcache.txt')
+            assert False
+        except FileNotFound:
+            pass
+        eq_(ag.hierarchy_file_cache.stats()['misses'], stats['misses'] + 2)
+
+        # the component map is only snapshotted once for the settings
+        mapkey = ag.hierarchy_file_cache.component_map_key()
+        assert ag.hierarchy_file_cache.component_map_key() is mapkey
+
+    def test_import_negative_cache(self):
+        stats = ag.hierarchy_import_cache.stats()
+        for _ in range(2):
+            try:
+                findview('news:NotThereNegCache')
+                assert False
+            except HierarchyImportError as e:
+                assert 'View endpoint "news:NotThereNegCache" was not found' in str(e), e
+        assert 'compstack.news.views:NotThereNegCache' in ag.hierarchy_import_cache.missing
+        eq_(ag.hierarchy_import_cache.stats()['negative_hits'], stats['negative_hits'] + 1)
+
+    def test_hierarchy_cache_lru(self):
+        cache = HierarchyCache(max_missing=2)
+        cache.add_missing('a')
+        cache.add_missing('b')
+        eq_(cache.lookup('a'), (True, None))
+        cache.add_missing('c')
+        eq_(list(cache.missing), ['a', 'c'])
+        eq_(cache.lookup('b'), (False, None))
+        cache['b'] = 'found'
+        eq_(cache.lookup('b'), (True, 'found'))
+        eq_(cache.stats(), {'hits': 1, 'negative_hits': 1, 'misses': 1, 'size': 1,
+                            'missing_size': 2})
+
     def test_findobj(self):
         view = findobj('news:views.FakeView')
         assert 'newlayout.components.news.views.FakeView' in str(view), view
@@ -1,15 +1,27 @@
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
 import unittest
 
 import six
 
 from blazeutils.helpers import diff
 from blazeutils.testing import logging_handler
+from nose.tools import eq_
 
-from blazeweb.globals import settings
+from blazeweb.globals import ag, settings
 from . import config
+import blazeweb.mail
 from blazeweb.mail import EmailMessage, BadHeaderError, EmailMultiAlternatives, \
-    MarkdownMessage, HtmlMessage, send_mail, _mail_programmers, _mail_admins
+    MarkdownMessage, HtmlMessage, send_mail, _mail_programmers, _mail_admins, \
+    MailQueue, SMTPServer, send_mail_async, send_mass_mail_async, smtp_pool, ExceptionMailer, \
+    attachment_cache, MappedFile, SMTPConnection, get_mail_queue, start_spool_retry, \
+    send_spooled_mail
+from blazeweb.utils import ExceptionContext
 from blazeweb.exceptions import SettingsError
+from blazeweb.tasks import run_tasks
 from blazeweb.testing import mockmail
 
 ###
@@ -361,6 +373,69 @@ Content-Transfer-Encoding: quoted-printable
         assert text_part in text_message
         assert html_part in text_message
 
+    def test_attachment_cache(self):
+        attachment_cache.clear()
+
+        def message(content, filename='report.pdf'):
+            email = EmailMessage('Subject', 'body', 'from@example.com', ['to@example.com'])
+            email.attach(filename, content)
+            email.attach(content='<p>body</p>', mimetype='text/html')
+            return email.message()
+        first = message(b'%PDF\x00\xff')
+        second = message(b'%PDF\x00\xff')
+        # the file is encoded once, the alternative isn't cached
+        assert first.get_payload()[1] is second.get_payload()[1]
+        eq_((attachment_cache.hits, attachment_cache.misses), (1, 1))
+        eq_(first.get_payload()[1].get_payload(decode=True), b'%PDF\x00\xff')
+        assert message(b'other').get_payload()[1] is not first.get_payload()[1]
+        assert message(b'%PDF\x00\xff', 'b.pdf').get_payload()[1] is not \
+            first.get_payload()[1]
+
+        # the least recently used are dropped to stay under the size limit
+        attachment_cache.clear()
+        part_a = message(b'a').get_payload()[1]
+        settings.email.attachment_cache_size = attachment_cache.size * 2
+        message(b'b')
+        message(b'a')
+        message(b'c')
+        eq_(len(attachment_cache._parts), 2)
+        assert message(b'a').get_payload()[1] is part_a
+        misses = attachment_cache.misses
+        message(b'b')
+        eq_(attachment_cache.misses, misses + 1)
+        attachment_cache.clear()
+
+    def test_text_attachment_payload(self):
+        attachment_cache.clear()
+        for content in (u'hello ☃', u'hello ☃'.encode('utf-8')):
+            email = EmailMessage('Subject', 'body', 'from@example.com', ['to@example.com'])
+            email.attach('notes.txt', content)
+            part = email.message().get_payload()[1]
+            eq_(part.get_content_type(), 'text/plain')
+            eq_(part.get_payload(decode=True).decode('utf-8'), u'hello ☃')
+        attachment_cache.clear()
+
+    def test_attach_file_mapped(self):
+        attachment_cache.clear()
+        content = os.urandom(5000)
+        with tempfile.NamedTemporaryFile(suffix='.bin') as fh:
+            fh.write(content)
+            fh.flush()
+            settings.email.attachment_mmap_size = 4096
+            email = EmailMessage('Subject', 'body', 'from@example.com', ['to@example.com'])
+            email.attach_file(fh.name)
+            assert isinstance(email.attachments[0][1], MappedFile)
+            part = email.message().get_payload()[1]
+            eq_(part.get_payload(decode=True), content)
+            eq_(part.get_content_type(), 'application/octet-stream')
+
+            settings.email.attachment_mmap_size = 5001
+            email = EmailMessage('Subject', 'body', 'from@example.com', ['to@example.com'])
+            email.attach_file(fh.name)
+            eq_(email.attachments[0][1], content)
+            assert email.message().get_payload()[1] is part
+        attachment_cache.clear()
+
     def test_markdown_email(self):
         text_content = 'This is an **important** message.'
         email = MarkdownMessage('Subject', text_content, 'from@example.com', ['to@example.com'],
@@ -650,5 +725,284 @@ Bcc: </p>
         msg = email.message()
         assert msg['From'] == 'server@localhost'
 
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+
+    def say(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.say('220 localhost stand-in')
+        mail_from, rcpt_to = None, []
+        for line in self.rfile:
+            verb, _, arg = line.decode('ascii').strip().partition(' ')
+            verb = verb.upper()
+            if verb in ('EHLO', 'HELO', 'NOOP', 'RSET'):
+                self.say('250 OK')
+            elif verb == 'MAIL':
+                mail_from, rcpt_to = arg, []
+                self.say(server.mail_reply)
+            elif verb == 'RCPT':
+                if any(address in arg for address in server.refuse):
+                    self.say('550 no such user')
+                    continue
+                rcpt_to.append(arg)
+                self.say('250 OK')
+            elif verb == 'DATA':
+                self.say('354 go ahead')
+                data = []
+                for dline in self.rfile:
+                    if dline == b'.\r\n':
+                        break
+                    data.append(dline)
+                server.messages.append((mail_from, rcpt_to, b''.join(data)))
+                self.say('250 OK')
+            elif verb == 'QUIT':
+                self.say('221 bye')
+                return
+            else:
+                self.say('502 not implemented')
+
+
+class StandInSMTP(socketserver.ThreadingTCPServer):
+    """ an SMTP server on localhost that keeps the messages it gets """
+    daemon_threads = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), StandInSMTPHandler)
+        self.port = self.server_address[1]
+        self.messages = []
+        self.connections = 0
+        self.mail_reply = '250 OK'
+        # recipient addresses that are refused
+        self.refuse = []
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TestSMTPQueue(unittest.TestCase):
+    def setUp(self):
+        self.app = config.make_wsgi()
+        self.smtpd = StandInSMTP()
+        settings.smtp.port = self.smtpd.port
+        self.spool_dir = tempfile.mkdtemp()
+        settings.email.spool_dir = self.spool_dir
+        self.mail_queue = blazeweb.mail._mail_queue = MailQueue(size=10, workers=1)
+
+    def tearDown(self):
+        self.mail_queue.stop()
+        blazeweb.mail._mail_queue = None
+        smtp_pool.clear()
+        self.smtpd.stop()
+        shutil.rmtree(self.spool_dir)
+        self.app = None
+
+    def spooled(self):
+        return sorted(fname for fname in os.listdir(self.spool_dir) if fname.endswith('.msg'))
+
+    def test_connection_reused(self):
+        send_mail('one', 'email content', ['test@example.com'])
+        send_mail('two', 'email content', ['test@example.com'])
+        eq_(len(self.smtpd.messages), 2)
+        eq_(self.smtpd.connections, 1)
+        mail_from, rcpt_to, data = self.smtpd.messages[1]
+        eq_(rcpt_to, ['TO:<test@example.com>'])
+        assert b'Subject: two' in data
+
+        smtp_pool.clear()
+        settings.smtp.keepalive = 0
+        send_mail('three', 'email content', ['test@example.com'])
+        send_mail('four', 'email content', ['test@example.com'])
+        eq_(self.smtpd.connections, 3)
+
+    def test_send_async(self):
+        future = send_mail_async('async', 'email content', ['test@example.com'])
+        assert future.result(5) is True
+        assert b'Subject: async' in self.smtpd.messages[0][2]
+
+        datatuple = [('mass %d' % num, 'content', None, ['test@example.com'])
+                     for num in range(3)]
+        eq_(send_mass_mail_async(datatuple).result(5), 3)
+        eq_(len(self.smtpd.messages), 4)
+        eq_(self.mail_queue.sent, 4)
+
+    def test_refused(self):
+        self.smtpd.mail_reply = '550 no such sender'
+        future = send_mail_async('refused', 'email content', ['test@example.com'])
+        try:
+            future.result(5)
+            assert False
+        except Exception as e:
+            eq_(e.smtp_code, 550)
+        eq_(self.spooled(), [])
+
+    def test_spooled_when_down(self):
+        self.smtpd.mail_reply = '451 try again later'
+        future = send_mail_async('later', 'email content', ['test@example.com'])
+        assert future.result(5) is False
+        eq_(len(self.spooled()), 1)
+
+        # nothing is sent until the server works again
+        eq_(self.mail_queue.retry_spooled(), 0)
+        self.smtpd.mail_reply = '250 OK'
+        eq_(self.mail_queue.retry_spooled(), 1)
+        eq_(self.spooled(), [])
+        assert b'Subject: later' in self.smtpd.messages[0][2]
+
+    def test_spooled_when_full(self):
+        self.mail_queue = blazeweb.mail._mail_queue = MailQueue(size=1, workers=0)
+        first = send_mail_async('first', 'email content', ['test@example.com'])
+        second = send_mail_async('second', 'email content', ['test@example.com'])
+        assert not first.done()
+        assert second.result(0) is False
+        eq_(len(self.spooled()), 1)
+
+        # the queued message is spooled too when the queue is stopped
+        self.mail_queue.stop()
+        assert first.result(0) is False
+        eq_(len(self.spooled()), 2)
+        eq_(self.mail_queue.send_spool(self.spool_dir), 2)
+        # oldest first
+        assert b'Subject: second' in self.smtpd.messages[0][2]
+        assert b'Subject: first' in self.smtpd.messages[1][2]
+        eq_(self.spooled(), [])
+
+    def test_spool_after_restart(self):
+        other = StandInSMTP()
+        try:
+            self.smtpd.mail_reply = other.mail_reply = '451 try again later'
+            assert not send_mail_async('default', 'content', ['test@example.com']).result(5)
+            connection = SMTPConnection(port=other.port)
+            email = EmailMessage('other', 'content', None, ['test@example.com'],
+                                 connection=connection)
+            assert not email.send_async().result(5)
+            self.mail_queue.stop()
+            self.smtpd.mail_reply = other.mail_reply = '250 OK'
+
+            # a new process only knows the server of the settings
+            blazeweb.mail._mail_queue = None
+            start_spool_retry()
+            self.mail_queue = get_mail_queue()
+            eq_(self.mail_queue.spool_dirs, set([self.spool_dir]))
+            eq_(self.mail_queue.retry_spooled(), 1)
+            assert b'Subject: default' in self.smtpd.messages[0][2]
+            eq_(len(self.spooled()), 1)
+
+            self.mail_queue.register(self.spool_dir, SMTPServer(port=other.port))
+            eq_(send_spooled_mail(), 1)
+            assert b'Subject: other' in other.messages[0][2]
+            eq_(len(self.smtpd.messages), 1)
+            eq_(self.spooled(), [])
+        finally:
+            other.stop()
+
+    def test_spool_task(self):
+        self.smtpd.mail_reply = '451 try again later'
+        assert not send_mail_async('later', 'content', ['test@example.com']).result(5)
+        self.smtpd.mail_reply = '250 OK'
+        result = run_tasks('mail-spool', print_call=False)
+        eq_(result['mail-spool'], [('action_010_send', 'blazeweb.builtin_tasks.mail_spool', 1)])
+        eq_(self.spooled(), [])
+
+
+def _exception_context(message, other_place=False):
+    try:
+        if other_place:
+            raise ValueError(message)
+        raise ValueError(message)
+    except ValueError:
+        return ExceptionContext()
+
+
+class TestExceptionMailer(unittest.TestCase):
+    def setUp(self):
+        self.app = config.make_wsgi()
+        self.smtpd = StandInSMTP()
+        settings.smtp.port = self.smtpd.port
+        self.mailer = ExceptionMailer(settings._current_obj(), window=300)
+
+    def tearDown(self):
+        self.mailer.stop()
+        smtp_pool.clear()
+        self.smtpd.stop()
+        self.app = None
+
+    def subjects(self):
+        return [data.split(b'Subject: ')[1].split(b'\n')[0].strip()
+                for _, _, data in self.smtpd.messages]
+
+    def test_fingerprint(self):
+        eq_(_exception_context('a').fingerprint(), _exception_context('b').fingerprint())
+        assert _exception_context('a').fingerprint() != \
+            _exception_context('a', True).fingerprint()
+        assert 'ValueError: a' in str(_exception_context('a'))
+
+    def test_repeats_counted(self):
+        assert self.mailer.notify(_exception_context('first'))
+        assert not self.mailer.notify(_exception_context('second'))
+        assert not self.mailer.notify(_exception_context('third'))
+        assert self.mailer.notify(_exception_context('other', True))
+        self.mailer.flush()
+        eq_(self.subjects(), [b'[pysvmt test app] exception encountered'] * 2)
+        assert b'ValueError: first' in self.smtpd.messages[0][2]
+
+        # the window passes, the repeats are emailed with the last context
+        for entry in self.mailer.seen.values():
+            entry[0] -= 300
+        self.mailer.due()
+        self.mailer.flush()
+        eq_(len(self.smtpd.messages), 3)
+        eq_(self.subjects()[2], b'[pysvmt test app] exception encountered (2 times)')
+        assert b'ValueError: third' in self.smtpd.messages[2][2]
+
+        # the next one starts a new window
+        assert not self.mailer.notify(_exception_context('fourth'))
+        self.mailer.due()
+        self.mailer.flush()
+        eq_(len(self.smtpd.messages), 3)
+
+    def test_log_only(self):
+        lh = logging_handler('blazeweb.mail')
+        assert self.mailer.notify(_exception_context('first'), email=False)
+        assert not self.mailer.notify(_exception_context('second'), email=False)
+        self.mailer.flush()
+        eq_(self.smtpd.messages, [])
+        eq_(len(lh.messages['error']), 1)
+        assert 'ValueError: first' in lh.messages['error'][0], lh.messages['error']
+        lh.reset()
+
+    def test_request_logs_summary(self):
+        ag.app.ag.exception_mailer = self.mailer
+        settings.exception_handling = ['handle']
+        lh = logging_handler('blazeweb.application')
+        try:
+            raise ValueError('in the request')
+        except ValueError as e:
+            ag.app.handle_exception(e)
+        message = lh.messages['error'][0]
+        assert 'ValueError: in the request' in message, message
+        assert '\n' not in message, message
+        lh.reset()
+
+    def test_max_fingerprints(self):
+        self.mailer.max_fingerprints = 1
+        assert self.mailer.notify(_exception_context('first'))
+        assert not self.mailer.notify(_exception_context('other', True))
+        eq_(self.mailer.dropped, 1)
+
+        # room is made by forgetting fingerprints whose window has passed
+        list(self.mailer.seen.values())[0][0] -= 300
+        assert self.mailer.notify(_exception_context('other', True))
+        self.mailer.flush()
+        eq_(len(self.smtpd.messages), 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,16 @@
+import os
+import shutil
+import tempfile
+import time
+
+from nose.tools import eq_
 from webtest import TestApp
 
+from blazeweb.middleware import StaticFileCache, StaticFileServer, HttpRequestLogger, \
+    RequestProfiler, _cprofile_lock
+from blazeweb.profiling import merge_profiles, top_frames
+from blazeweb.wrappers import Response
+
 from newlayout.application import make_wsgi
 
 
@@ -36,3 +47,177 @@ class TestStaticFileServer(object):
     def test_from_external_component(self):
         r = self.ta.get('/static/component/news/statictest5.txt')
         assert 'newscomp3' in r, r
+
+
+class TestStaticFileCache(object):
+
+    @classmethod
+    def setup_class(cls):
+        make_wsgi('ForStaticFileTesting')
+
+    def setup_method(self, _):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown_method(self, _):
+        shutil.rmtree(self.tmpdir)
+
+    def test_server(self):
+        cache = StaticFileCache(1024, 1024)
+        ta = TestApp(StaticFileServer(Response('not found', status=404), memory_cache=cache))
+        r = ta.get('/static/app/statictest.txt')
+        assert 'newlayout' in r, r
+        eq_((cache.hits, cache.misses), (0, 1))
+        r = ta.get('/static/app/statictest.txt')
+        assert 'newlayout' in r, r
+        eq_((cache.hits, cache.misses), (1, 1))
+
+        r = ta.get('/static/app/statictest.txt', headers={'If-None-Match': r.headers['Etag']},
+                   status=304)
+        eq_((cache.hits, cache.misses), (2, 1))
+
+    def test_limits(self):
+        def write(fname, size):
+            fpath = os.path.join(self.tmpdir, fname)
+            with open(fpath, 'wb') as fh:
+                fh.write(b'x' * size)
+            return fpath
+
+        cache = StaticFileCache(max_bytes=100, max_file_bytes=60)
+        a = write('a', 40)
+        b = write('b', 40)
+        big = write('big', 61)
+        eq_(cache.get(a)[0], b'x' * 40)
+        cache.get(b)
+        # too big to cache, but the caller is told to read it from disk
+        assert cache.get(big) is None
+        eq_(list(cache.entries), [a, b])
+
+        # a is most recently used, so b is evicted to make room for c
+        cache.get(a)
+        c = write('c', 40)
+        cache.get(c)
+        eq_(list(cache.entries), [a, c])
+        eq_(cache.size, 80)
+
+        # changed files are reloaded
+        write('a', 50)
+        os.utime(a, (0, 0))
+        eq_(cache.get(a)[2], 50)
+        eq_(cache.size, 90)
+
+
+def body_length_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(len(body)).encode('ascii')]
+
+
+class TestHttpRequestLogger(object):
+
+    @classmethod
+    def setup_class(cls):
+        make_wsgi('ForStaticFileTesting')
+
+    def setup_method(self, _):
+        self.log_dir = tempfile.mkdtemp()
+
+    def teardown_method(self, _):
+        shutil.rmtree(self.log_dir)
+
+    def test_logging(self):
+        app = HttpRequestLogger(body_length_app, enabled=True, request_method_filter='post',
+                                max_body=5, max_files=2, log_dir=self.log_dir)
+        ta = TestApp(app)
+        # the application still gets the whole body
+        r = ta.post('/upload', b'abcdefghij')
+        eq_(r.body, b'10')
+        app.writer.flush()
+        fnames = os.listdir(self.log_dir)
+        eq_(len(fnames), 1)
+        with open(os.path.join(self.log_dir, fnames[0]), 'rb') as fh:
+            contents = fh.read()
+        assert b"'PATH_INFO': '/upload'" in contents, contents
+        assert contents.endswith(b'\nabcde\n[body truncated: 5 of 10 bytes logged]\n'), contents
+
+        # filtered out
+        ta.get('/upload')
+        app.writer.flush()
+        eq_(len(os.listdir(self.log_dir)), 1)
+
+        # only the newest max_files are kept, other files are left alone
+        with open(os.path.join(self.log_dir, 'README_first'), 'w') as fh:
+            fh.write('request logs')
+        ta.post('/upload', b'a')
+        ta.post('/upload', b'b')
+        app.writer.flush()
+        fnames = os.listdir(self.log_dir)
+        fnames.remove('README_first')
+        eq_(len(fnames), 2)
+        for fname in fnames:
+            with open(os.path.join(self.log_dir, fname), 'rb') as fh:
+                assert not fh.read().endswith(b'logged]\n')
+
+
+def sleepy_app(environ, start_response):
+    time.sleep(0.02)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'slept']
+
+
+class TestRequestProfiler(object):
+
+    @classmethod
+    def setup_class(cls):
+        make_wsgi('ForStaticFileTesting')
+
+    def setup_method(self, _):
+        self.profile_dir = tempfile.mkdtemp()
+
+    def teardown_method(self, _):
+        shutil.rmtree(self.profile_dir)
+
+    def test_collapsed(self):
+        app = RequestProfiler(sleepy_app, self.profile_dir, rate=1.0, endpoints=['news:*'],
+                              interval=0.001, max_files=2)
+        ta = TestApp(app)
+        for _ in range(3):
+            ta.get('/news').mustcontain('slept')
+        # filtered out by endpoint
+        ta.get('/applevelview/foo')
+        ta.get('/nothere')
+        eq_(os.listdir(self.profile_dir), ['news--Index'])
+        eq_(len(os.listdir(os.path.join(self.profile_dir, 'news--Index'))), 2)
+
+        merged = merge_profiles(self.profile_dir)
+        eq_(len(merged), 1)
+        endpoint, fmt, count, stacks = merged[0]
+        eq_((endpoint, fmt, count), ('news--Index', 'collapsed', 2))
+        # the stacks start at the application, not the server or middleware
+        for stack in stacks:
+            assert stack.startswith('sleepy_app ('), stack
+        frame, own, inclusive = top_frames(stacks)[0]
+        assert frame.startswith('sleepy_app (test_middleware.py:'), frame
+        eq_(own, sum(stacks.values()))
+
+    def test_pstats(self):
+        app = RequestProfiler(sleepy_app, self.profile_dir, rate=1.0, format='pstats')
+        ta = TestApp(app)
+        ta.get('/news')
+        ta.get('/nothere')
+        merged = merge_profiles(self.profile_dir)
+        eq_([m[:3] for m in merged], [('news--Index', 'pstats', 1),
+                                      ('routing-error', 'pstats', 1)])
+        funcs = [func[2] for func in merged[0][3].stats]
+        assert 'sleepy_app' in funcs, funcs
+
+    def test_pstats_one_at_a_time(self):
+        app = RequestProfiler(sleepy_app, self.profile_dir, rate=1.0, format='pstats')
+        # another request is being profiled
+        with _cprofile_lock:
+            TestApp(app).get('/news').mustcontain('slept')
+        eq_(os.listdir(self.profile_dir), [])
+
+    def test_rate(self):
+        app = RequestProfiler(sleepy_app, self.profile_dir, rate=0)
+        TestApp(app).get('/news')
+        eq_(os.listdir(self.profile_dir), [])
@@ -0,0 +1,92 @@
+import asyncio
+import contextvars
+
+from blazeutils.datastructures import BlankObject
+from nose.tools import eq_
+
+from blazeweb.exceptions import ProgrammingError
+from blazeweb.registry import ContextVarObjectProxy, StackedObjectProxy, set_proxy_backend
+from blazeweb.utils import registry_has_object
+
+
+class TestContextVarObjectProxy(object):
+
+    def test_proxy_api(self):
+        proxy = ContextVarObjectProxy(name='testproxy')
+        assert not registry_has_object(proxy)
+        try:
+            proxy.foo
+            assert False
+        except TypeError as e:
+            assert 'testproxy' in str(e), e
+
+        obj1 = BlankObject()
+        obj2 = BlankObject()
+        proxy._push_object(obj1)
+        proxy.foo = 'bar'
+        eq_(obj1.foo, 'bar')
+        proxy._push_object(obj2)
+        assert proxy._current_obj() is obj2
+        eq_(proxy._object_stack(), [obj1, obj2])
+        try:
+            proxy._pop_object(obj1)
+            assert False
+        except AssertionError:
+            pass
+        proxy._pop_object(obj2)
+        eq_(proxy.foo, 'bar')
+        # private attributes of the proxied object are still reachable
+        obj1._private = 1
+        eq_(proxy._private, 1)
+        proxy._pop_object()
+        assert not registry_has_object(proxy)
+
+    def test_default(self):
+        proxy = ContextVarObjectProxy(default=[1], name='withdefault')
+        eq_(len(proxy), 1)
+
+    def test_context_isolation(self):
+        proxy = ContextVarObjectProxy(name='isolated')
+        proxy._push_object('outer')
+
+        def in_copy():
+            proxy._push_object('inner')
+            return proxy._object_stack()
+        eq_(contextvars.copy_context().run(in_copy), ['outer', 'inner'])
+        eq_(proxy._object_stack(), ['outer'])
+        proxy._pop_object('outer')
+
+    def test_asyncio_tasks(self):
+        proxy = ContextVarObjectProxy(name='tasks')
+
+        async def handle(value):
+            proxy._push_object(value)
+            await asyncio.sleep(0)
+            # another task has pushed its own object in the meantime
+            return proxy._current_obj()
+
+        async def run():
+            return await asyncio.gather(handle('a'), handle('b'))
+        eq_(asyncio.run(run()), ['a', 'b'])
+        assert not registry_has_object(proxy)
+
+
+def test_set_proxy_backend():
+    proxy = StackedObjectProxy(name='switched')
+    set_proxy_backend(proxy, 'contextvars')
+    assert isinstance(proxy, ContextVarObjectProxy)
+    proxy._push_object('obj')
+    try:
+        set_proxy_backend(proxy, 'paste')
+        assert False
+    except ProgrammingError:
+        pass
+    proxy._pop_object()
+    set_proxy_backend(proxy, 'paste')
+    assert type(proxy) is StackedObjectProxy
+
+    try:
+        set_proxy_backend(proxy, 'notthere')
+        assert False
+    except ValueError:
+        pass
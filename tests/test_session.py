@@ -1,12 +1,19 @@
 import unittest
 
+from beaker.session import Session
+from beaker.synchronization import file_synchronizer
+from blazeweb.globals import ag
+from blazeweb.sessions import sweeper_from_settings
+from blazeweb.utils.filesystem import mkdirs
 from blazewebtestapp.applications import make_wsgi
 from werkzeug import Client
 from blazeweb.testing import TestApp
 from nose.tools import eq_
 from werkzeug.wrappers.base_response import BaseResponse
 import os
-from time import sleep
+import shutil
+import threading
+from time import sleep, time
 
 
 class TestSession(unittest.TestCase):
@@ -45,32 +52,140 @@ class TestSession(unittest.TestCase):
         r = ta.get('/sessiontests/getfoo', status=200)
         assert r.body == b'bar'
 
+    def test_session_changed_in_place(self):
+        eq_(self.client.get('/sessiontests/additem/a').data, b'a')
+        eq_(self.client.get('/sessiontests/additem/b').data, b'a,b')
+        eq_(self.client.get('/sessiontests/additem/c').data, b'a,b,c')
+
+    def test_session_saved_when_changed(self):
+        # accessed_only for each save that writes to the session store
+        saves = []
+        orig_save = Session.save
+
+        def save(session, accessed_only=False):
+            if not accessed_only or session.save_atime:
+                saves.append(accessed_only)
+            return orig_save(session, accessed_only)
+        Session.save = save
+        try:
+            self.client.get('/usertests/setfoo')
+            eq_(saves, [False])
+
+            # reading the session or user doesn't save it
+            r = self.client.get('/usertests/getfoo')
+            eq_(r.data, b'barbaz')
+            r = self.client.get('/usertests/getauth')
+            eq_(r.data, b'False')
+            eq_(saves, [False])
+
+            self.client.get('/usertests/setauth')
+            eq_(saves, [False, False])
+            self.client.get('/sessiontests/setfoo')
+            eq_(saves, [False, False, False])
+
+            # the stored user isn't marked modified, so it isn't saved again
+            r = self.client.get('/usertests/getfoo')
+            eq_(r.data, b'barbaz')
+            eq_(saves, [False, False, False])
+
+            # the accessed time is saved once touch_interval has passed
+            touch_interval = ag.app.settings.beaker.touch_interval
+            ag.app.settings.beaker.touch_interval = 0
+            try:
+                r = self.client.get('/usertests/getauth')
+                eq_(r.data, b'True')
+                eq_(saves, [False, False, False, True])
+            finally:
+                ag.app.settings.beaker.touch_interval = touch_interval
+        finally:
+            Session.save = orig_save
+
 
 class TestBeakerCleanup(unittest.TestCase):
+    def setUp(self):
+        from minimal2.application import make_wsgi as min_make_wsgi
+
+        self.wsgiapp = min_make_wsgi('BeakerSessions')
+        self.data_dir = ag.app.settings.beaker.data_dir
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+        mkdirs(self.data_dir)
+        ag.session_sweeper.interval = 0.01
+
+    def tearDown(self):
+        ag.session_sweeper.stop()
+
+    def count_files(self):
+        return len([
+            f for f in os.listdir(self.data_dir)
+            if os.path.isfile(os.path.join(self.data_dir, f))
+        ])
+
+    def make_files(self, count, age=0):
+        for i in range(count):
+            fpath = os.path.join(self.data_dir, '%s-%d' % (age, i))
+            open(fpath, 'a').close()
+            then = time() - age
+            os.utime(fpath, (then, then))
+
     def test_session_cleanup(self):
+        from blazeweb.events import clear_old_beaker_sessions
+
+        # 6 files expired, 4 within timeout
+        self.make_files(6, age=10)
+        self.make_files(4)
+        clear_old_beaker_sessions(None)
+        eq_(self.count_files(), 4)
+
+        # the application doesn't walk the sessions when it starts
+        self.make_files(6, age=10)
         from minimal2.application import make_wsgi as min_make_wsgi
-        from blazeweb.globals import settings
-
-        wsgiapp = min_make_wsgi('BeakerSessions')
-        ta = TestApp(wsgiapp)
-        ta.get('/hassession')
-
-        for i in range(10):
-            open(os.path.join(settings.beaker.data_dir, str(i)), 'a').close()
-            if i == 5:
-                # files 6, 7, 8, 9 will be within timeout
-                sleep(2)
-
-        def count_files():
-            return len([
-                f for f in os.listdir(settings.beaker.data_dir)
-                if os.path.isfile(os.path.join(settings.beaker.data_dir, f))
-            ])
-
-        assert count_files() > 5
-        wsgiapp = min_make_wsgi('BeakerSessions')
-        eq_(count_files(), 4)
-
-        # cleanup
-        for i in range(6, 10):
-            os.remove(os.path.join(settings.beaker.data_dir, str(i)))
+        min_make_wsgi('BeakerSessions')
+        eq_(self.count_files(), 10)
+
+    def test_incremental_sweep(self):
+        self.make_files(6, age=10)
+        self.make_files(4)
+        sweeper = sweeper_from_settings(ag.app.settings)
+        sweeper.batch_size = 4
+        eq_(sweeper.sweep(), 4)
+        eq_(sweeper.sweep(), 4)
+        eq_(sweeper.passes, 0)
+        eq_(sweeper.sweep(), 2)
+        eq_(sweeper.passes, 1)
+        eq_(sweeper.removed, 6)
+        eq_(self.count_files(), 4)
+
+    def test_sweep_locked(self):
+        self.make_files(6, age=10)
+        sweeper = sweeper_from_settings(ag.app.settings)
+        lock = file_synchronizer(sweeper.lock_name, lock_dir=sweeper.lock_dir)
+        # another process holding the lock, beaker's locks are per thread
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold_lock():
+            lock.acquire_write_lock()
+            locked.set()
+            release.wait()
+            lock.release_write_lock()
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        locked.wait()
+        try:
+            eq_(sweeper.sweep(), 0)
+            eq_(self.count_files(), 6)
+        finally:
+            release.set()
+            thread.join()
+        sweeper.sweep()
+        eq_(self.count_files(), 0)
+
+    def test_background_thread(self):
+        self.make_files(6, age=10)
+        TestApp(self.wsgiapp).get('/hassession')
+        assert ag.session_sweeper._thread.is_alive()
+        for _ in range(100):
+            if not self.count_files():
+                break
+            sleep(0.05)
+        eq_(self.count_files(), 0)
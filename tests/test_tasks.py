@@ -1,5 +1,8 @@
+import os
+
 from nose.tools import eq_
-from blazeweb.tasks import run_tasks
+from blazeweb.exceptions import ProgrammingError
+from blazeweb.tasks import depends_on, run_tasks, _dependencies, _run_parallel
 
 # create the wsgi application that will be used for testing
 from blazewebtestapp.applications import make_wsgi
@@ -32,6 +35,11 @@ class TestTasks(object):
                 ],
             })
 
+    def test_builtin_task(self):
+        result = run_tasks('session-sweep', print_call=False)
+        eq_([(actname, modkey) for actname, modkey, _ in result['session-sweep']],
+            [('action_010_sweep', 'blazeweb.builtin_tasks.session_sweep')])
+
     def test_notask(self):
         eq_(run_tasks('not-there', print_call=False), {'not-there': []})
 
@@ -87,3 +95,63 @@ class TestTasks(object):
                 ],
             }
         )
+
+    def test_parallel(self):
+        from blazewebtestapp.tasks import parallel
+        del parallel.calls[:]
+        parallel.free_called.clear()
+        eq_(
+            run_tasks('parallel', print_call=False, workers=2),
+            {
+                'parallel': [
+                    ('action_010_slow', 'appstack.tasks.parallel', True),
+                    ('action_020_after', 'appstack.tasks.parallel', 'after'),
+                    ('action_020_needs_after', 'appstack.tasks.parallel', None),
+                    ('action_030_free', 'appstack.tasks.parallel', 'free'),
+                ],
+            }
+        )
+        eq_(parallel.calls, ['030_free', '010_slow', '020_after', '020_needs_after'])
+
+    def test_parallel_exception(self):
+        from blazewebtestapp.tasks import parallel_fail
+        try:
+            run_tasks('parallel-fail', print_call=False, workers=2)
+            assert False
+        except ValueError as e:
+            eq_(str(e), 'action failed')
+        eq_(parallel_fail.calls, [])
+
+    def test_parallel_processes(self):
+        result = run_tasks('parallel-procs', print_call=False, workers=2, executor='process')
+        pids = [retval for _, _, retval in result['parallel-procs']]
+        eq_(len(pids), 2)
+        assert os.getpid() not in pids
+
+    def test_numeric_groups(self):
+        def action():
+            pass
+        names = ['action_1_c', 'action_2_b', 'action_10_a', 'action_other']
+        deps = _dependencies([(name, 'mod', action, None) for name in names])
+        eq_(deps, {
+            ('action_1_c', 'mod'): set(),
+            ('action_2_b', 'mod'): set([('action_1_c', 'mod')]),
+            ('action_10_a', 'mod'): set([('action_1_c', 'mod'), ('action_2_b', 'mod')]),
+            ('action_other', 'mod'): set([('action_1_c', 'mod'), ('action_2_b', 'mod'),
+                                          ('action_10_a', 'mod')]),
+        })
+
+    def test_unmet_dependencies(self):
+        @depends_on('action_b')
+        def action_a():
+            pass
+
+        @depends_on('action_a')
+        def action_b():
+            pass
+        callables = [('action_a', 'mod', action_a, None), ('action_b', 'mod', action_b, None)]
+        try:
+            _run_parallel('cycle', callables, False, 2, 'thread')
+            assert False
+        except ProgrammingError as e:
+            assert 'mod:action_a, mod:action_b can not be met' in str(e), str(e)
@@ -1,9 +1,13 @@
+from os import path
+
 from blazeutils.testing import raises
 from jinja2 import TemplateNotFound
+from jinja2.bccache import Bucket, bc_magic
 from nose.tools import eq_
 
 from blazeweb.content import getcontent
-from blazeweb.globals import user, ag, rg
+from blazeweb.exceptions import SettingsError
+from blazeweb.globals import user, ag, rg, settings
 from blazeweb.testing import inrequest
 
 
@@ -211,3 +215,100 @@ class TestContent(object):
         input = 'var foo = {{ obj | json }};'
         res = ag.tplengine.render_string(input, {'obj': {'some_key': 'This is json formatted'}})
         eq_(res, 'var foo = {"some_key": "This is json formatted"};')
+
+
+class TestBytecodeCache(object):
+
+    def test_cache_keyed_on_hierarchy_path(self):
+        from blazeweb.templating.jinja import HierarchyBytecodeCache
+        env = ag.tplengine.env
+        bcc = env.bytecode_cache
+        assert isinstance(bcc, HierarchyBytecodeCache)
+        assert bcc.directory == settings.jinja.bytecode_cache.dir
+
+        getcontent('index.html', a='foo')
+        fpath = env.loader.find_template_path('index.html')
+        assert fpath.endswith(path.join('newlayout', 'templates', 'index.html'))
+        bucket = Bucket(env, bcc.get_cache_key('index.html', fpath), '')
+        assert path.exists(bcc._get_cache_filename(bucket))
+
+    def test_unreadable_cache_file_is_a_miss(self):
+        env = ag.tplengine.env
+        bcc = env.bytecode_cache
+        fpath = env.loader.find_template_path('getcontent.html')
+        key = bcc.get_cache_key('getcontent.html', fpath)
+        with open(bcc._get_cache_filename(Bucket(env, key, '')), 'wb') as fh:
+            fh.write(bc_magic + b'garbage')
+        env.cache.clear()
+        c = getcontent('getcontent.html', endpoint='foo')
+        eq_(c.primary, 'the endpoint: foo')
+
+    def test_list_templates(self):
+        templates = ag.tplengine.env.list_templates()
+        assert 'index.html' in templates
+        # from the supporting app
+        assert 'forcache.txt' in templates
+        # components
+        assert 'news:template.html' in templates, templates
+        eq_(len(templates), len(set(templates)))
+
+    def test_precompile(self):
+        compiled, errors = ag.tplengine.precompile_templates()
+        eq_(errors, [])
+        eq_(compiled, len(ag.tplengine.env.list_templates()))
+
+
+class TestUptodateChecks(object):
+
+    def setup_method(self, method):
+        self.stats = []
+        self.orig_getmtime = path.getmtime
+
+        def getmtime(fpath):
+            self.stats.append(fpath)
+            return self.orig_getmtime(fpath)
+        path.getmtime = getmtime
+
+    def teardown_method(self, method):
+        path.getmtime = self.orig_getmtime
+
+    def uptodate(self, mode, interval=None):
+        from blazeweb.templating.jinja import HierarchyLoader
+        loader = HierarchyLoader(uptodate_checks=mode, check_interval=interval)
+        _, _, uptodate = loader.get_source(ag.tplengine.env, 'index.html')
+        return uptodate
+
+    def test_always(self):
+        uptodate = self.uptodate('always')
+        assert uptodate()
+        assert uptodate()
+        eq_(len(self.stats), 3)
+
+    def test_never(self):
+        uptodate = self.uptodate('never')
+        assert uptodate()
+        assert uptodate()
+        eq_(len(self.stats), 0)
+
+    def test_interval(self):
+        uptodate = self.uptodate('interval', 60)
+        assert uptodate()
+        eq_(len(self.stats), 1)
+        uptodate.next_check = 0
+        assert uptodate()
+        eq_(len(self.stats), 2)
+        assert uptodate()
+        eq_(len(self.stats), 2)
+
+        uptodate.next_check = 0
+        uptodate.mtime -= 1
+        assert not uptodate()
+
+    @raises(SettingsError, 'templating.uptodate_checks should be one of always, interval, never, '
+            'not "sometimes"')
+    def test_bad_mode(self):
+        self.uptodate('sometimes')
+
+    def test_default(self):
+        eq_(ag.tplengine.env.loader.uptodate_checks, 'always')
+        assert ag.tplengine.env.auto_reload
@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_
+from webtest import TestApp
+
+from blazeweb.globals import ag
+from blazeweb.timing import Histogram, NULL_TIMER, RequestTimer, TimingStats, current_timer
+
+from minimal2.application import make_wsgi
+
+
+class TestHistogram(object):
+
+    def test_observe(self):
+        hist = Histogram()
+        for ms in (0.05, 0.3, 0.3, 4, 20000):
+            hist.observe(ms)
+        eq_(hist.count, 5)
+        eq_(hist.max, 20000)
+        eq_(hist.counts[0], 1)
+        eq_(hist.counts[2], 2)
+        eq_(hist.counts[-1], 1)
+        eq_(hist.percentile(50), 0.5)
+        eq_(hist.percentile(80), 5)
+        eq_(hist.percentile(100), 20000)
+        eq_(round(hist.mean, 2), 4000.93)
+
+    def test_merge_and_serialize(self):
+        hist = Histogram()
+        hist.observe(1)
+        other = Histogram.fromdict(hist.todict())
+        other.observe(3)
+        hist.merge(other)
+        eq_(hist.count, 3)
+        eq_(hist.total, 5)
+        eq_(hist.max, 3)
+        eq_(Histogram().percentile(50), 0.0)
+
+
+class TestRequestTimer(object):
+
+    def test_phases(self):
+        timer = RequestTimer()
+        with timer.phase('one'):
+            pass
+        with timer.phase('two'):
+            pass
+        timer.add('one', 0.5)
+        timer.finish()
+        eq_(list(timer.durations), ['one', 'two', 'total'])
+        assert timer.durations['one'] >= 0.5
+        header = timer.server_timing()
+        assert header.startswith('one;dur=50'), header
+        assert ', two;dur=' in header, header
+
+    def test_no_request(self):
+        assert current_timer() is NULL_TIMER
+        with NULL_TIMER.phase('foo'):
+            pass
+
+
+class TestTimingStats(object):
+
+    def setup_method(self, _):
+        self.dump_dir = tempfile.mkdtemp()
+
+    def teardown_method(self, _):
+        shutil.rmtree(self.dump_dir)
+
+    def record(self, stats, endpoint, **durations):
+        timer = RequestTimer()
+        timer.endpoint = endpoint
+        for name, seconds in durations.items():
+            timer.add(name, seconds)
+        stats.record(timer)
+
+    def test_dump_and_load(self):
+        stats1 = TimingStats(self.dump_dir)
+        self.record(stats1, 'index', total=0.002, action=0.001)
+        self.record(stats1, None, total=0.001)
+        stats1.dump()
+        stats2 = TimingStats()
+        self.record(stats2, 'index', total=0.004)
+        stats2.dump(os.path.join(self.dump_dir, 'other.json'))
+
+        stats = TimingStats.load_dir(self.dump_dir)
+        eq_(sorted(stats.endpoints), ['(unrouted)', 'index'])
+        eq_(stats.endpoints['index']['total'].count, 2)
+        eq_(stats.endpoints['index']['total'].max, 4)
+        eq_(stats.endpoints['index']['action'].count, 1)
+
+        report = stats.report()
+        assert report.index('index') < report.index('(unrouted)'), report
+        assert 'action' in report
+        assert '(unrouted)' not in stats.report('index')
+
+    def test_load_missing_dir(self):
+        eq_(TimingStats.load_dir(os.path.join(self.dump_dir, 'nothere')).endpoints, {})
+
+
+class TestTimingRequests(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.ta = TestApp(make_wsgi('Timing'))
+        cls.stats = ag.timing_stats
+
+    def setup_method(self, _):
+        self.stats.reset()
+
+    def test_phases_recorded(self):
+        r = self.ta.get('/')
+        r.mustcontain('index')
+        phases = [part.split(';')[0] for part in r.headers['Server-Timing'].split(', ')]
+        eq_(phases, ['registry', 'url_match', 'view_init', 'process_args', 'action', 'total'])
+
+        self.ta.get('/')
+        eq_(self.stats.endpoints['index']['total'].count, 2)
+
+    def test_session_save(self):
+        self.ta.get('/session1')
+        assert 'session_save' in self.stats.endpoints['session1']
+
+    def test_not_found(self):
+        r = self.ta.get('/nothere', status=404)
+        assert 'url_match;dur=' in r.headers['Server-Timing']
+        eq_(self.stats.endpoints['(unrouted)']['total'].count, 1)
+
+    def test_disabled(self):
+        ta = TestApp(make_wsgi())
+        r = ta.get('/')
+        assert 'Server-Timing' not in r.headers
+        assert ag.timing_stats is None
@@ -1,9 +1,12 @@
+import pickle
 import unittest
 
+from nose.tools import eq_
+
 from werkzeug import Client
 from werkzeug.wrappers.base_response import BaseResponse
 
-from blazeweb.users import User, UserProxy
+from blazeweb.users import PermissionRegistry, User, UserMessage, UserProxy
 
 from blazewebtestapp.applications import make_wsgi
 
@@ -123,6 +126,76 @@ class TestUserUnit(object):
         assert u.has_any_perm(('baz', 'foobar'))
         assert u.has_any_perm(['foobar', 'baz'])
 
+    def test_all_perms(self):
+        u = User()
+        assert u.has_all_perms([])
+        assert not u.has_all_perms('foo')
+        u.add_perm('foo', 'bar')
+        assert u.has_all_perms('foo')
+        assert u.has_all_perms('foo', 'bar')
+        assert u.has_all_perms(('foo', 'bar'))
+        assert not u.has_all_perms(['foo', 'bar', 'baz'])
+        eq_(u.perms, set(['foo', 'bar']))
+
+        u.perms = ['baz']
+        eq_(u.perms, set(['baz']))
+        assert not u.has_perm('foo')
+        assert 'perms' not in u
+
+    def test_perms_set(self):
+        u = User()
+        u.mark_saved()
+        u.perms.add('foo')
+        u.perms.update(['bar', 'baz'], ('zip', ))
+        assert u.is_modified()
+        assert u.has_all_perms('foo', 'bar', 'baz', 'zip')
+        eq_(len(u.perms), 4)
+        assert 'bar' in u.perms
+
+        u.mark_saved()
+        u.perms.discard('bar')
+        u.perms.remove('baz')
+        assert u.is_modified()
+        eq_(u.perms, set(['foo', 'zip']))
+        assert not u.has_perm('bar')
+        u.mark_saved()
+        u.perms.discard('not-there')
+        assert not u.is_modified()
+
+    def test_perm_registry(self):
+        reg = PermissionRegistry()
+        eq_(reg.bit('a'), 1)
+        eq_(reg.bit('b'), 2)
+        eq_(reg.bit('a'), 1)
+        eq_(reg.mask(['a', 'c']), 5)
+        eq_(reg.mask('b'), 2)
+        eq_(reg.mask(()), 0)
+        eq_(reg.names(7), set(['a', 'b', 'c']))
+
+        # checking a permission no one has doesn't give it a bit
+        eq_(reg.known_mask(['a', 'd']), (1, False))
+        eq_(reg.known_mask('b', ['c']), (6, True))
+        assert 'd' not in reg.bits
+
+    def test_unknown_perms_not_interned(self):
+        u = User()
+        u.add_perm('granted')
+        bits = dict(u.perm_registry.bits)
+        assert not u.has_perm('never-granted-1')
+        assert u.has_any_perm('never-granted-2', 'granted')
+        assert not u.has_all_perms('never-granted-3', 'granted')
+        eq_(u.perm_registry.bits, bits)
+
+    def test_subclass_properties(self):
+        class MyUser(User):
+            pass
+        u = MyUser()
+        u.is_authenticated = True
+        u.perms = ['foo']
+        assert u.is_authenticated
+        assert u.has_perm('foo')
+        eq_(dict(u), {})
+
     def test_super_user_perms(self):
         u = User()
         u.is_super_user = True
@@ -149,6 +222,82 @@ class TestUserUnit(object):
         u = User()
         assert repr(u)
 
+    def test_modified(self):
+        u = User()
+        assert not u.is_modified()
+        assert u.is_empty()
+
+        u.foo = 'bar'
+        assert u.is_modified()
+        assert not u.is_empty()
+        u.mark_saved()
+        assert not u.is_modified()
+
+        # reading doesn't modify
+        assert u.foo == 'bar'
+        assert not u.has_perm('foo')
+        eq_(u.get_messages(), [])
+        assert not u.is_modified()
+
+        for change in (
+            lambda: setattr(u, 'is_authenticated', True),
+            lambda: u.add_perm('foo'),
+            lambda: u.add_message('notice', 'hi'),
+            lambda: u.get_messages(),
+            lambda: u.update(baz=1),
+            lambda: u.pop('baz'),
+            lambda: u.clear(),
+        ):
+            change()
+            assert u.is_modified()
+            u.mark_saved()
+
+    def test_pickle(self):
+        u = User()
+        u.is_authenticated = True
+        u.add_perm('foo', 'bar')
+        u.add_message('notice', 'hi', ident=5)
+        u.foo = 'bar'
+        u.__dict__['extra'] = 1
+
+        u2 = pickle.loads(pickle.dumps(u, 2))
+        assert u2.is_authenticated is True
+        assert u2.is_super_user is False
+        eq_(u2.perms, set(['foo', 'bar']))
+        eq_(dict(u2), {'foo': 'bar'})
+        eq_(u2.extra, 1)
+        assert not u2.is_modified()
+        msgs = u2.get_messages()
+        eq_([(msg.severity, msg.text) for msg in msgs], [('notice', 'hi')])
+        assert isinstance(msgs[0], UserMessage)
+        # still a LazyDict after unpickling
+        u2.baz = 1
+        eq_(u2['baz'], 1)
+
+        # the state has no class or attribute names
+        eq_(u.__getstate__(), (1, True, False, ['bar', 'foo'], [(5, 'notice', 'hi')],
+                               {'extra': 1}))
+
+    def test_setstate_legacy(self):
+        # users pickled before __getstate__() existed
+        u = User()
+        u.add_message('notice', 'hi')
+        state = dict(vars(u))
+        del state['_modified']
+        del state['_perm_mask']
+        state['perms'] = set(['foo'])
+        u2 = User.__new__(User)
+        u2.__setstate__(state)
+        eq_(len(u2.get_messages(clear=False)), 1)
+        assert u2.has_perm('foo')
+        assert u2.is_modified()
+
+        try:
+            u2.__setstate__((99,))
+            assert False
+        except ValueError as e:
+            assert 'unknown User state version' in str(e)
+
 
 class TestUserProxy(object):
 
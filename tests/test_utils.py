@@ -1,13 +1,20 @@
 from __future__ import with_statement
+import gzip
+import json
+import os
 from os import path
 
 from nose.tools import eq_
 from webtest import TestApp
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
 
 from blazeweb.globals import rg
+from blazeweb.routing import static_url
 from blazeweb.testing import inrequest
 from blazeweb.utils import exception_with_context, exception_context_filter
-from blazeweb.utils.filesystem import copy_static_files, mkdirs
+from blazeweb.utils.filesystem import copy_static_files, mkdirs, compress_static_files, \
+    write_static_manifest
 
 from scripting_helpers import script_test_path, env
 from newlayout.application import make_wsgi
@@ -80,6 +87,71 @@ class TestFirstApp(object):
         r = self.ta.get('/static/app/statictest.txt')
         assert 'newlayout' in r
 
+    def test_static_manifest(self):
+        copy_static_files(delete_existing=True)
+        with open(path.join(script_test_path, 'newlayout', 'static', 'manifest.json')) as fh:
+            manifest = json.load(fh)
+        hashed = manifest['app/statictest.txt']
+        assert hashed.startswith('app/statictest.') and hashed.endswith('.txt'), hashed
+        assert_contents('newlayout', path.join('newlayout', 'static', *hashed.split('/')))
+        assert 'component/news/statictest.txt' in manifest
+
+        # copying again does not hash the hashed copies
+        copy_static_files()
+        with open(path.join(script_test_path, 'newlayout', 'static', 'manifest.json')) as fh:
+            eq_(manifest, json.load(fh))
+
+        # the copies of earlier versions are not hashed either
+        appdir = path.join(script_test_path, 'newlayout', 'static', 'app')
+        for version in ('v1', 'v2', 'v3'):
+            with open(path.join(appdir, 'versioned.txt'), 'w') as fh:
+                fh.write(version)
+            newest = write_static_manifest()
+        eq_(len([fname for fname in os.listdir(appdir) if fname.startswith('versioned.')]), 4)
+        eq_(sorted(key for key in newest if 'versioned' in key), ['app/versioned.txt'])
+        os.remove(path.join(appdir, 'versioned.txt'))
+        copy_static_files()
+
+        ta = TestApp(make_wsgi())
+        eq_(static_url('app/statictest.txt'), 'static/' + hashed)
+        eq_(static_url('app/notinmanifest.txt'), 'static/app/notinmanifest.txt')
+
+        r = ta.get('/' + static_url('app/statictest.txt'))
+        assert 'newlayout' in r
+        eq_(r.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        r = ta.get('/static/app/statictest.txt')
+        assert 'immutable' not in r.headers['Cache-Control']
+
+    def test_precompressed_static_files(self):
+        copy_static_files(delete_existing=True, manifest=False)
+        css = b'body { color: black; }\n' * 100
+        with open(path.join(script_test_path, 'newlayout', 'static', 'app', 'big.css'), 'wb') as fh:
+            fh.write(css)
+        # statictest.txt is too small to be worth compressing
+        eq_(compress_static_files(formats=['gzip'], min_size=0), 1)
+        # up to date siblings are not written again
+        eq_(compress_static_files(formats=['gzip'], min_size=0), 0)
+        gzpath = path.join(script_test_path, 'newlayout', 'static', 'app', 'big.css.gz')
+        with gzip.open(gzpath) as fh:
+            eq_(fh.read(), css)
+
+        # webtest would decode the response, so use werkzeug's client
+        client = Client(make_wsgi(), BaseResponse)
+        r = client.get('/static/app/big.css', headers={'Accept-Encoding': 'gzip, deflate'})
+        eq_(r.headers['Content-Encoding'], 'gzip')
+        eq_(r.headers['Vary'], 'Accept-Encoding')
+        assert r.headers['Content-Type'].startswith('text/css')
+        eq_(gzip.decompress(r.data), css)
+
+        r = client.get('/static/app/big.css')
+        assert 'Content-Encoding' not in r.headers
+        eq_(r.headers['Vary'], 'Accept-Encoding')
+        eq_(r.data, css)
+
+        r = client.get('/static/app/statictest.txt', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in r.headers
+        assert 'Vary' not in r.headers
+
 
 class TestAborting(object):
 
@@ -1,3 +1,4 @@
+from formencode import ForEach
 from formencode.validators import Int, String, Email, Number
 from nose.tools import eq_
 from blazeutils.testing import logging_handler
@@ -9,7 +10,7 @@ from werkzeug.test import run_wsgi_app
 from blazeutils.jsonh import jsonmod
 from blazeweb.globals import rg, user
 import blazeweb.views
-from blazeweb.views import SecureView, jsonify
+from blazeweb.views import ArgProcessor, SecureView, jsonify
 from blazeweb.testing import inrequest
 from blazeweb.wrappers import Response
 
@@ -118,6 +119,49 @@ def test_get_args():
     assert r.get_data() == b'baz'
 
 
+@inrequest('/foo?bar=baz')
+def test_arg_signature_cache():
+    class TestView(View):
+        def init(self):
+            self.expect_getargs('bar')
+
+        def setup_view(self, bar, baz=None):
+            eq_(baz, None)
+
+        def default(self, bar, *, extra='x', **kwargs):
+            return '%s %s %s' % (bar, extra, sorted(kwargs))
+    r = TestView({'foo': '1'}).process()
+    eq_(r.get_data(), b"baz x ['foo']")
+
+    # introspection happened once per method and is stored on the class
+    cache = TestView.__dict__['_arg_signatures']
+    eq_(len(cache), 2)
+    sig = cache[TestView.__dict__['setup_view']]
+    eq_(sig.names, frozenset(['bar', 'baz']))
+    eq_(sig.required, ('bar', ))
+    assert not sig.takes_kwargs
+    assert cache[TestView.__dict__['default']].takes_kwargs
+
+    TestView({}).process()
+    eq_(len(cache), 2)
+
+    # subclasses get their own cache
+    class SubView(TestView):
+        pass
+    SubView({}).process()
+    assert SubView.__dict__['_arg_signatures'] is not cache
+
+    # missing keyword-only args are a bad request
+    class TestView(View):
+        def default(self, *, bar, baz):
+            pass  # pragma: no coverage
+    try:
+        TestView({'bar': 1}).process()
+        assert False
+    except BadRequest:
+        pass
+
+
 @inrequest('/foo?bar=baz&a1=a')
 def test_arg_processor():
     # register get args with a processor
@@ -351,6 +395,62 @@ def test_processing_with_lists():
         pass
 
 
+@inrequest('/foo?a=1&b=b&d=1&d=2&d=abc&h=1&h=foo&i[]=1&e=foo@bar.com')
+def test_class_level_processors():
+    class TestView(View):
+        arg_processors = (
+            ArgProcessor('a', int),
+            ArgProcessor('b', int),
+            ArgProcessor('d', int, takes_list=True, strict=True),
+            ArgProcessor('h', int, takes_list=True, list_item_invalidates=True, show_msg=True),
+            ArgProcessor('i[]', int, takes_list=True, pass_as='i'),
+            ArgProcessor('e', (Number, Email)),
+        )
+
+        def init(self):
+            # instance level processors still work and run afterwards
+            self.add_processor('c', int)
+
+        def default(self, a, c, d, i, b=5, h=None, e=None):
+            msgs = user.get_messages()
+            eq_(a, 1)
+            eq_(b, 5)
+            eq_(c, 2)
+            eq_(d, [1, 2])
+            # invalid, so removed from the calling args
+            eq_(h, None)
+            assert str(msgs[0]).startswith('error: h: Errors:'), msgs
+            eq_(i, [1])
+            eq_(e, None)
+            return 'ok'
+
+    # the validators are built when the class is declared, not per request
+    validator = TestView.arg_processors[2].validators[0]
+    assert isinstance(validator, ForEach)
+    eq_(TestView({'c': '2'}).process().get_data(), b'ok')
+    assert TestView.arg_processors[2].validators[0] is validator
+
+    # url args are not expected as get args
+    eq_(TestView({'c': '2', 'a': '3'}).expected_get_args, ['b', 'd', 'h', 'i[]', 'e'])
+
+    class TestView(View):
+        arg_processors = (
+            ArgProcessor('z', required=True),
+        )
+    try:
+        TestView({}).process()
+        assert False
+    except BadRequest:
+        pass
+
+    try:
+        ArgProcessor('e', 5)
+        assert False
+    except TypeError as e:
+        if 'processor must be a Formencode validator or a callable' != str(e):
+            raise  # pragma: no cover
+
+
 def test_call_method_changes():
     v = View({})
     assert v._cm_stack[0][0] == 'setup_view'